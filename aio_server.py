@@ -0,0 +1,195 @@
+"""Async serving mode: `python aio_server.py`.
+
+Slack requests go through Bolt's `AsyncApp` and its aiohttp adapter, and questions are answered on one event loop:
+the agents `achat`, the transcripts tool `aquery`s, the other tools and Slack calls are awaited. An in-flight question
+is a task waiting on the network instead of an OS thread, so one process serves many more of them at once.
+
+The index, tools, prompts, caches and limits are the ones `commons-bot.py` sets up (loaded through `wsgi.py`).
+"""
+import asyncio
+import json
+import logging
+import os
+
+# background services are started with the event loop, see _on_startup
+os.environ["COMMONS_BOT_PRELOAD"] = "1"
+# no nest_asyncio: a sync llama-index call made on the loop must fail loudly, not block it
+os.environ["COMMONS_BOT_ASYNC"] = "1"
+
+from aiohttp import web  # noqa: E402
+from llama_index.core.tools import QueryEngineTool  # noqa: E402
+from slack_bolt.adapter.aiohttp import to_aiohttp_response, to_bolt_request  # noqa: E402
+from slack_bolt.async_app import AsyncApp  # noqa: E402
+from slack_sdk.web.async_client import AsyncWebClient  # noqa: E402
+
+from jobs import AsyncJobQueue  # noqa: E402
+from metrics import registry  # noqa: E402
+from scheduler import PRIORITY_ONBOARDING, RequestScheduler  # noqa: E402
+import slack  # noqa: E402
+import utils  # noqa: E402
+from wsgi import commons_bot  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+# awaited by the agents' transcripts tool; a streamed response could only be read by blocking the loop
+query_engine_transcripts = commons_bot.query_engine_manager.create_query_engine(
+    retriever=commons_bot.retriever, depth=commons_bot.depth, streaming=False)
+_transcripts_tool = QueryEngineTool(query_engine=query_engine_transcripts,
+                                    metadata=commons_bot.query_engine_tools_manager.youtube_transcripts_tool.metadata)
+command_tools = [tool for tool in commons_bot.query_engine_agent_commands_tools
+                 if tool.metadata.name != _transcripts_tool.metadata.name] + [_transcripts_tool]
+
+# up to ASYNC_JOB_WORKERS questions are answered at once, each one a task; same rate limits as the threaded server
+scheduler = RequestScheduler(
+    AsyncJobQueue(max_workers=int(os.getenv("ASYNC_JOB_WORKERS", 16 if commons_bot.low_memory else 64)),
+                  max_queue=int(os.getenv("ASYNC_JOB_QUEUE_MAX", 256))),
+    user_limiter=commons_bot.scheduler.user_limiter,
+    channel_limiter=commons_bot.scheduler.channel_limiter)
+
+slack_ops = commons_bot.slack_ops
+message_handler = slack.MessageHandler(slack_ops, query_engine_transcripts, command_tools,
+                                       commons_bot.agent_commands_context, scheduler=scheduler,
+                                       single_flight=commons_bot.single_flight)
+cmd_handler = slack.CommandHandler(slack_ops, query_engine_transcripts, command_tools,
+                                   commons_bot.agent_commands_context, scheduler=scheduler,
+                                   single_flight=commons_bot.single_flight)
+
+bolt_app = AsyncApp(
+    client=AsyncWebClient(token=os.environ["SLACK_BOT_TOKEN"],
+                          base_url=os.getenv("SLACK_API_URL", AsyncWebClient.BASE_URL)),
+    signing_secret=os.environ["SLACK_SIGNING_SECRET"]
+)
+
+bolt_app.command("/commons")(cmd_handler.ahandle_commons_command_agent_only)
+bolt_app.command("/onboard")(cmd_handler.ahandle_onboard_command)
+bolt_app.command("/help")(cmd_handler.ahandle_help_command)
+
+
+@bolt_app.message()
+async def handle_incoming_messages(message):
+    if message.get('channel') in commons_bot.mirror_channel_ids:
+        await asyncio.to_thread(commons_bot.message_store.add_message, message)
+    message_handler.areply(message, commons_bot.bot_user_id)
+
+
+@bolt_app.event({"type": "message", "subtype": "message_changed"})
+async def handle_message_changed(event):
+    if event.get('channel') in commons_bot.mirror_channel_ids:
+        await asyncio.to_thread(commons_bot.message_store.update_message, event)
+
+
+@bolt_app.event({"type": "message", "subtype": "message_deleted"})
+async def handle_message_deleted(event):
+    await asyncio.to_thread(commons_bot.message_store.delete_message, event)
+
+
+@bolt_app.event("team_join")
+async def handle_member_joined_channel(event, client):
+    user_id = event['user']['id']
+    await client.chat_postMessage(channel=user_id, blocks=slack.blocks, text=f"Welcome <@{user_id}>")
+
+
+async def _recommend_for_role(role):
+    response = await slack.arun_agent(command_tools, commons_bot.agent_commands_context,
+                                      commons_bot._role_query(role), "onboarding")
+    return utils.convert_to_slack_formatting(str(response))
+
+
+async def _process_role_selection(role, user_id, channel_id, thread_ts, suggested_channels_text):
+    recommendations = await asyncio.to_thread(commons_bot.role_recommendations.get, role)
+    if recommendations is None:
+        # not precomputed yet (e.g. right after the first start), fall back to a live agent run
+        await slack_ops.apost_ephemeral_message(channel_id, user_id,
+                                                "Customizing information for you. Please wait a moment... :mag_right:")
+        try:
+            recommendations = await _recommend_for_role(role)
+            await asyncio.to_thread(commons_bot.role_recommendations.set, role, recommendations)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+
+    if recommendations:
+        await slack_ops.apost_ephemeral_message(channel_id, user_id, recommendations, thread_ts=thread_ts)
+
+    await slack_ops.apost_ephemeral_message(channel_id, user_id,
+                                            commons_bot._good_to_go_text(suggested_channels_text),
+                                            thread_ts=thread_ts)
+
+
+async def slack_interactive(request):
+    form = await request.post()
+    payload = json.loads(form["payload"])
+    role, user_id, channel_id, thread_ts = commons_bot._parse_payload(payload)
+    suggested_channels_text = commons_bot._get_suggested_channels(role)
+    response_text = commons_bot._construct_response_text(user_id, role, suggested_channels_text)
+
+    async def process():
+        await slack_ops.apost_ephemeral_message(channel_id, user_id, response_text)
+        await _process_role_selection(role, user_id, channel_id, thread_ts, suggested_channels_text)
+
+    def on_busy(_message):
+        # skip the personalized agent answer, the channel suggestions don't need the LLM
+        slack_ops.post_ephemeral_later(channel_id, user_id, response_text)
+        slack_ops.post_ephemeral_later(channel_id, user_id, commons_bot._good_to_go_text(suggested_channels_text),
+                                       thread_ts=thread_ts)
+
+    slack.submit_job(scheduler, "onboarding", process, priority=PRIORITY_ONBOARDING, user=user_id,
+                     on_busy=on_busy)
+    return web.json_response({})
+
+
+async def _dispatch(request):
+    return await to_aiohttp_response(await bolt_app.async_dispatch(await to_bolt_request(request)))
+
+
+async def slack_commands(request):
+    return await _dispatch(request)
+
+
+async def slack_events(request):
+    data = await request.json()
+    # Respond to the Slack challenge
+    if data and data.get("type") == "url_verification":
+        return web.json_response({"challenge": data.get("challenge")})
+
+    # the claim is a round trip to the shared state, keep it off the loop
+    if data and await asyncio.to_thread(commons_bot.event_deduplicator.seen, data.get("event_id")):
+        print(f"Skipping redelivered event {data.get('event_id')} (retry {request.headers.get('X-Slack-Retry-Num')})")
+        return web.Response(status=200)
+
+    return await _dispatch(request)
+
+
+async def metrics(request):
+    return web.Response(body=registry.render_prometheus().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4"})
+
+
+def start_background_services():
+    # the same per-process threads as the threaded server (feeds, video catalog, mirror backfill, onboarding
+    # answers, RSS reports), without its job workers
+    commons_bot.start_background_services(job_workers=False)
+
+
+async def _on_startup(app):
+    start_background_services()
+    scheduler.start()
+
+
+def create_app():
+    app = web.Application()
+    app.add_routes([
+        web.post("/slack/events", slack_events),
+        web.post("/slack/commands", slack_commands),
+        web.post("/slack/interactive", slack_interactive),
+        web.get("/metrics", metrics),
+    ])
+    app.on_startup.append(_on_startup)
+    return app
+
+
+def serve(host="0.0.0.0", port=None):
+    web.run_app(create_app(), host=host, port=int(port or os.getenv("PORT", 10000)))
+
+
+if __name__ == "__main__":
+    serve()
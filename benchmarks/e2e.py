@@ -0,0 +1,386 @@
+"""Offline end-to-end benchmark: the whole bot against local fakes, driven with signed Slack payloads.
+
+    python benchmarks/e2e.py --mode dev --requests 200 --concurrency 16
+    python benchmarks/e2e.py --mode gunicorn --llm-latency 1.0 --output gunicorn.json
+    python benchmarks/e2e.py --mode gunicorn --baseline gunicorn.json --max-regression 0.2
+    python benchmarks/e2e.py --mode gunicorn --low-memory --rss-budget-mb 1024
+    python benchmarks/e2e.py --compare gunicorn,async --concurrency 128 --llm-latency 2 --rss-budget-mb 1024
+
+The bot runs in a subprocess (`offline_app.py`) with a fake LLM, fake embeddings, an in-memory Qdrant filled with
+synthetic transcripts, and a fake Slack Web API served from this process. Each virtual user sends an event
+(mention), a `/commons` command or a role button click, and waits until the bot has posted its answer to the fake
+Slack API. We report the HTTP ack latency, the end-to-end answer latency, answer throughput and the peak RSS of the
+serving processes. With `--baseline` the run fails if it is more than `--max-regression` worse than the baseline, and
+with `--rss-budget-mb` if the serving processes ever used more memory than that.
+
+`--compare` runs the same load against several modes (e.g. the threaded gunicorn workers and the `async` server,
+aio_server.py) one after another. Each is sized by `--job-workers` (questions answered at once) and must stay within
+the same `--rss-budget-mb`; the table shows how many questions each mode answers at once and per second for the
+memory it used.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeSlackServer, marker  # noqa: E402
+from serving import percentile  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIGNING_SECRET = "benchmark-secret"
+KINDS = ("events", "commands", "interactive")
+MODES = ("dev", "gunicorn", "async")
+ROLES = ["software_engineer", "product_manager", "data_scientist", "solution_architect", "operations",
+         "security_specialist", "educator"]
+
+
+def sign(body, secret=SIGNING_SECRET):
+    timestamp = str(int(time.time()))
+    digest = hmac.new(secret.encode("utf-8"), f"v0:{timestamp}:{body}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": f"v0={digest}"}
+
+
+def build_request(kind, n):
+    """Returns (path, body, content type, completion key) for the n-th synthetic request of `kind`."""
+    user, channel = f"UBENCH{n}", f"CBENCH{n % 8}"
+    question = f"What do the OpenShift Commons videos say about upgrades {marker(n)}?"
+    if kind == "events":
+        body = json.dumps({
+            "type": "event_callback",
+            "token": "benchmark",
+            "team_id": "TBENCH",
+            "api_app_id": "ABENCH",
+            "event_id": f"EvBENCH{n}",
+            "event_time": int(time.time()),
+            "event": {"type": "message", "channel": channel, "user": user, "text": f"<@UBOT> {question}",
+                      "ts": f"{1700000000 + n}.000100", "channel_type": "channel"},
+        })
+        return "/slack/events", body, "application/json", marker(n)
+    if kind == "commands":
+        body = urllib.parse.urlencode({
+            "token": "benchmark", "team_id": "TBENCH", "channel_id": channel, "user_id": user, "command": "/commons",
+            "text": question, "response_url": "http://127.0.0.1/response", "trigger_id": f"trigger{n}",
+        })
+        return "/slack/commands", body, "application/x-www-form-urlencoded", marker(n)
+    payload = {
+        "type": "block_actions",
+        "user": {"id": user},
+        "channel": {"id": channel},
+        "team": {"id": "TBENCH"},
+        "actions": [{"action_id": f"select_{ROLES[n % len(ROLES)]}"}],
+    }
+    body = urllib.parse.urlencode({"payload": json.dumps(payload)})
+    return "/slack/interactive", body, "application/x-www-form-urlencoded", user
+
+
+class Completions:
+    """Watches the fake Slack API for the bot's answers: the message carrying a question's tag, or the final
+    onboarding message for a user."""
+
+    def __init__(self, slack):
+        self._events = {}
+        self._times = {}
+        self._lock = threading.Lock()
+        slack.listeners.append(self.on_message)
+
+    def expect(self, key):
+        with self._lock:
+            self._events[key] = threading.Event()
+
+    def on_message(self, message):
+        at, method, channel, user, text = message
+        if "videos say about" in text:
+            key = text.split("videos say about", 1)[1].split(":", 1)[0].strip()
+        elif "You are good to go" in text:
+            key = user
+        else:
+            return
+        with self._lock:
+            event = self._events.get(key)
+            if event is not None and key not in self._times:
+                self._times[key] = at
+                event.set()
+
+    def wait(self, key, timeout):
+        if self._events[key].wait(timeout):
+            return self._times[key]
+        return None
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident memory of the server process and its workers."""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        import psutil
+
+        root = psutil.Process(self.pid)
+        while not self._stop.is_set():
+            try:
+                processes = [root] + root.children(recursive=True)
+                self.peak = max(self.peak, sum(p.memory_info().rss for p in processes if p.is_running()))
+            except psutil.Error:
+                pass
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_bot(mode, port, env):
+    if mode == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--chdir", "benchmarks",
+                   "offline_app:app"]
+    elif mode == "async":
+        command = [sys.executable, os.path.join("benchmarks", "offline_app.py"), "--async"]
+    else:
+        command = [sys.executable, os.path.join("benchmarks", "offline_app.py")]
+    return subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **env, PORT=str(port)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    body = json.dumps({"type": "url_verification", "challenge": "ready"}).encode("utf-8")
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Bot exited with {process.returncode} while starting")
+        try:
+            request = urllib.request.Request(url + "/slack/events", data=body,
+                                             headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"Bot did not become ready within {timeout}s")
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+def max_in_flight(results):
+    """Most questions between request and answer at the same moment."""
+    edges = sorted([(r[1], 1) for r in results if r[3] is not None] + [(r[3], -1) for r in results if r[3] is not None])
+    peak = current = 0
+    for _, step in edges:
+        current += step
+        peak = max(peak, current)
+    return peak
+
+
+def run(url, completions, requests, concurrency, mix, answer_timeout):
+    kinds = [kind for kind in KINDS for _ in range(mix.get(kind, 0))] or list(KINDS)
+    results = []
+    lock = threading.Lock()
+
+    def virtual_user(n):
+        kind = kinds[n % len(kinds)]
+        path, body, content_type, key = build_request(kind, n)
+        completions.expect(key)
+        headers = {"Content-Type": content_type, **sign(body)}
+        start = time.perf_counter()
+        try:
+            request = urllib.request.Request(url + path, data=body.encode("utf-8"), headers=headers)
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            acked = time.perf_counter()
+            answered = completions.wait(key, answer_timeout)
+        except Exception:
+            acked = answered = None
+        with lock:
+            results.append((kind, start, acked, answered))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(virtual_user, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    report = {"requests": requests, "concurrency": concurrency, "elapsed_s": elapsed,
+              "max_in_flight": max_in_flight(results)}
+    for kind in KINDS + ("all",):
+        rows = [r for r in results if kind == "all" or r[0] == kind]
+        if not rows:
+            continue
+        answered = [r for r in rows if r[3] is not None]
+        report[kind] = {
+            "errors": sum(1 for r in rows if r[2] is None),
+            "unanswered": sum(1 for r in rows if r[2] is not None and r[3] is None),
+            "ack": summarize([r[2] - r[1] for r in rows if r[2] is not None]),
+            "answer": summarize([r[3] - r[1] for r in answered]),
+            "throughput_answers_per_s": len(answered) / elapsed if elapsed else 0.0,
+        }
+    return report
+
+
+def compare(report, baseline, max_regression):
+    """Returns the metrics that regressed by more than `max_regression` against `baseline`."""
+    regressions = []
+    checks = [("answer", "p95_ms"), ("answer", "p99_ms"), ("ack", "p99_ms")]
+    for section, metric in checks:
+        old, new = baseline["all"][section][metric], report["all"][section][metric]
+        if old and new > old * (1 + max_regression):
+            regressions.append(f"{section} {metric}: {old:.0f} -> {new:.0f}")
+    old, new = baseline["all"]["throughput_answers_per_s"], report["all"]["throughput_answers_per_s"]
+    if old and new < old * (1 - max_regression):
+        regressions.append(f"throughput: {old:.2f} -> {new:.2f} answers/s")
+    old, new = baseline.get("peak_rss_mb"), report.get("peak_rss_mb")
+    if old and new and new > old * (1 + max_regression):
+        regressions.append(f"peak RSS: {old:.0f} -> {new:.0f} MB")
+    return regressions
+
+
+def run_mode(mode, args, mix):
+    """Starts the bot in `mode` against a fresh fake Slack API, runs the load and returns the report."""
+    slack = FakeSlackServer(latency=args.slack_latency)
+    threading.Thread(target=slack.serve_forever, daemon=True).start()
+    completions = Completions(slack)
+
+    workdir = tempfile.mkdtemp(prefix="commons-bench-")
+    env = {
+        "SLACK_API_URL": slack.url,
+        "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+        "BENCH_LLM_LATENCY": str(args.llm_latency),
+        "BENCH_EMBED_LATENCY": str(args.embed_latency),
+        "BENCH_TRANSCRIPTS": str(args.transcripts),
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.sqlite3") if args.llm_cache else "",
+        "SLACK_MIRROR_PATH": os.path.join(workdir, "slack_messages.sqlite3"),
+        "RECOMMENDATIONS_PATH": os.path.join(workdir, "recommendations.sqlite3"),
+        "SHARED_STATE_PATH": os.path.join(workdir, "shared_state.sqlite3"),
+        # measure the serving path, not the per-user and per-channel limits
+        "RATE_LIMIT_USER_PER_MINUTE": "0",
+        "RATE_LIMIT_CHANNEL_PER_MINUTE": "0",
+        "JOB_QUEUE_MAX": str(max(args.requests, 32)),
+        "ASYNC_JOB_QUEUE_MAX": str(max(args.requests, 32)),
+    }
+    if args.job_workers:
+        env["JOB_WORKERS"] = env["ASYNC_JOB_WORKERS"] = str(args.job_workers)
+    if args.low_memory:
+        env["LOW_MEMORY"] = "1"
+    url = f"http://127.0.0.1:{args.port}"
+
+    process = start_bot(mode, args.port, env)
+    sampler = RssSampler(process.pid)
+    try:
+        # sample from the start, loading and indexing the transcripts counts against the memory budget too
+        sampler.start()
+        started = time.perf_counter()
+        wait_ready(url, process, args.startup_timeout)
+        startup = time.perf_counter() - started
+        report = run(url, completions, args.requests, args.concurrency, mix, args.answer_timeout)
+    finally:
+        sampler.stop()
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        slack.shutdown()
+
+    peak_rss_gb = sampler.peak / (1024 * 1024 * 1024)
+    report.update({
+        "mode": mode,
+        "startup_s": startup,
+        "peak_rss_mb": peak_rss_gb * 1024,
+        "answers_per_s_per_gb": report["all"]["throughput_answers_per_s"] / peak_rss_gb if peak_rss_gb else 0.0,
+        "job_workers": args.job_workers,
+        "llm_latency_s": args.llm_latency,
+        "low_memory": args.low_memory,
+        "rss_budget_mb": args.rss_budget_mb,
+        "slack_api_calls": slack.calls,
+    })
+    return report
+
+
+def print_comparison(reports):
+    print(f"{'mode':<10} {'peak RSS MB':>12} {'in flight':>10} {'answers/s':>10} {'answers/s/GB':>13} "
+          f"{'p95 answer ms':>14} {'unanswered':>11}")
+    for report in reports:
+        total = report["all"]
+        print(f"{report['mode']:<10} {report['peak_rss_mb']:>12.0f} {report['max_in_flight']:>10} "
+              f"{total['throughput_answers_per_s']:>10.2f} {report['answers_per_s_per_gb']:>13.2f} "
+              f"{total['answer']['p95_ms']:>14.0f} {total['unanswered'] + total['errors']:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=MODES, default="dev")
+    parser.add_argument("--compare", help="comma separated modes to run one after another, e.g. gunicorn,async")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--requests", type=int, default=120)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", default="events=2,commands=2,interactive=1",
+                        help="relative share of mentions, slash commands and role clicks")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per fake LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per fake embedding call")
+    parser.add_argument("--slack-latency", type=float, default=0.02, help="seconds per fake Slack API call")
+    parser.add_argument("--transcripts", type=int, default=48, help="synthetic transcripts to index")
+    parser.add_argument("--llm-cache", action="store_true", help="keep the LLM completion cache enabled")
+    parser.add_argument("--job-workers", type=int,
+                        help="questions answered at once per process (JOB_WORKERS threads, ASYNC_JOB_WORKERS tasks)")
+    parser.add_argument("--answer-timeout", type=float, default=300)
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--low-memory", action="store_true", help="serve with the LOW_MEMORY profile")
+    parser.add_argument("--rss-budget-mb", type=float, help="fail if the peak RSS goes above this")
+    args = parser.parse_args()
+
+    mix = {kind: int(share) for kind, share in (part.split("=") for part in args.mix.split(","))}
+    modes = args.compare.split(",") if args.compare else [args.mode]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+
+    reports = [run_mode(mode, args, mix) for mode in modes]
+    output = reports[0] if len(reports) == 1 else {"runs": reports}
+    print(json.dumps(output, indent=2))
+    if len(reports) > 1:
+        print_comparison(reports)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    failures = []
+    for report in reports:
+        if args.rss_budget_mb and report["peak_rss_mb"] > args.rss_budget_mb:
+            failures.append(f"{report['mode']}: peak RSS {report['peak_rss_mb']:.0f} MB is over the "
+                            f"{args.rss_budget_mb:.0f} MB budget")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for report in reports:
+            regressions = compare(report, baseline, args.max_regression)
+            if regressions:
+                failures.append(f"{report['mode']}: regressions against the baseline:\n  " + "\n  ".join(regressions))
+    if failures:
+        print("Benchmark failed, " + "\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
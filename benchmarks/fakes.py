@@ -0,0 +1,266 @@
+"""Deterministic local stand-ins for OpenAI, the YouTube transcripts and the Slack Web API.
+
+`install()` patches them in before `commons-bot.py` is loaded, so the whole bot (Flask, Bolt, agents, query engine,
+in-memory Qdrant, Slack client) runs offline with fixed, configurable latencies. The async methods wait with
+`asyncio.sleep`, like a real network call awaited by the async server.
+"""
+import asyncio
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Sequence
+from urllib.parse import parse_qs
+
+MARKER_PATTERN = re.compile(r"bench-\d+-q")
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+TOPICS = ["kubernetes operators", "openshift virtualization", "service mesh", "gitops with argo cd",
+          "tekton pipelines", "serverless with knative", "edge computing", "observability with prometheus",
+          "security and compliance", "data science on openshift", "ai model serving", "multicluster management"]
+
+
+def marker(n):
+    """Unique tag that the fake LLM copies into its answer, so the harness can tell when a question was answered."""
+    return f"bench-{n}-q"
+
+
+def fake_transcripts(count=48, sentences=40):
+    from llama_index.core import Document
+
+    documents = []
+    for i in range(count):
+        topic = TOPICS[i % len(TOPICS)]
+        text = " ".join(
+            f"In this OpenShift Commons briefing we talk about {topic} and how teams run it in production, "
+            f"part {j} of the discussion covers upgrades, day two operations and lessons learned."
+            for j in range(sentences)
+        )
+        documents.append(Document(text=text, metadata={"video_id": f"video{i:04d}", "topic": topic}))
+    return documents
+
+
+def _make_fake_llm():
+    from llama_index.core.base.llms.generic_utils import completion_response_to_chat_response
+    from llama_index.core.base.llms.types import ChatMessage, ChatResponse, CompletionResponse, LLMMetadata
+    from llama_index.core.bridge.pydantic import Field
+    from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+    from llama_index.core.llms.custom import CustomLLM
+
+    class FakeLLM(CustomLLM):
+        """Answers like a ReAct agent: one `youtube_transcripts` call, then an answer echoing the question's tag."""
+
+        model: str = Field(default="fake")
+        temperature: float = Field(default=0.0)
+        latency: float = Field(default=0.0)
+
+        def __init__(self, model: str = "fake", temperature: float = 0.0, latency: float = None, **kwargs: Any):
+            if latency is None:
+                latency = float(os.getenv("BENCH_LLM_LATENCY", 0.5))
+            super().__init__(model=model, temperature=temperature, latency=latency)
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "fake_llm"
+
+        @property
+        def metadata(self) -> LLMMetadata:
+            return LLMMetadata(context_window=128000, num_output=512, model_name=self.model, is_chat_model=False)
+
+        def _respond(self, prompt: str) -> str:
+            time.sleep(self.latency)
+            return self._answer(prompt)
+
+        def _answer(self, prompt: str) -> str:
+            found = MARKER_PATTERN.findall(prompt)
+            tag = found[-1] if found else "onboarding"
+            if "## Output Format" not in prompt:
+                # response synthesis over retrieved transcripts
+                return f"The transcripts about {tag} cover upgrades and day two operations."
+
+            conversation = prompt.split("## Current Conversation", 1)[-1]
+            if "Observation:" in conversation or "youtube_transcripts" not in prompt:
+                return (f"Thought: I can answer without using any more tools.\n"
+                        f"Answer: Here is what the OpenShift Commons videos say about {tag}: "
+                        f"teams run it in production and share their lessons learned.")
+            return ("Thought: I need to use a tool to help me answer the question.\n"
+                    "Action: youtube_transcripts\n"
+                    f'Action Input: {json.dumps({"input": f"openshift {tag}"})}')
+
+        @llm_completion_callback()
+        def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+            return CompletionResponse(text=self._respond(prompt))
+
+        @llm_completion_callback()
+        def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+            text = self._respond(prompt)
+
+            def gen():
+                emitted = ""
+                for word in text.split(" "):
+                    delta = word if not emitted else " " + word
+                    emitted += delta
+                    yield CompletionResponse(text=emitted, delta=delta)
+
+            return gen()
+
+        @llm_completion_callback()
+        async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+            await asyncio.sleep(self.latency)
+            return CompletionResponse(text=self._answer(prompt))
+
+        @llm_chat_callback()
+        async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+            prompt = self.messages_to_prompt(messages)
+            return completion_response_to_chat_response(await self.acomplete(prompt, formatted=True, **kwargs))
+
+    return FakeLLM
+
+
+def _make_fake_embedding():
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+    from llama_index.core.bridge.pydantic import Field
+
+    class FakeEmbedding(BaseEmbedding):
+        """Hashed bag-of-words vectors, so similar texts land close together without a model."""
+
+        dim: int = Field(default=1536)
+        latency: float = Field(default=0.0)
+
+        def __init__(self, model: str = "fake-embedding", dim: int = 1536, latency: float = None, **kwargs: Any):
+            if latency is None:
+                latency = float(os.getenv("BENCH_EMBED_LATENCY", 0.05))
+            super().__init__(model_name=model, dim=dim, latency=latency)
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "fake_embedding"
+
+        def _vector(self, text: str) -> List[float]:
+            vector = [0.0] * self.dim
+            for token in _TOKEN_PATTERN.findall(text.lower()):
+                vector[zlib.crc32(token.encode("utf-8")) % self.dim] += 1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            return [v / norm for v in vector]
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            time.sleep(self.latency)
+            return self._vector(query)
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            await asyncio.sleep(self.latency)
+            return self._vector(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            time.sleep(self.latency)
+            return self._vector(text)
+
+        def _get_text_embeddings(self, texts: Sequence[str]) -> List[List[float]]:
+            time.sleep(self.latency)
+            return [self._vector(text) for text in texts]
+
+    return FakeEmbedding
+
+
+def install(transcripts=48):
+    """Replaces OpenAI, graphsignal and the YouTube transcripts with local fakes, and sets the env the bot needs."""
+    import graphsignal
+    import llama_index.embeddings.openai
+    import llama_index.llms.openai
+    import loaders
+
+    llama_index.llms.openai.OpenAI = _make_fake_llm()
+    llama_index.embeddings.openai.OpenAIEmbedding = _make_fake_embedding()
+    graphsignal.configure = lambda *args, **kwargs: None
+    documents = fake_transcripts(transcripts)
+    loaders.YouTubeLoader.yttranscripts = property(lambda self: documents)
+
+    for name, value in {
+        "QD_ENDPOINT": ":memory:",  # without QD_API_KEY the bot uses an in-memory Qdrant
+        "SLACK_BOT_TOKEN": "xoxb-benchmark",
+        "SLACK_SIGNING_SECRET": "benchmark-secret",
+        "GRAPH_SIGNAL_API_KEY": "benchmark",
+        "BING_SEARCH_API_KEY": "benchmark",
+        "OPENAI_API_KEY": "sk-benchmark",
+    }.items():
+        os.environ.setdefault(name, value)
+    os.environ.pop("QD_API_KEY", None)
+
+
+class FakeSlackServer(ThreadingHTTPServer):
+    """Stand-in for the Slack Web API (`SLACK_API_URL`) that records every message the bot posts."""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__((host, port), _FakeSlackHandler)
+        self.latency = latency
+        self.calls = {}
+        self.messages = []  # (time, method, channel, user, text)
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._ts = 1700000000
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/api/"
+
+    def record(self, method, args):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self._ts += 1
+            ts = f"{self._ts}.000100"
+            if method.startswith("chat.post"):
+                message = (time.perf_counter(), method, args.get("channel"), args.get("user"), args.get("text") or "")
+                self.messages.append(message)
+                for listener in self.listeners:
+                    listener(message)
+        return ts
+
+    def respond(self, method, args):
+        ts = self.record(method, args)
+        if method == "auth.test":
+            return {"ok": True, "user_id": "UBOT", "bot_id": "BBOT", "team_id": "TBENCH", "user": "commons-bot"}
+        if method == "conversations.list":
+            return {"ok": True, "channels": [{"id": "C0FNVPMNF", "name": "general"}],
+                    "response_metadata": {"next_cursor": ""}}
+        if method == "conversations.history":
+            return {"ok": True, "messages": [], "has_more": False}
+        if method == "chat.postMessage":
+            return {"ok": True, "channel": args.get("channel"), "ts": ts}
+        if method == "chat.postEphemeral":
+            return {"ok": True, "message_ts": ts}
+        return {"ok": True}
+
+
+class _FakeSlackHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _args(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        if not body:
+            return {}
+        if "json" in (self.headers.get("Content-Type") or ""):
+            return json.loads(body)
+        return {key: values[-1] for key, values in parse_qs(body).items()}
+
+    def _handle(self):
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        args = self._args()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        data = json.dumps(self.server.respond(method, args)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
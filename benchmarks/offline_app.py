@@ -0,0 +1,48 @@
+"""The bot with local fakes for OpenAI, Qdrant and the YouTube transcripts, for `benchmarks/e2e.py`.
+
+    SLACK_API_URL=http://127.0.0.1:8099/api/ python benchmarks/offline_app.py           # threaded dev server
+    SLACK_API_URL=... gunicorn -c gunicorn.conf.py --chdir benchmarks offline_app:app    # production mode
+    SLACK_API_URL=... python benchmarks/offline_app.py --async                          # aio_server.py
+
+`SLACK_API_URL` must point at a `fakes.FakeSlackServer`. Background services that reach the internet (news feeds,
+YouTube link validation, precomputed onboarding answers) are not started; only the job queue is.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import fakes  # noqa: E402
+
+fakes.install(transcripts=int(os.getenv("BENCH_TRANSCRIPTS", 48)))
+
+if "--async" in sys.argv:
+    # set before commons-bot.py is loaded, as aio_server.py does
+    os.environ["COMMONS_BOT_ASYNC"] = "1"
+_preload = os.environ.get("COMMONS_BOT_PRELOAD")
+os.environ["COMMONS_BOT_PRELOAD"] = "1"
+import wsgi  # noqa: E402
+
+if _preload is None:
+    del os.environ["COMMONS_BOT_PRELOAD"]
+
+
+def start_background_services():
+    wsgi.commons_bot.scheduler.start()
+
+
+# gunicorn.conf.py calls wsgi.start_background_services() in each worker
+wsgi.start_background_services = start_background_services
+app = wsgi.app
+
+if __name__ == "__main__" and "--async" in sys.argv:
+    import aio_server
+
+    # its job queue is started with the loop
+    aio_server.start_background_services = lambda: None
+    aio_server.serve(host="127.0.0.1")
+elif __name__ == "__main__":
+    start_background_services()
+    app.run(host="127.0.0.1", port=int(os.getenv("PORT", 10000)), threaded=True)
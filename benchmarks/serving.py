@@ -0,0 +1,75 @@
+"""Compare serving modes by firing concurrent requests at a running bot.
+
+    python commons-bot.py                              # dev server
+    gunicorn -c gunicorn.conf.py wsgi:app              # production mode
+    python benchmarks/serving.py --url http://localhost:10000 --requests 2000 --concurrency 32
+
+By default this posts Slack `url_verification` challenges to /slack/events, which exercises the HTTP serving path
+(request parsing, routing, worker/thread scheduling) without touching Slack or the LLM.
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def run(url, path, body, requests, concurrency, timeout=30):
+    data = json.dumps(body).encode("utf-8")
+
+    def send(_):
+        request = urllib.request.Request(url.rstrip("/") + path, data=data,
+                                         headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+            return time.perf_counter() - start
+        except Exception:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [r for r in results if r is not None]
+    return summarize(latencies, len(results) - len(latencies), elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:10000")
+    parser.add_argument("--path", default="/slack/events")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    body = {"type": "url_verification", "challenge": "benchmark"}
+    result = run(args.url, args.path, body, args.requests, args.concurrency)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
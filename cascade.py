@@ -0,0 +1,172 @@
+import logging
+import time
+from typing import Any, Optional, Sequence
+
+from llama_index.core.agent.react.output_parser import ReActOutputParser
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.llm import LLM
+
+from metrics import registry
+import tracing
+
+log = logging.getLogger(__name__)
+
+ROUTE = "route"
+SYNTHESIS = "synthesis"
+
+# USD per 1M (prompt, completion) tokens, local models are free
+MODEL_PRICES = {
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+
+def token_usage(response):
+    """(prompt tokens, completion tokens) reported by OpenAI or Ollama, (0, 0) for cached or unknown responses."""
+    counts = response.additional_kwargs or {}
+    if "prompt_tokens" in counts:
+        return counts.get("prompt_tokens") or 0, counts.get("completion_tokens") or 0
+    raw = response.raw if isinstance(response.raw, dict) else {}
+    return raw.get("prompt_eval_count") or 0, raw.get("eval_count") or 0
+
+
+def cost_usd(model, prompt_tokens, completion_tokens):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # dated snapshots (gpt-4o-2024-05-13) cost the same as their alias
+        prices = next((p for name, p in MODEL_PRICES.items() if model.startswith(name + "-")), (0.0, 0.0))
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+
+class CascadeLLM(LLM):
+    """LLM for ReAct agents that runs each reasoning step on a fast, cheap model first.
+
+    Tool selection and the tool inputs (the rewritten queries) are taken from the fast model. When the fast model
+    decides to answer, or its output does not parse as a ReAct step (or it fails), the step is run again on the
+    strong model, so final answers always come from the strong model. Per request, the latency and cost of both roles
+    are recorded on the trace (`llm_route`, `llm_synthesis`) and as `llm_tokens` / `llm_cost_usd` counters.
+    """
+
+    _fast: LLM = PrivateAttr()
+    _strong: LLM = PrivateAttr()
+    _parser: ReActOutputParser = PrivateAttr()
+
+    def __init__(self, fast: LLM, strong: LLM, **kwargs: Any) -> None:
+        super().__init__(callback_manager=strong.callback_manager, **kwargs)
+        self._fast = fast
+        self._strong = strong
+        self._parser = ReActOutputParser()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CascadeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._strong.metadata
+
+    def _record(self, role, llm, response, seconds):
+        model = llm.metadata.model_name
+        prompt_tokens, completion_tokens = token_usage(response)
+        tracing.record(f"llm_{role}", seconds, model=model)
+        tracing.record_llm_usage(role, model, prompt_tokens, completion_tokens,
+                                 cost_usd(model, prompt_tokens, completion_tokens))
+
+    def _routed(self, response: Optional[ChatResponse]) -> bool:
+        """Whether the fast model's step can be used: it parses and picks a tool instead of answering."""
+        if response is None:
+            registry.inc("cascade_steps", result="fast_error")
+            return False
+        try:
+            step = self._parser.parse(response.message.content or "", is_streaming=False)
+        except Exception:
+            registry.inc("cascade_steps", result="unparsable")
+            return False
+        if step.is_done:
+            registry.inc("cascade_steps", result="answer")
+            return False
+        registry.inc("cascade_steps", result="routed")
+        return True
+
+    def _fast_chat(self, messages, kwargs):
+        start = time.perf_counter()
+        try:
+            response = self._fast.chat(messages, **kwargs)
+        except Exception as e:
+            log.warning(f"Fast model failed, using the strong model: {e}")
+            return None
+        self._record(ROUTE, self._fast, response, time.perf_counter() - start)
+        return response
+
+    def _strong_chat(self, messages, kwargs):
+        start = time.perf_counter()
+        response = self._strong.chat(messages, **kwargs)
+        self._record(SYNTHESIS, self._strong, response, time.perf_counter() - start)
+        return response
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = self._fast_chat(messages, kwargs)
+        if self._routed(response):
+            return response
+        return self._strong_chat(messages, kwargs)
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        start = time.perf_counter()
+        try:
+            response = await self._fast.achat(messages, **kwargs)
+            self._record(ROUTE, self._fast, response, time.perf_counter() - start)
+        except Exception as e:
+            log.warning(f"Fast model failed, using the strong model: {e}")
+            response = None
+        if self._routed(response):
+            return response
+
+        start = time.perf_counter()
+        response = await self._strong.achat(messages, **kwargs)
+        self._record(SYNTHESIS, self._strong, response, time.perf_counter() - start)
+        return response
+
+    # completions and streams are final output, they go to the strong model directly
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return self._strong.complete(prompt, formatted=formatted, **kwargs)
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return self._strong.stream_chat(messages, **kwargs)
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        return self._strong.stream_complete(prompt, formatted=formatted, **kwargs)
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return await self._strong.acomplete(prompt, formatted=formatted, **kwargs)
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        return await self._strong.astream_chat(messages, **kwargs)
+
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        return await self._strong.astream_complete(prompt, formatted=formatted, **kwargs)
+
+
+def create_fast_llm(spec, ollama_base_url="http://localhost:11434"):
+    """The fast model for `LLM_CASCADE_MODEL`: an OpenAI model name, or `ollama:<model>` for a local one."""
+    if spec.startswith("ollama:"):
+        from llama_index.llms.ollama import Ollama
+
+        return Ollama(model=spec.split(":", 1)[1], base_url=ollama_base_url, request_timeout=120.0)
+
+    from llama_index.llms.openai import OpenAI
+
+    return OpenAI(model=spec, temperature=0.0, stop_symbols=["\n"])
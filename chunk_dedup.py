@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import random
+import re
+import struct
+from typing import Any, List
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, NodeRelationship, TransformComponent
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+_WORD_PATTERN = re.compile(r"\w+")
+# largest 32-bit prime, for the (a * x + b) mod p hash family; a * x + b stays below 2 ** 64
+_PRIME = 4294967291
+
+
+def shingles(text, size=5):
+    """Set of hashed `size`-word shingles of `text` (case and punctuation insensitive)."""
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+    return {
+        struct.unpack("<I", hashlib.blake2b(" ".join(words[i:i + size]).encode("utf-8"), digest_size=4).digest())[0]
+        for i in range(len(words) - size + 1)
+    }
+
+
+class MinHasher:
+    """MinHash signatures whose agreement estimates the Jaccard similarity of two shingle sets.
+
+    Each permutation is a universal hash `(a * x + b) mod p` with random `a` and `b`, so the signature positions are
+    independent, as the LSH banding assumes. All permutations of a chunk are computed at once with numpy.
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+        import numpy as np
+
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._a = np.array([rng.randrange(1, _PRIME) for _ in range(num_perm)], dtype=np.uint64)[:, None]
+        self._b = np.array([rng.randrange(0, _PRIME) for _ in range(num_perm)], dtype=np.uint64)[:, None]
+
+    def signature(self, shingle_set):
+        import numpy as np
+
+        if not shingle_set:
+            return (_PRIME,) * self.num_perm
+        values = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set)) % np.uint64(_PRIME)
+        hashed = (self._a * values + self._b) % np.uint64(_PRIME)
+        return tuple(hashed.min(axis=1).tolist())
+
+    @staticmethod
+    def similarity(a, b):
+        return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+class NearDuplicateIndex:
+    """LSH over MinHash signatures: `bands` buckets per signature, so only likely duplicates are compared."""
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=5):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm)
+        self._rows = num_perm // bands
+        self._buckets = {}  # (band, band hash) -> keys
+        self._signatures = {}
+
+    def _bands(self, signature):
+        for band in range(0, len(signature), self._rows):
+            yield band, hash(signature[band:band + self._rows])
+
+    def find(self, signature):
+        """Key of an indexed text that is at least `threshold` similar, or None."""
+        seen = set()
+        for band in self._bands(signature):
+            for key in self._buckets.get(band, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                if MinHasher.similarity(signature, self._signatures[key]) >= self.threshold:
+                    return key
+        return None
+
+    def add(self, key, signature):
+        self._signatures[key] = signature
+        for band in self._bands(signature):
+            self._buckets.setdefault(band, []).append(key)
+
+    def find_or_add(self, key, text):
+        """Returns the key of the near-duplicate of `text`, or indexes `text` under `key` and returns None."""
+        signature = self.hasher.signature(shingles(text, self.shingle_size))
+        duplicate = self.find(signature)
+        if duplicate is None:
+            self.add(key, signature)
+        return duplicate
+
+
+class NearDuplicateFilter(TransformComponent):
+    """Ingestion step after the splitter that drops chunks nearly identical to an earlier one (repeated intros,
+    sponsor segments, talks uploaded twice) before they are embedded.
+
+    The kept chunk records the documents its duplicates came from in `duplicate_sources`, which is left out of the
+    embedding and the LLM prompt.
+    """
+
+    threshold: float = 0.8
+    num_perm: int = 64
+    bands: int = 16
+    shingle_size: int = 5
+    embedding_dimensions: int = 1536
+
+    _stats: dict = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NearDuplicateFilter"
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        index = NearDuplicateIndex(self.threshold, self.num_perm, self.bands, self.shingle_size)
+        kept, by_id = [], {}
+        dropped_bytes = 0
+        for node in nodes:
+            text = node.get_content()
+            duplicate_of = index.find_or_add(node.node_id, text)
+            if duplicate_of is None:
+                kept.append(node)
+                by_id[node.node_id] = node
+                continue
+
+            original = by_id[duplicate_of]
+            sources = original.metadata.setdefault("duplicate_sources", [])
+            if node.ref_doc_id and node.ref_doc_id != original.ref_doc_id and node.ref_doc_id not in sources:
+                sources.append(node.ref_doc_id)
+            for excluded in (original.excluded_embed_metadata_keys, original.excluded_llm_metadata_keys):
+                if "duplicate_sources" not in excluded:
+                    excluded.append("duplicate_sources")
+            dropped_bytes += len(text.encode("utf-8"))
+
+        if len(kept) < len(nodes):
+            self._relink(nodes, kept)
+
+        dropped = len(nodes) - len(kept)
+        self._stats = {
+            "chunks": len(nodes),
+            "dropped": dropped,
+            "embeddings_saved": dropped,
+            "storage_saved_bytes": dropped_bytes + dropped * self.embedding_dimensions * 4,
+        }
+        registry.inc("ingestion_chunks", len(nodes))
+        registry.inc("ingestion_duplicate_chunks", dropped)
+        log.info(f"Dropped {dropped} of {len(nodes)} chunks as near-duplicates, saving {dropped} embeddings and "
+                 f"~{self._stats['storage_saved_bytes'] / 1024 / 1024:.1f} MB of vectors and text")
+        return kept
+
+    @staticmethod
+    def _relink(nodes, kept):
+        """Points the PREVIOUS / NEXT relationships of the kept chunks past the dropped ones (or drops them)."""
+        by_id = {node.node_id: node for node in nodes}
+        dropped_ids = by_id.keys() - {node.node_id for node in kept}
+        for node in kept:
+            for relation in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+                info = node.relationships.get(relation)
+                if info is None or info.node_id not in dropped_ids:
+                    continue
+                while info is not None and info.node_id in dropped_ids:
+                    info = by_id[info.node_id].relationships.get(relation)
+                if info is None:
+                    del node.relationships[relation]
+                else:
+                    node.relationships[relation] = info
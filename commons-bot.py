@@ -1,17 +1,33 @@
+import hmac
 import json
 import logging
 import os
 import sys
 from nest_asyncio import apply
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, abort, request, jsonify, send_file
 
 from slack_sdk import WebClient, WebhookClient
 import slack
+from cascade import CascadeLLM, create_fast_llm
 
 from index import IndexManager
-from loaders import QdrantClientManager, EnvironmentConfig
+from jobs import JobQueue
+from rate_limit import KeyedRateLimiter
+from scheduler import PRIORITY_ONBOARDING, RequestScheduler
+from shared_state import create_coordination_state, create_shared_state
+from singleflight import EventDeduplicator, SingleFlight
+from llm_cache import CachedLLM, CompletionCache, SharedCompletionCache
+from loaders import QdrantClientManager, EnvironmentConfig, YouTubeLoader
+from metrics import registry
+from profiling import Profiler, rss_bytes
 from query_engine import QueryEngineManager, QueryEngineToolsManager
+from prefetch import RetrievalPrefetcher
+from recommendations import RoleRecommendations
+from retrieval import AdaptiveDepthPostprocessor, ThreadedRetriever, TwoStageRetriever, VideoSummaryIndex
+from slack_mirror import SlackMessageStore
+from youtube_catalog import VideoCatalog
+import tracing
 
 from llama_index.core import Settings, ServiceContext
 from llama_index.core.node_parser import (
@@ -20,7 +36,6 @@ from llama_index.core.node_parser import (
     SentenceSplitter
 )
 
-from llama_index.core.agent.react import ReActAgent
 from llama_index.llms.openai import OpenAI
 from llama_index.llms.ollama import Ollama
 
@@ -38,8 +53,39 @@ import os
 # Settings.llm = OpenAI(model="gpt-3.5-turbo", temperature=0.1, stop_symbols=["\n"])
 Settings.llm = OpenAI(model="gpt-4o", temperature=0.1, stop_symbols=["\n"])
 
+# LOW_MEMORY=1 for small VMs (1 GB): no punctuation model at ingestion, fewer workers and smaller in-memory caches
+low_memory = os.getenv("LOW_MEMORY", "").lower() in ("1", "true", "yes")
+cache_max_bytes = int(os.getenv("CACHE_MAX_MB", 16 if low_memory else 128)) * 1024 * 1024
+
+# caches shared by all replicas (set SHARED_STATE_URL=redis://...)
+shared_state_url = os.getenv("SHARED_STATE_URL")
+shared_state = create_shared_state(shared_state_url, max_bytes=cache_max_bytes)
+# seen events, in-flight questions and leases; must never be evicted, so COORDINATION_STATE_URL should point at a Redis
+# with maxmemory-policy noeviction; in SQLite shared by this host's workers without a URL
+coordination_state = create_coordination_state(os.getenv("COORDINATION_STATE_URL", shared_state_url),
+                                               os.getenv("SHARED_STATE_PATH", "shared_state.sqlite3"))
+
+# persistent exact-match cache for repeated prompts (onboarding queries, agent retries, ...)
+# set LLM_CACHE_PATH to an empty string to disable it
+llm_cache_path = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+llm_cache = None
+if llm_cache_path:
+    llm_cache = CompletionCache(llm_cache_path, max_bytes=int(os.getenv("LLM_CACHE_MAX_MB", 64)) * 1024 * 1024)
+if shared_state_url:
+    llm_cache = SharedCompletionCache(shared_state, local=llm_cache)
+if llm_cache is not None:
+    Settings.llm = CachedLLM(Settings.llm, llm_cache)
+
 # Settings.llm = Ollama(model="llama2", request_timeout=240.0, base_url="http://192.168.178.254:11434")
 
+# LLM_CASCADE_MODEL=gpt-4o-mini (or ollama:llama3) picks the agents' tools and tool inputs, Settings.llm answers
+cascade_model = os.getenv("LLM_CASCADE_MODEL")
+if cascade_model:
+    fast_llm = create_fast_llm(cascade_model, ollama_base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"))
+    if llm_cache is not None:
+        fast_llm = CachedLLM(fast_llm, llm_cache)
+    slack.use_agent_llm(CascadeLLM(fast_llm, Settings.llm))
+
 # set llm as gpt-3.5-turbo for faster response time
 # change to gpt-4-turn
 Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
@@ -52,7 +98,10 @@ configure(api_key=os.environ['GRAPH_SIGNAL_API_KEY'], deployment='commons-bot')
 
 # Load environment variables from .env file or Lambda environment
 load_dotenv()
-apply()
+# the async server (aio_server.py) awaits the async APIs on its loop instead; nested loops would hide sync calls
+# blocking it
+if not os.getenv("COMMONS_BOT_ASYNC"):
+    apply()
 
 # even noisier debugging
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -62,6 +111,20 @@ collection_name = "commons-clean"
 config = EnvironmentConfig()
 qdrant_manager = QdrantClientManager(config, collection_name)
 qdrant_client = qdrant_manager.client
+# awaited searches of the async server (aio_server.py), None for the in-memory Qdrant
+qdrant_aclient = qdrant_manager.async_client
+
+# per-stage latency histograms (embedding, Qdrant search, rerank, LLM, tools, Slack API), served on /metrics
+tracing.install_llama_index_spans()
+tracing.instrument_methods(qdrant_client, ["search", "search_batch", "query_points"], stage="qdrant_search")
+if qdrant_aclient is not None:
+    tracing.instrument_methods(qdrant_aclient, ["search", "search_batch", "query_points"], stage="qdrant_search")
+
+# PROFILE_* env vars turn on tracemalloc diffs, CPU profiles of slow requests and RSS reports, see /debug/profiles
+profiler = Profiler.from_env()
+if profiler.memory_sample_rate > 0 or profiler.slow_seconds > 0:
+    tracing.add_request_hook(profiler.profile_request)
+profile_admin_token = os.getenv("PROFILE_ADMIN_TOKEN")
 
 # Assuming 'client' is your initialized Qdrant client and 'youtube_transcripts' is your data
 # llm = OpenAI(model="gpt-4", temperature=0.0, stop_symbols=["\n"])
@@ -83,7 +146,9 @@ service_context = ServiceContext.from_defaults(
 )
 
 index_manager = IndexManager(qdrant_client, service_context, embed_model=Settings.embed_model,
-                             collection_name=collection_name)
+                             collection_name=collection_name, restore_punctuation=not low_memory,
+                             dedup_threshold=float(os.getenv("CHUNK_DEDUP_THRESHOLD", 0.8)),
+                             qd_aclient=qdrant_aclient)
 index = index_manager.create_or_load_index()
 
 ## testing stuff
@@ -91,13 +156,51 @@ index = index_manager.create_or_load_index()
 # index_manager.retriever(index)
 ## end of testing 
 
+# known commons videos, so link checks are answered locally
+video_catalog = VideoCatalog(state=coordination_state)
+video_catalog.add_links(YouTubeLoader().ytlinks)
+video_catalog.load_spreadsheet()
+
+# RETRIEVAL_DEPTH=adaptive sends as many chunks as their scores justify (none if nothing is relevant) instead of 5
+depth = None
+if os.getenv("RETRIEVAL_DEPTH", "fixed") == "adaptive":
+    depth = AdaptiveDepthPostprocessor(min_score=float(os.getenv("RETRIEVAL_MIN_SCORE", 0.25)),
+                                       relative_cutoff=float(os.getenv("RETRIEVAL_RELATIVE_CUTOFF", 0.2)),
+                                       max_top_k=int(os.getenv("RETRIEVAL_MAX_TOP_K", 10)))
+
+# RETRIEVAL_MODE=two_stage first picks the best videos from one summary vector per video, then searches their chunks
+retrieval_top_k = depth.max_top_k if depth else 5
+retriever = None
+if os.getenv("RETRIEVAL_MODE", "flat") == "two_stage":
+    video_index = VideoSummaryIndex(qdrant_client, collection_name, catalog=video_catalog, aclient=qdrant_aclient)
+    video_index.build(force=index_manager.created)
+    retriever = TwoStageRetriever(index, video_index, similarity_top_k=retrieval_top_k,
+                                  top_videos=int(os.getenv("RETRIEVAL_TOP_VIDEOS", 3)))
+
+# without an async Qdrant client, the async server's awaited searches run in a worker thread
+if qdrant_aclient is None:
+    retriever = ThreadedRetriever(retriever or index.as_retriever(similarity_top_k=retrieval_top_k))
+
+# retrieve the raw question while the agent's first LLM step runs, the transcripts tool reuses it when its input
+# is close to the question (PREFETCH_RETRIEVAL=0 turns it off)
+if os.getenv("PREFETCH_RETRIEVAL", "1") != "0":
+    prefetcher = RetrievalPrefetcher(retriever or index.as_retriever(similarity_top_k=retrieval_top_k),
+                                     min_overlap=float(os.getenv("PREFETCH_MIN_OVERLAP", 0.6)))
+    retriever = prefetcher.retriever
+    slack.use_prefetcher(prefetcher)
+
 query_engine_manager = QueryEngineManager(index)
-query_engine_transcripts = query_engine_manager.create_query_engine()
+query_engine_transcripts = query_engine_manager.create_query_engine(retriever=retriever, depth=depth)
 
 agent_context = query_engine_manager.get_agent_context()
 agent_commands_context = query_engine_manager.get_agent_commands_context()
 
-query_engine_tools_manager = QueryEngineToolsManager(query_engine_transcripts)
+# local, searchable mirror of the community channels used by the slack tool
+mirror_channel_ids = os.getenv("SLACK_MIRROR_CHANNELS", "C0FNVPMNF").split(",")
+message_store = SlackMessageStore(os.getenv("SLACK_MIRROR_PATH", "slack_messages.sqlite3"))
+
+query_engine_tools_manager = QueryEngineToolsManager(query_engine_transcripts, message_store=message_store,
+                                                     channel_ids=mirror_channel_ids, video_catalog=video_catalog)
 query_engine_agent_tools = query_engine_tools_manager.query_engine_agent_tools
 query_engine_agent_commands_tools = query_engine_tools_manager.query_engine_command_tools
 
@@ -105,8 +208,9 @@ query_engine_agent_commands_tools = query_engine_tools_manager.query_engine_comm
 flask_app: Flask = Flask(__name__)
 
 # Initializes your app with your bot token and signing secret
+# SLACK_API_URL overrides the Slack Web API endpoint, e.g. the offline benchmark's stand-in
 slack_app = App(
-    token=os.environ["SLACK_BOT_TOKEN"],
+    client=WebClient(token=os.environ["SLACK_BOT_TOKEN"], base_url=os.getenv("SLACK_API_URL", WebClient.BASE_URL)),
     signing_secret=os.environ["SLACK_SIGNING_SECRET"]
 )
 
@@ -120,12 +224,51 @@ slack_app = App(
 handler = SlackRequestHandler(slack_app)
 
 slack_ops = slack.SlackOperations(slack_app)
+
+# handlers ack right away and hand the LLM work to a bounded pool of workers
+job_queue = JobQueue(max_workers=int(os.getenv("JOB_WORKERS", 2 if low_memory else 4)), max_queue=int(os.getenv("JOB_QUEUE_MAX", 32)))
+# per-user and per-channel limits keep one user or one busy channel from starving everybody else
+scheduler = RequestScheduler(
+    job_queue,
+    user_limiter=KeyedRateLimiter(float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", 4)),
+                                  int(os.getenv("RATE_LIMIT_USER_BURST", 3)), name="user_limits"),
+    channel_limiter=KeyedRateLimiter(float(os.getenv("RATE_LIMIT_CHANNEL_PER_MINUTE", 20)),
+                                     int(os.getenv("RATE_LIMIT_CHANNEL_BURST", 10)), name="channel_limits"))
+
+
+
+def _role_query(role):
+    # construct a query to a llm based on role provide useful references
+    return f"As a {role}, what are the latest insights, recommendations, topics in OpenShift? Tell me why it fits my role."
+
+
+def _recommend_for_role(role):
+    import utils
+
+    response = slack.run_agent(query_engine_agent_commands_tools, agent_commands_context, _role_query(role),
+                               "onboarding")
+    return utils.convert_to_slack_formatting(str(response))
+
+
+# the onboarding answer only depends on the role, compute it ahead of time and refresh it when the index changes
+role_recommendations = RoleRecommendations(
+    slack.roles_and_interests, _recommend_for_role,
+    index_version=lambda: qdrant_client.count(collection_name).count,
+    path=os.getenv("RECOMMENDATIONS_PATH", "recommendations.sqlite3"),
+    refresh_interval=int(os.getenv("RECOMMENDATIONS_REFRESH_SECONDS", 21600)),
+    state=coordination_state)
+
+# identical questions asked at the same time are answered by a single agent run
+single_flight = SingleFlight(state=coordination_state)
+# Slack redelivers events it considers unanswered (possibly to another replica), each event is processed once
+event_deduplicator = EventDeduplicator(state=coordination_state)
+
 message_handler = slack.MessageHandler(slack_ops, query_engine_transcripts, query_engine_agent_commands_tools,
-                                       agent_commands_context)
+                                       agent_commands_context, scheduler=scheduler, single_flight=single_flight)
 
 # Initialize Command Handlers with Slack Operations
 cmd_handler = slack.CommandHandler(slack_ops, query_engine_transcripts, query_engine_agent_commands_tools,
-                                   agent_commands_context)
+                                   agent_commands_context, scheduler=scheduler, single_flight=single_flight)
 
 # Register command handlers
 slack_app.command("/commons")(cmd_handler.handle_commons_command_agent_only)
@@ -139,9 +282,22 @@ bot_user_id = auth_response["user_id"]
 
 @slack_app.message()
 def handle_incoming_messages(message, say):
+    if message.get('channel') in mirror_channel_ids:
+        message_store.add_message(message)
     message_handler.handle_message(message, say, slack_app.client, bot_user_id)
 
 
+@slack_app.event({"type": "message", "subtype": "message_changed"})
+def handle_message_changed(event):
+    if event.get('channel') in mirror_channel_ids:
+        message_store.update_message(event)
+
+
+@slack_app.event({"type": "message", "subtype": "message_deleted"})
+def handle_message_deleted(event):
+    message_store.delete_message(event)
+
+
 # Event, command, and action handlers
 @slack_app.event("team_join")
 def handle_member_joined_channel(event, client):
@@ -232,46 +388,83 @@ def _construct_response_text(user_id, role, suggested_channels_text):
             f"{help_message}")
 
 
+def _process_role_selection(role, user_id, channel_id, thread_ts, suggested_channels_text):
+    recommendations = role_recommendations.get(role)
+    if recommendations is None:
+        # not precomputed yet (e.g. right after the first start), fall back to a live agent run
+        slack_ops.post_ephemeral_message(channel_id, user_id,
+                                         "Customizing information for you. Please wait a moment... :mag_right:")
+        try:
+            recommendations = _recommend_for_role(role)
+            role_recommendations.set(role, recommendations)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+
+    if recommendations:
+        slack_ops.post_ephemeral_message(channel_id, user_id, recommendations, thread_ts=thread_ts)
+
+    _post_good_to_go(channel_id, user_id, thread_ts, suggested_channels_text)
+
+
+def _good_to_go_text(suggested_channels_text):
+    return f"You are good to go! If you have any questions or need further assistance, feel free to ask here: \n {suggested_channels_text}\n Also make sure to check https://commons.openshift.org/ for more information. Have fun :tada:!"
+
+
+def _post_good_to_go(channel_id, user_id, thread_ts, suggested_channels_text):
+    slack_ops.post_ephemeral_message(channel_id, user_id, _good_to_go_text(suggested_channels_text),
+                                     thread_ts=thread_ts)
+
+
 @flask_app.route("/slack/interactive", methods=["POST"])
 def slack_interactive():
     print("Interactive")
 
-    import utils
     payload = json.loads(request.form["payload"])
     role, user_id, channel_id, thread_ts = _parse_payload(payload)
     suggested_channels_text = _get_suggested_channels(role)
     response_text = _construct_response_text(user_id, role, suggested_channels_text)
 
-    # Assuming slack_ops is an instance of a class that handles Slack operations
-    slack_ops.post_ephemeral_message(channel_id, user_id, response_text)
+    def process():
+        # Assuming slack_ops is an instance of a class that handles Slack operations
+        slack_ops.post_ephemeral_message(channel_id, user_id, response_text)
+        _process_role_selection(role, user_id, channel_id, thread_ts, suggested_channels_text)
 
-    slack_ops.post_ephemeral_message(channel_id, user_id,
-                                     "Customizing information for you. Please wait a moment... :mag_right:")
+    def on_busy(_message):
+        # skip the personalized agent answer, the channel suggestions don't need the LLM
+        slack_ops.post_ephemeral_message(channel_id, user_id, response_text)
+        _post_good_to_go(channel_id, user_id, thread_ts, suggested_channels_text)
 
-    # construct a query to a llm based on role provide useful references
-    query = f"As a {role}, what are the latest insights, recommendations, topics in OpenShift? Tell me why it fits my role."
+    # answer Slack right away, recommendations are delivered by the job queue
+    slack.submit_job(scheduler, "onboarding", process, priority=PRIORITY_ONBOARDING, user=user_id,
+                     on_busy=on_busy)
+    return jsonify({})
 
-    try:
-        response = ReActAgent.from_tools(
-            query_engine_agent_commands_tools,
-            llm=Settings.llm,
-            verbose=True,
-            context=agent_commands_context).chat(query)
-        formatted_transcripts_response = utils.convert_to_slack_formatting(str(response))
 
-        slack_ops.post_ephemeral_message(channel_id, user_id, formatted_transcripts_response, thread_ts)
+@flask_app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(registry.render_prometheus(), mimetype="text/plain; version=0.0.4")
 
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        slack_ops.post_ephemeral_message(channel_id, user_id,
-                                         "You are good to go! If you have any questions or need further assistance, feel free to ask here: \n {suggested_channels_text}\n Also make sure to check https://commons.openshift.org/ for more information. Have fun :tada:!",
-                                         thread_ts)
 
-    slack_ops.post_ephemeral_message(channel_id, user_id,
-                                     f"You are good to go! If you have any questions or need further assistance, feel free to ask here: \n {suggested_channels_text}\n Also make sure to check https://commons.openshift.org/ for more information. Have fun :tada:!",
-                                     thread_ts)
+def _check_profile_admin():
+    # the reports show code paths and memory contents, only serve them with PROFILE_ADMIN_TOKEN set and presented
+    expected = f"Bearer {profile_admin_token}"
+    if not profile_admin_token or not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        abort(404)
 
-    return jsonify({})
+
+@flask_app.route("/debug/profiles", methods=["GET"])
+def profiles():
+    _check_profile_admin()
+    return jsonify({"pid": os.getpid(), "rss_bytes": rss_bytes(), "files": profiler.files()})
+
+
+@flask_app.route("/debug/profiles/<name>", methods=["GET"])
+def profile_file(name):
+    _check_profile_admin()
+    path = profiler.file_path(name)
+    if path is None:
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype="application/octet-stream", as_attachment=True)
 
 
 @flask_app.route("/slack/commands", methods=["POST"])
@@ -288,9 +481,33 @@ def slack_events():
             "challenge": data.get("challenge")
         })
 
+    if data and event_deduplicator.seen(data.get("event_id")):
+        print(f"Skipping redelivered event {data.get('event_id')} (retry {request.headers.get('X-Slack-Retry-Num')})")
+        return "", 200
+
     return handler.handle(request)
 
 
+def start_background_services(job_workers=True):
+    """Starts the per-process background threads; under gunicorn this runs in each worker after the fork.
+
+    The async server (aio_server.py) answers on its event loop and skips the job worker threads.
+    """
+    # keep the news feeds warm in the background so the feed tool answers from memory
+    query_engine_tools_manager.feed_cache.start()
+    video_catalog.start()
+    # catch up on history missed while the bot was down, new messages arrive through the event stream
+    message_store.start_backfill(slack_app.client, mirror_channel_ids)
+    if job_workers:
+        scheduler.start()
+    role_recommendations.start()
+    profiler.start()
+
+
+# gunicorn.conf.py defers this to its post_fork hook, threads don't survive the fork of a preloaded app
+if not os.getenv("COMMONS_BOT_PRELOAD"):
+    start_background_services()
+
 if __name__ == "__main__":
     port = os.getenv("PORT", 10000)
     flask_app.run(host='0.0.0.0', debug=True, port=port)
@@ -1,120 +1,256 @@
+"""Evaluates retrieval quality and latency over a sweep of chunk sizes.
+
+    python eval.py --chunk-sizes 128,256,512,1024,2048 --questions 40 --concurrency 8
+
+Transcripts, generated questions, embeddings and judge verdicts are cached under `--cache-dir`, so only the first
+run pays for them: every chunk size is indexed into its own Qdrant collection from the same cached transcripts, and
+the questions are generated once and reused for all chunk sizes.
+"""
+import argparse
+import hashlib
+import json
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
 
 from llama_index.llms.openai import OpenAI
-from llama_index.core import ServiceContext 
-from llama_index.core.evaluation import FaithfulnessEvaluator, RelevancyEvaluator,  DatasetGenerator
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.core import Document, ServiceContext
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.evaluation import FaithfulnessEvaluator, RelevancyEvaluator, DatasetGenerator
 
-from index import IndexManager
+from llm_cache import CompletionCache
 from loaders import YouTubeLoader, QdrantClientManager, EnvironmentConfig
-from query_engine import QueryEngineManager, QueryEngineToolsManager
+from query_engine import QueryEngineManager
+from retrieval import AdaptiveDepthPostprocessor
 
-class ResponseEvaluator:
-    def __init__(self, service_context):
-        """
-        Initializes the evaluator with configured llm (e.g., GPT-4) based Faithfulness and Relevancy evaluators.
 
-        Args:
-            service_context (ServiceContext): The service context configured for llm (e.g.,GPT-4).
-        """
-        self.faithfulness_evaluator = FaithfulnessEvaluator(service_context=service_context)
-        self.relevancy_evaluator = RelevancyEvaluator(service_context=service_context)
-        self.service_context = service_context
+def _hash(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
-    def evaluate(self, eval_questions):
-        """
-        Evaluates the performance of the system by calculating three key metrics: 
-        average response time, faithfulness, and relevancy.
 
-        Average Response Time:
-        This metric measures the average time it takes for the system to respond to a given input or request. 
-        It is calculated by summing the response times for all requests and dividing by the total number of requests. 
-        A lower average response time generally indicates better performance.
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
 
-        Faithfulness:
-        This metric assesses the accuracy or correctness of the system's output or response. 
-        It is calculated based on the proportion of responses that meet a certain accuracy threshold. 
-        A high faithfulness score indicates that the system is producing accurate and reliable outputs.
 
-        Relevancy:
-        This metric evaluates the degree to which the system's output or response is relevant to the given input or context. 
-        It is calculated based on the proportion of responses that meet a certain relevancy threshold. 
-        A high relevancy score indicates that the system is producing relevant and valuable outputs.
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper that stores every vector in a `CompletionCache`, so re-indexing the same chunks (or
+    embedding the same questions for another chunk size) costs nothing."""
 
-        Args:
-            chunk_size (int): The size of data chunks being processed.
-            eval_questions (list): A list of questions to evaluate.
-            eval_documents (list): A list of documents to build the vector index from.
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: CompletionCache = PrivateAttr()
 
-        Returns:
-            tuple: A tuple containing the average response time, faithfulness, and relevancy metrics.
-        """
-        total_response_time = 0
-        total_faithfulness = 0
-        total_relevancy = 0
+    def __init__(self, embed_model: BaseEmbedding, cache: CompletionCache, **kwargs: Any):
+        super().__init__(model_name=embed_model.model_name, embed_batch_size=embed_model.embed_batch_size, **kwargs)
+        self._embed_model = embed_model
+        self._cache = cache
 
-        config = EnvironmentConfig()
-        qdrant_manager = QdrantClientManager(config, collection_name="commons")
-        qdrant_client = qdrant_manager.client
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
 
+    def _key(self, kind, text):
+        return _hash(self.model_name, kind, text)
 
-        index_manager = IndexManager(qdrant_client, self.service_context)
-        index = index_manager.create_or_load_index()
+    def _get_query_embedding(self, query: str) -> List[float]:
+        key = self._key("query", query)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        embedding = self._embed_model.get_query_embedding(query)
+        self._cache.set(key, json.dumps(embedding))
+        return embedding
 
-        query_engine_manager = QueryEngineManager(index)
-        
-        # we can change these parameters to optimize response time, faithfulness, and relevancy
-        query_engine = query_engine_manager.create_query_engine(similarity_top_k=2, streaming=False)
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("text", text) for text in texts]
+        embeddings = [self._cache.get(key) for key in keys]
+        embeddings = [json.loads(e) if e is not None else None for e in embeddings]
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self._embed_model.get_text_embedding_batch([texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                self._cache.set(keys[i], json.dumps(embedding))
+        return embeddings
+
+
+def load_transcripts(cache_dir):
+    """Returns the punctuated transcripts, downloading them only if they are not cached yet."""
+    path = os.path.join(cache_dir, "transcripts.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return [Document(text=d["text"], id_=d["id"], metadata=d["metadata"]) for d in json.load(f)]
+
+    documents = YouTubeLoader().yttranscripts
+    with open(path, "w") as f:
+        json.dump([{"id": d.id_, "text": d.text, "metadata": d.metadata} for d in documents], f)
+    return documents
 
-        agentContext = query_engine_manager.get_agent_context()
-        query_engine_tools_manager = QueryEngineToolsManager(query_engine)
-        query_engine_tools = query_engine_tools_manager.query_engine_agent_tools
 
+def load_questions(cache_dir, documents, service_context, num):
+    """Generates `num` evaluation questions once per transcript set and reuses them afterwards."""
+    path = os.path.join(cache_dir, f"questions-{_hash([d.id_ for d in documents], num)[:12]}.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
 
-        num_questions = len(eval_questions)
+    data_generator = DatasetGenerator.from_documents(documents=documents, service_context=service_context)
+    questions = data_generator.generate_questions_from_nodes(num=num)
+    with open(path, "w") as f:
+        json.dump(questions, f)
+    return questions
 
-        for question in eval_questions:
-            start_time = time.time()
-            response_vector = query_engine.query(question)
-            elapsed_time = time.time() - start_time
 
-            faithfulness_result = self.faithfulness_evaluator.evaluate_response(response=response_vector).passing
-            relevancy_result = self.relevancy_evaluator.evaluate_response(query=question, response=response_vector).passing
+def build_index(qdrant_client, documents, chunk_size, service_context):
+    """Indexes `documents` split at `chunk_size` into their own collection, reusing it if it is already filled."""
+    from llama_index.core.indices.vector_store import VectorStoreIndex
+    from llama_index.core.node_parser import SentenceSplitter
+    from llama_index.core.storage import StorageContext
+    from llama_index.vector_stores.qdrant import QdrantVectorStore
 
-            total_response_time += elapsed_time
-            total_faithfulness += faithfulness_result
-            total_relevancy += relevancy_result
+    collection_name = f"commons-eval-{chunk_size}"
+    try:
+        exists = qdrant_client.count(collection_name).count > 0
+    except Exception:
+        exists = False
 
-        average_response_time = total_response_time / num_questions
-        average_faithfulness = total_faithfulness / num_questions
-        average_relevancy = total_relevancy / num_questions
+    vector_store = QdrantVectorStore(collection_name=collection_name, client=qdrant_client)
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    if exists:
+        return VectorStoreIndex.from_vector_store(vector_store, service_context=service_context)
 
-        return average_response_time, average_faithfulness, average_relevancy
+    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=min(20, chunk_size // 10))
+    nodes = splitter.get_nodes_from_documents(documents)
+    print(f"Indexing {len(nodes)} chunks of size {chunk_size} into {collection_name}")
+    return VectorStoreIndex(nodes, storage_context=storage_context, service_context=service_context,
+                            show_progress=True)
 
 
-import random
+class ResponseEvaluator:
+    def __init__(self, service_context, verdict_cache: CompletionCache, concurrency=8):
+        """
+        Initializes the evaluator with configured llm (e.g., GPT-4) based Faithfulness and Relevancy evaluators.
+
+        Args:
+            service_context (ServiceContext): The service context configured for llm (e.g.,GPT-4).
+            verdict_cache (CompletionCache): Where judge verdicts are kept between runs.
+            concurrency (int): How many questions are answered and judged at the same time.
+        """
+        self.faithfulness_evaluator = FaithfulnessEvaluator(service_context=service_context)
+        self.relevancy_evaluator = RelevancyEvaluator(service_context=service_context)
+        self.service_context = service_context
+        self.verdict_cache = verdict_cache
+        self.concurrency = concurrency
+
+    def _judge(self, name, evaluator, question, response):
+        contexts = [node.get_content() for node in response.source_nodes]
+        key = _hash(name, question, str(response), contexts)
+        cached = self.verdict_cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        if name == "faithfulness":
+            result = evaluator.evaluate_response(response=response)
+        else:
+            result = evaluator.evaluate_response(query=question, response=response)
+        verdict = bool(result.passing)
+        self.verdict_cache.set(key, json.dumps(verdict))
+        return verdict
+
+    def _evaluate_question(self, query_engine, question):
+        start_time = time.perf_counter()
+        response = query_engine.query(question)
+        elapsed_time = time.perf_counter() - start_time
+
+        faithful = self._judge("faithfulness", self.faithfulness_evaluator, question, response)
+        relevant = self._judge("relevancy", self.relevancy_evaluator, question, response)
+        return elapsed_time, faithful, relevant
+
+    def evaluate(self, query_engine, eval_questions):
+        """
+        Answers and judges the questions concurrently and returns latency percentiles (p50/p95/p99, mean),
+        faithfulness (share of answers supported by the retrieved context) and relevancy (share of answers that
+        address the question).
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(lambda q: self._evaluate_question(query_engine, q), eval_questions))
+
+        latencies = [latency for latency, _, _ in results]
+        num_questions = len(results)
+        return {
+            "questions": num_questions,
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "p99_s": percentile(latencies, 99),
+            "mean_s": sum(latencies) / num_questions if num_questions else 0.0,
+            "faithfulness": sum(f for _, f, _ in results) / num_questions if num_questions else 0.0,
+            "relevancy": sum(r for _, _, r in results) / num_questions if num_questions else 0.0,
+        }
+
 
-def generate_questions_from_nodes(nodes, num=40):
-    random.shuffle(nodes)  # Shuffle the list of nodes
-    # Rest of the function implementation goes here
-                
 def main():
-    llm = OpenAI(model="gpt-4", temperature=0.0, stop_symbols=["\n"])
-    chunk_sizes = [128, 256, 512, 1024, 2048]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-sizes", default="128,256,512,1024,2048")
+    parser.add_argument("--questions", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--adaptive-depth", action="store_true",
+                        help="pick the number of chunks from their scores (up to 10) instead of --top-k")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--cache-dir", default="eval_cache")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
 
-    for chunk_size in chunk_sizes:
-        service_context = ServiceContext.from_defaults(llm=llm)
+    os.makedirs(args.cache_dir, exist_ok=True)
+    llm = OpenAI(model=args.model, temperature=0.0, stop_symbols=["\n"])
+    embed_model = CachedEmbedding(OpenAIEmbedding(model="text-embedding-3-small"),
+                                  CompletionCache(os.path.join(args.cache_dir, "embeddings.sqlite3"),
+                                                  max_bytes=1024 * 1024 * 1024))
+    service_context = ServiceContext.from_defaults(llm=llm, embed_model=embed_model)
+    evaluator = ResponseEvaluator(service_context,
+                                  CompletionCache(os.path.join(args.cache_dir, "verdicts.sqlite3")),
+                                  concurrency=args.concurrency)
 
-        # generate questions from nodes
-        evaluator = ResponseEvaluator(service_context=service_context)
-        eval_documents = YouTubeLoader().yttranscripts
-        data_generator = DatasetGenerator.from_documents(documents=eval_documents)
-        eval_questions = data_generator.generate_questions_from_nodes(num = 40)
-        print(f"Eval questions: {eval_questions}")
+    qdrant_client = QdrantClientManager(EnvironmentConfig(), collection_name="commons").client
+    eval_documents = load_transcripts(args.cache_dir)
+    eval_questions = load_questions(args.cache_dir, eval_documents, service_context, args.questions)
+    print(f"Evaluating {len(eval_questions)} questions over {len(eval_documents)} transcripts")
+
+    results = {}
+    for chunk_size in (int(size) for size in args.chunk_sizes.split(",")):
+        index = build_index(qdrant_client, eval_documents, chunk_size, service_context)
+        # we can change these parameters to optimize response time, faithfulness, and relevancy
+        query_engine = QueryEngineManager(index).create_query_engine(
+            similarity_top_k=args.top_k, streaming=False,
+            depth=AdaptiveDepthPostprocessor() if args.adaptive_depth else None)
+        results[chunk_size] = result = evaluator.evaluate(query_engine, eval_questions)
+        print(f"Chunk size {chunk_size} - Response time p50 {result['p50_s']:.2f}s, p95 {result['p95_s']:.2f}s, "
+              f"p99 {result['p99_s']:.2f}s, Average Faithfulness: {result['faithfulness']:.2f}, "
+              f"Average Relevancy: {result['relevancy']:.2f}")
 
-        avg_response_time, avg_faithfulness, avg_relevancy = evaluator.evaluate(eval_questions)
-        print(f"Chunk size {chunk_size} - Average Response time: {avg_response_time:.2f}s, Average Faithfulness: {avg_faithfulness:.2f}, Average Relevancy: {avg_relevancy:.2f}")
+    print("\n| Chunk Size | p50 (s) | p95 (s) | p99 (s) | Average Faithfulness | Average Relevancy |")
+    print("|------------|---------|---------|---------|----------------------|-------------------|")
+    for chunk_size, r in results.items():
+        print(f"| {chunk_size:<10} | {r['p50_s']:<7.2f} | {r['p95_s']:<7.2f} | {r['p99_s']:<7.2f} "
+              f"| {r['faithfulness']:<20.2f} | {r['relevancy']:<17.2f} |")
 
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+def rank_news(formatted_news_list, max_items=10, max_red_hat=4):
+    """Puts up to `max_red_hat` Red Hat/OpenShift items first and fills up with the rest."""
+    red_hat_openshift_news = [news for news in formatted_news_list if
+                              "red hat" in news.lower() or "openshift" in news.lower()]
+
+    other_news = [news for news in formatted_news_list if news not in red_hat_openshift_news]
+    return (red_hat_openshift_news[:max_red_hat] + other_news)[:max_items]
+
+
+class FeedCache:
+    """Keeps a parsed, pre-ranked news list in memory and refreshes it in the background.
+
+    Feeds are fetched in parallel with conditional GETs (ETag/Last-Modified), so unchanged feeds cost a 304.
+    """
+
+    def __init__(self, feed_urls, refresh_interval=900, max_workers=4):
+        self.feed_urls = feed_urls
+        self.refresh_interval = refresh_interval
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._validators = {}  # url -> (etag, modified)
+        self._entries = {}  # url -> formatted items
+        self._news = []
+        self._fetched_at = {}  # url -> time of its last successful (or not modified) fetch
+        self._updated_at = None
+        self._refreshed = False
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def _fetch(self, url):
+        import feedparser
+
+        etag, modified = self._validators.get(url, (None, None))
+        feed = feedparser.parse(url, etag=etag, modified=modified)
+        status = getattr(feed, "status", None)
+        if status == 304:
+            registry.inc("feed_fetches", status="not_modified")
+            return url, None
+        if feed.bozo and not feed.entries:
+            raise feed.bozo_exception
+
+        registry.inc("feed_fetches", status="fetched")
+        self._validators[url] = (feed.get("etag"), feed.get("modified"))
+
+        formatted_news_list = []
+        for entry in feed.entries:
+            formatted_item = f"Title: {entry.get('title')}\n" \
+                             f"Link: {entry.get('link')}\n" \
+                             f"Published: {entry.get('published')}\n"
+            formatted_news_list.append(formatted_item)
+        return url, formatted_news_list
+
+    def refresh(self):
+        """Fetches all feeds in parallel and rebuilds the ranked news list."""
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._fetch, url) for url in self.feed_urls]
+
+        entries = dict(self._entries)
+        fetched_at = dict(self._fetched_at)
+        for url, future in zip(self.feed_urls, futures):
+            try:
+                _, items = future.result()
+                if items is not None:
+                    entries[url] = items
+                fetched_at[url] = time.time()
+            except Exception as e:
+                registry.inc("feed_fetches", status="error")
+                logging.error(f"Error parsing RSS URL '{url}': {e}")
+
+        # keep the configured feed order so ranking stays stable between refreshes
+        news = rank_news([item for url in self.feed_urls for item in entries.get(url, [])])
+        with self._lock:
+            self._entries = entries
+            self._news = news
+            self._fetched_at = fetched_at
+            # the news is as old as its stalest feed, failed fetches don't make it any fresher
+            self._updated_at = min((fetched_at[url] for url in self.feed_urls if url in fetched_at), default=None)
+            self._refreshed = True
+
+        log.info(f"Refreshed {len(self.feed_urls)} feeds in {time.monotonic() - start:.2f}s")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"Feed refresh failed: {e}")
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        """Starts the background refresher (again, if this process was forked after it started)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="feed-cache", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def age(self):
+        """Seconds since the stalest feed was last fetched, or None if no feed was ever fetched."""
+        if self._updated_at is None:
+            return None
+        return time.time() - self._updated_at
+
+    def get_news(self):
+        """Returns the ranked news list and its age in seconds, fetching synchronously on first use."""
+        self.start()
+        if not self._refreshed:
+            self.refresh()
+
+        with self._lock:
+            news = list(self._news)
+        age = self.age
+        registry.set_gauge("feed_cache_age_seconds", age)
+        return news, age
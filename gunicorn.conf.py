@@ -0,0 +1,24 @@
+# Production serving mode: `gunicorn -c gunicorn.conf.py wsgi:app`
+#
+# The app (index, tools, prompts) is loaded once in the master before forking, so workers share it
+# copy-on-write. Background threads are started per worker in post_fork, they don't survive the fork.
+import os
+
+# tells commons-bot.py not to start its background threads in the master
+os.environ["COMMONS_BOT_PRELOAD"] = "1"
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+preload_app = True
+workers = int(os.getenv("WEB_WORKERS", 2))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 8))
+timeout = int(os.getenv("WEB_TIMEOUT", 60))
+keepalive = 5
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    import wsgi
+
+    wsgi.start_background_services()
+    server.log.info(f"Worker {worker.pid} started background services")
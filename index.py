@@ -6,15 +6,24 @@ logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(name)s - %(leveln
 log = logging.getLogger(__name__)
 
 class IndexManager:
-    # __slots__ = ['qd_client', 'collection', 'service_context']
+    __slots__ = ['qd_client', 'qd_aclient', 'collection_name', 'service_context', 'embed_model', 'documents',
+                 'restore_punctuation', 'created', 'dedup_threshold']
 
     # @profile
-    def __init__(self, qd_client, service_context, embed_model, collection_name="commons"):
+    def __init__(self, qd_client, service_context, embed_model, collection_name="commons", restore_punctuation=True,
+                 dedup_threshold=0.8, qd_aclient=None):
         self.qd_client = qd_client
+        # AsyncQdrantClient for the vector store's aquery (the async server), optional
+        self.qd_aclient = qd_aclient
         self.collection_name = collection_name
         self.service_context = service_context
         self.embed_model = embed_model
         self.documents = None
+        self.restore_punctuation = restore_punctuation
+        # whether the last create_or_load_index ingested the transcripts into a new collection
+        self.created = False
+        # chunks at least this similar to an earlier one are not embedded, 0 keeps them all
+        self.dedup_threshold = dedup_threshold
 
     def _check_collection_exists(self):
         try:
@@ -43,13 +52,14 @@ class IndexManager:
         
         collection_exists = self._check_collection_exists()
 
-        vector_store = QdrantVectorStore(collection_name=self.collection_name, client=self.qd_client, service_context=self.service_context)
+        vector_store = QdrantVectorStore(collection_name=self.collection_name, client=self.qd_client,
+                                         aclient=self.qd_aclient, service_context=self.service_context)
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
         if not collection_exists:
             from loaders import YouTubeLoader
 
-            youtube_loader = YouTubeLoader()
+            youtube_loader = YouTubeLoader(restore_punctuation=self.restore_punctuation)
             youtube_transcripts = youtube_loader.yttranscripts
             
             # define splitter. Optimize params (chunk size and overlap for pure text splitters, otherwise special
@@ -60,12 +70,26 @@ class IndexManager:
             # base_nodes = node_parser.get_nodes_from_documents(documents=youtube_transcripts, show_progress=True)
 
             print("Collection does not exist, creating new index from documents")
-            return VectorStoreIndex.from_documents(documents=youtube_transcripts, storage_context=storage_context, service_context=self.service_context, show_progress=True)
+            self.created = True
+            return VectorStoreIndex.from_documents(documents=youtube_transcripts, storage_context=storage_context, service_context=self.service_context, show_progress=True,
+                                                   transformations=self._transformations())
 
         else:
             print("Collection exists, loading index from storage")
             return VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context, service_context=self.service_context)
 
+    def _transformations(self):
+        from llama_index.core import Settings
+        from llama_index.core.settings import transformations_from_settings_or_context
+
+        transformations = list(transformations_from_settings_or_context(Settings, self.service_context))
+        if self.dedup_threshold:
+            from chunk_dedup import NearDuplicateFilter
+
+            # after the splitter, before the chunks are embedded
+            transformations.append(NearDuplicateFilter(threshold=self.dedup_threshold))
+        return transformations
+
     def retriever(self, index):
         # find top 2 nodes
         base_retriever = index.as_retriever(similarity_top_k=5)
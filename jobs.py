@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+class Job:
+    __slots__ = ['name', 'func', 'args', 'kwargs', 'priority', 'enqueued_at']
+
+    def __init__(self, name, func, args, kwargs, priority=0):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class JobQueue:
+    """Bounded worker pool for the slow part of Slack requests (agent runs, queries).
+
+    Handlers ack Slack right away and `submit` the work; when `max_queue` jobs are already waiting, `submit`
+    refuses the job so the caller can reply that the bot is busy.
+
+    Waiting jobs are taken lowest `priority` first. Within a priority, jobs are taken round-robin across their
+    `fair_key` (e.g. the user), so one user with many queued questions does not hold up everybody else.
+    """
+
+    def __init__(self, max_workers=4, max_queue=32):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pending = {}  # priority -> OrderedDict(fair_key -> deque of jobs)
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._pid = None
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def start(self):
+        """Starts the worker threads (again, if this process was forked after they started)."""
+        with self._lock:
+            if self._pid == os.getpid() and all(worker.is_alive() for worker in self._workers):
+                return
+            self._pid = os.getpid()
+            self._workers = [
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                for i in range(self.max_workers)
+            ]
+            for worker in self._workers:
+                worker.start()
+
+    def submit(self, name, func, *args, priority=0, fair_key=None, **kwargs):
+        """Queues `func(*args, **kwargs)`; returns False if the queue is full."""
+        self.start()
+        with self._cond:
+            if self._depth >= self.max_queue:
+                registry.inc("jobs_rejected", job=name)
+                log.warning(f"Job queue full ({self.max_queue}), rejecting {name}")
+                return False
+
+            queues = self._pending.setdefault(priority, OrderedDict())
+            queues.setdefault(fair_key, deque()).append(Job(name, func, args, kwargs, priority))
+            self._depth += 1
+            self._update_depth(priority)
+            self._wake()
+
+        registry.inc("jobs_submitted", job=name)
+        return True
+
+    def _wake(self):
+        self._cond.notify()
+
+    def _update_depth(self, priority):
+        registry.set_gauge("jobs_queue_depth", self._depth)
+        registry.set_gauge("jobs_queue_depth", sum(len(jobs) for jobs in self._pending[priority].values()),
+                           priority=priority)
+
+    def _pop(self):
+        priority = min(p for p, queues in self._pending.items() if queues)
+        queues = self._pending[priority]
+        fair_key, jobs = next(iter(queues.items()))
+        job = jobs.popleft()
+        # the key goes to the back of the line, its next job waits for every other key's turn
+        del queues[fair_key]
+        if jobs:
+            queues[fair_key] = jobs
+        self._depth -= 1
+        self._update_depth(priority)
+        return job
+
+    def _take(self):
+        with self._cond:
+            while not self._depth:
+                self._cond.wait()
+            return self._pop()
+
+    @contextmanager
+    def _running(self, job):
+        """Records the wait and run time of `job`; a failing job is logged, it never stops the worker."""
+        started_at = time.monotonic()
+        wait = started_at - job.enqueued_at
+        registry.observe("jobs_wait_seconds", wait, job=job.name)
+        registry.observe("jobs_wait_seconds_by_priority", wait, priority=job.priority)
+        try:
+            yield
+            registry.inc("jobs_completed", job=job.name)
+        except Exception as e:
+            registry.inc("jobs_failed", job=job.name)
+            log.exception(f"Job {job.name} failed: {e}")
+        finally:
+            duration = time.monotonic() - started_at
+            registry.observe("jobs_run_seconds", duration, job=job.name)
+            log.info(f"Job {job.name} waited {wait:.2f}s and ran {duration:.2f}s")
+
+    def _work(self):
+        while True:
+            job = self._take()
+            with self._running(job):
+                job.func(*job.args, **job.kwargs)
+
+
+class AsyncJobQueue(JobQueue):
+    """`JobQueue` for coroutine functions, run as tasks on the event loop instead of worker threads.
+
+    `max_workers` bounds the questions answered at once. A job waiting on the LLM, Qdrant or Slack holds no OS thread,
+    so it can be set far higher than the thread pool's. Priorities, fairness and `max_queue` work the same; `start`
+    and `submit` must be called on the loop.
+    """
+
+    def __init__(self, max_workers=64, max_queue=256):
+        super().__init__(max_workers=max_workers, max_queue=max_queue)
+        self._loop = None
+        self._ready = None
+
+    def start(self):
+        """Starts the worker tasks on the running loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self._workers = [loop.create_task(self._awork(), name=f"job-worker-{i}") for i in range(self.max_workers)]
+
+    def _wake(self):
+        self._ready.set()
+
+    async def _awork(self):
+        while True:
+            while not self._depth:
+                self._ready.clear()
+                await self._ready.wait()
+            job = self._pop()
+            with self._running(job):
+                await job.func(*job.args, **job.kwargs)
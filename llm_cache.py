@@ -0,0 +1,355 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Sequence
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.llm import LLM
+
+from metrics import registry
+from retry import BAD_OUTPUT, current_retry_reason
+
+log = logging.getLogger(__name__)
+
+
+class CompletionCache:
+    """Persistent exact-match cache for LLM completions backed by SQLite.
+
+    Entries are evicted least-recently-used first once the stored payloads exceed `max_bytes`.
+    """
+
+    def __init__(self, path="llm_cache.sqlite3", max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._db()
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self):
+        # sqlite connections must not be shared with forked (gunicorn) workers, reopen once per process
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def make_key(model, temperature, stop, payload):
+        """Hashes everything that can change the completion for a prompt."""
+        raw = json.dumps([model, temperature, stop, payload], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key) -> Optional[str]:
+        if current_retry_reason() == BAD_OUTPUT:
+            # a retry after unparsable output must not replay the same cached completions
+            registry.inc("llm_cache_requests", result="bypass")
+            return None
+
+        conn = self._db()
+        with self._lock:
+            row = conn.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                registry.inc("llm_cache_requests", result="miss")
+                return None
+
+            conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            registry.inc("llm_cache_requests", result="hit")
+            return row[0]
+
+    def set(self, key, value: str):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        conn = self._db()
+        with self._lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            registry.set_gauge("llm_cache_bytes", total)
+            return
+
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+
+        registry.inc("llm_cache_evictions", evicted)
+        registry.set_gauge("llm_cache_bytes", total)
+
+    def stats(self):
+        conn = self._db()
+        with self._lock:
+            entries, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": total,
+        }
+
+    def clear(self):
+        conn = self._db()
+        with self._lock:
+            conn.execute("DELETE FROM completions")
+            conn.commit()
+
+
+class SharedCompletionCache:
+    """Completion cache shared by all replicas through a `SharedState`, in front of an optional local cache.
+
+    Lookups try the local (SQLite) cache first and fall back to the shared one, so an answer computed on one replica
+    is reused by the others.
+    """
+
+    make_key = staticmethod(CompletionCache.make_key)
+
+    def __init__(self, state, local: Optional[CompletionCache] = None, ttl=7 * 24 * 3600):
+        self.state = state
+        self.local = local
+        self.ttl = ttl
+
+    def get(self, key) -> Optional[str]:
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+        if current_retry_reason() == BAD_OUTPUT:
+            # same as the local cache, a retry after unparsable output must get a fresh completion
+            return None
+        try:
+            value = self.state.get(f"llm:{key}")
+        except Exception as e:
+            log.warning(f"Shared completion cache lookup failed: {e}")
+            return None
+        registry.inc("llm_shared_cache_requests", result="miss" if value is None else "hit")
+        if value is not None and self.local is not None:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value: str):
+        if self.local is not None:
+            self.local.set(key, value)
+        try:
+            self.state.set(f"llm:{key}", value, ttl=self.ttl)
+        except Exception as e:
+            log.warning(f"Shared completion cache update failed: {e}")
+
+
+def _serialize_chat(response: ChatResponse) -> Optional[str]:
+    # function calling responses carry provider objects we can't replay faithfully
+    if response.message.additional_kwargs.get("tool_calls"):
+        return None
+    return json.dumps({"role": response.message.role.value, "content": response.message.content})
+
+
+def _deserialize_chat(value: str) -> ChatResponse:
+    data = json.loads(value)
+    message = ChatMessage(role=MessageRole(data["role"]), content=data["content"])
+    return ChatResponse(message=message, delta=data["content"])
+
+
+class CachedLLM(LLM):
+    """Wraps any llama_index LLM and answers repeated identical prompts from a `CompletionCache`."""
+
+    _llm: LLM = PrivateAttr()
+    _cache: CompletionCache = PrivateAttr()
+
+    def __init__(self, llm: LLM, cache: CompletionCache, **kwargs: Any) -> None:
+        super().__init__(
+            callback_manager=llm.callback_manager,
+            system_prompt=llm.system_prompt,
+            messages_to_prompt=llm.messages_to_prompt,
+            completion_to_prompt=llm.completion_to_prompt,
+            pydantic_program_mode=llm.pydantic_program_mode,
+            **kwargs,
+        )
+        self._llm = llm
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedLLM"
+
+    @property
+    def llm(self) -> LLM:
+        return self._llm
+
+    @property
+    def cache(self) -> CompletionCache:
+        return self._cache
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._llm.metadata
+
+    def _key(self, kind, payload, kwargs):
+        stop = getattr(self._llm, "stop_symbols", None) or getattr(self._llm, "additional_kwargs", {}).get("stop")
+        return self._cache.make_key(
+            self.metadata.model_name,
+            getattr(self._llm, "temperature", None),
+            stop,
+            {"kind": kind, "payload": payload, "kwargs": kwargs},
+        )
+
+    def _chat_key(self, messages: Sequence[ChatMessage], kwargs):
+        return self._key("chat", [(m.role.value, m.content, m.additional_kwargs) for m in messages], kwargs)
+
+    def _complete_key(self, prompt: str, formatted: bool, kwargs):
+        return self._key("complete", [prompt, formatted], kwargs)
+
+    def _store_chat(self, key, response: ChatResponse):
+        value = _serialize_chat(response)
+        if value is not None:
+            self._cache.set(key, value)
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        key = self._chat_key(messages, kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return _deserialize_chat(cached)
+
+        response = self._llm.chat(messages, **kwargs)
+        self._store_chat(key, response)
+        return response
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        key = self._complete_key(prompt, formatted, kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return CompletionResponse(text=cached, delta=cached)
+
+        response = self._llm.complete(prompt, formatted=formatted, **kwargs)
+        self._cache.set(key, response.text)
+        return response
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        key = self._chat_key(messages, kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return iter([_deserialize_chat(cached)])
+
+        def gen() -> ChatResponseGen:
+            last = None
+            for last in self._llm.stream_chat(messages, **kwargs):
+                yield last
+            if last is not None:
+                self._store_chat(key, last)
+
+        return gen()
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        key = self._complete_key(prompt, formatted, kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return iter([CompletionResponse(text=cached, delta=cached)])
+
+        def gen() -> CompletionResponseGen:
+            last = None
+            for last in self._llm.stream_complete(prompt, formatted=formatted, **kwargs):
+                yield last
+            if last is not None:
+                self._cache.set(key, last.text)
+
+        return gen()
+
+    # the async methods run on the async server's loop, the cache lookups (SQLite, Redis) go to a worker thread
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        key = self._chat_key(messages, kwargs)
+        cached = await asyncio.to_thread(self._cache.get, key)
+        if cached is not None:
+            return _deserialize_chat(cached)
+
+        response = await self._llm.achat(messages, **kwargs)
+        await asyncio.to_thread(self._store_chat, key, response)
+        return response
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        key = self._complete_key(prompt, formatted, kwargs)
+        cached = await asyncio.to_thread(self._cache.get, key)
+        if cached is not None:
+            return CompletionResponse(text=cached, delta=cached)
+
+        response = await self._llm.acomplete(prompt, formatted=formatted, **kwargs)
+        await asyncio.to_thread(self._cache.set, key, response.text)
+        return response
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        key = self._chat_key(messages, kwargs)
+        cached = await asyncio.to_thread(self._cache.get, key)
+
+        async def gen() -> ChatResponseAsyncGen:
+            if cached is not None:
+                yield _deserialize_chat(cached)
+                return
+
+            last = None
+            async for last in await self._llm.astream_chat(messages, **kwargs):
+                yield last
+            if last is not None:
+                await asyncio.to_thread(self._store_chat, key, last)
+
+        return gen()
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        key = self._complete_key(prompt, formatted, kwargs)
+        cached = await asyncio.to_thread(self._cache.get, key)
+
+        async def gen() -> CompletionResponseAsyncGen:
+            if cached is not None:
+                yield CompletionResponse(text=cached, delta=cached)
+                return
+
+            last = None
+            async for last in await self._llm.astream_complete(prompt, formatted=formatted, **kwargs):
+                yield last
+            if last is not None:
+                await asyncio.to_thread(self._cache.set, key, last.text)
+
+        return gen()
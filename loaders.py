@@ -5,7 +5,7 @@ from memory_profiler import profile
 load_dotenv()
 
 class EnvironmentConfig:
-    # __slots__ = ['qd_endpoint', 'qd_api_key', 'slack_bot_token', 'slack_signing_secret', 'graph_signal_api_key']
+    __slots__ = ['qd_endpoint', 'qd_api_key', 'slack_bot_token', 'slack_signing_secret', 'graph_signal_api_key']
 
     # @profile
     def __init__(self):
@@ -35,13 +35,13 @@ class EnvironmentConfig:
     
 class QdrantClientManager:
 
-    # add __slots 
-    # __slots__ = ['config', '_client', '_collection_name'] 
+    __slots__ = ['config', '_client', '_aclient', '_collection_name']
 
     # @profile
     def __init__(self, config, collection_name):
         self.config = config
         self._client = None
+        self._aclient = None
         self._collection_name = collection_name
         
 
@@ -63,13 +63,22 @@ class QdrantClientManager:
                     )
         return self._client
 
+    @property
+    def async_client(self):
+        """AsyncQdrantClient for awaited searches (the async server), None for the in-memory client."""
+        from qdrant_client import AsyncQdrantClient
+
+        if self._aclient is None and self.config.qd_endpoint and self.config.qd_api_key:
+            self._aclient = AsyncQdrantClient(url=self.config.qd_endpoint, api_key=self.config.qd_api_key)
+        return self._aclient
+
 
 
 class YouTubeLoader:
-    # __slots__ = ['file_path', '_ytlinks', '_yttranscripts']
+    __slots__ = ['_ytlinks', '_yttranscripts', '_restore_punctuation']
 
     # @profile
-    def __init__(self):
+    def __init__(self, restore_punctuation=True):
         # TODO - add file path and put video content in there instead of using a
         self._ytlinks = [
                 'https://youtu.be/ZxvbQbT_wkc?feature=shared',   
@@ -204,6 +213,8 @@ class YouTubeLoader:
             # Add more links here...
         ]
         self._yttranscripts = {}
+        # the punctuation model pulls in torch, LOW_MEMORY deployments index the raw transcripts instead
+        self._restore_punctuation = restore_punctuation
 
 
     def _load_youtube_transcripts(self):
@@ -212,18 +223,20 @@ class YouTubeLoader:
         loader = YoutubeTranscriptReader()
         return loader.load_data(ytlinks=self._ytlinks)
 
-    # # define property for ytlinks
-    # @property
-    # def ytlinks(self):
-    #     return self._ytlinks
+    # define property for ytlinks
+    @property
+    def ytlinks(self):
+        return self._ytlinks
 
     # define property for yttranscripts
     @property
     def yttranscripts(self):
-        from deepmultilingualpunctuation import PunctuationModel
-
         if not self._yttranscripts:
             self._yttranscripts = self._load_youtube_transcripts()
+            if not self._restore_punctuation:
+                return self._yttranscripts
+
+            from deepmultilingualpunctuation import PunctuationModel
 
             model = PunctuationModel()
             # punctuation restoration for youtube transcripts using deepmultilingualpunctuation
@@ -0,0 +1,143 @@
+import bisect
+import re
+import threading
+from collections import defaultdict
+
+# latency buckets in seconds, from cache hits to slow agent runs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+_INVALID_NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Histogram:
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates the `q` quantile from the buckets (upper bound of the bucket it falls in)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Process-wide counters, gauges and histograms shared by the bot's caches and handlers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def quantile(self, name, q, **labels):
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            return histogram.quantile(q) if histogram else 0.0
+
+    def get(self, name, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key in self._gauges:
+                return self._gauges[key]
+            return self._counters.get(key, 0)
+
+    def snapshot(self):
+        """Returns a flat dict of `name{label=value,...}` -> value."""
+        with self._lock:
+            items = list(self._counters.items()) + list(self._gauges.items())
+            for (name, labels), histogram in self._histograms.items():
+                items.append(((f"{name}_count", labels), histogram.count))
+                items.append(((f"{name}_sum", labels), histogram.sum))
+
+        snapshot = {}
+        for (name, labels), value in items:
+            label_str = ",".join(f"{k}={v}" for k, v in labels)
+            snapshot[f"{name}{{{label_str}}}" if label_str else name] = value
+        return snapshot
+
+    def render_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(
+                ((key, list(h.buckets), list(h.counts), h.sum, h.count) for key, h in self._histograms.items()),
+                key=lambda item: item[0],
+            )
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for kind, items in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in items:
+                name = _INVALID_NAME_PATTERN.sub("_", name)
+                declare(name, kind)
+                lines.append(f"{name}{_prometheus_labels(labels)} {0 if value is None else value}")
+
+        for (name, labels), buckets, counts, total, count in histograms:
+            name = _INVALID_NAME_PATTERN.sub("_", name)
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_prometheus_labels(labels, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} {total}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
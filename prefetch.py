@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import List
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from metrics import registry
+from youtube_catalog import title_similarity
+
+log = logging.getLogger(__name__)
+
+# the retrieval started for the question being answered in this context
+_pending = contextvars.ContextVar("prefetched_retrieval", default=None)
+
+
+class _Prefetch:
+    __slots__ = ['query', 'future', 'used']
+
+    def __init__(self, query, future):
+        self.query = query
+        self.future = future
+        self.used = False
+
+
+class RetrievalPrefetcher:
+    """Starts retrieving the raw question as soon as an agent run starts, next to the agent's first LLM step.
+
+    When the agent then calls the transcripts tool with an input close to the question (at least `min_overlap` of
+    the tool input's words appear in the question), `retriever` answers from the prefetched nodes instead of
+    embedding and searching again.
+    """
+
+    def __init__(self, retriever: BaseRetriever, min_overlap=0.6, max_workers=4):
+        self.inner = retriever
+        self.min_overlap = min_overlap
+        self.max_workers = max_workers
+        self.retriever = PrefetchingRetriever(self)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # executor threads don't survive the fork of a preloaded gunicorn app
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="prefetch")
+                self._pid = os.getpid()
+            return self._executor
+
+    @contextmanager
+    def prefetch(self, query):
+        """Retrieves `query` in the background while the block (the agent run) runs."""
+        # copy the context so the retrieval spans are tied to this request's trace
+        context = contextvars.copy_context()
+        pending = _Prefetch(query, self._get_executor().submit(context.run, self.inner.retrieve, query))
+        token = _pending.set(pending)
+        try:
+            yield
+        finally:
+            _pending.reset(token)
+            if not pending.used and not pending.future.cancelled():
+                registry.inc("retrieval_prefetch", result="unused")
+                # nobody will read it, don't let it hold up the other questions' prefetches
+                pending.future.cancel()
+
+    @asynccontextmanager
+    async def aprefetch(self, query):
+        """`prefetch` for the async server: the retrieval is a task on the loop (`aretrieve`), not a thread."""
+        pending = _Prefetch(query, asyncio.ensure_future(self.inner.aretrieve(query)))
+        token = _pending.set(pending)
+        try:
+            yield
+        finally:
+            _pending.reset(token)
+            if not pending.used:
+                registry.inc("retrieval_prefetch", result="unused")
+                # nobody will read it: stop the search, or mark a failure as seen so asyncio doesn't log it
+                if not pending.future.cancel() and not pending.future.cancelled():
+                    pending.future.exception()
+
+    def _match(self, query_str):
+        pending = _pending.get()
+        if pending is None:
+            return None
+        if title_similarity(query_str, pending.query) < self.min_overlap:
+            registry.inc("retrieval_prefetch", result="miss")
+            return None
+        return pending
+
+    def _taken(self, pending, nodes):
+        pending.used = True
+        registry.inc("retrieval_prefetch", result="hit")
+        return list(nodes)
+
+    def take(self, query_str):
+        """Prefetched nodes if a retrieval for a question close to `query_str` is pending, else None."""
+        pending = self._match(query_str)
+        if pending is None:
+            return None
+        if pending.future.cancel():
+            # still queued behind other prefetches, retrieving right away is faster than waiting for a worker
+            registry.inc("retrieval_prefetch", result="queued")
+            return None
+        try:
+            nodes = pending.future.result()
+        except Exception as e:
+            log.warning(f"Prefetched retrieval failed, retrieving again: {e}")
+            registry.inc("retrieval_prefetch", result="error")
+            return None
+        return self._taken(pending, nodes)
+
+    async def atake(self, query_str):
+        """`take` for the async server, awaits the prefetch task."""
+        pending = self._match(query_str)
+        if pending is None:
+            return None
+        try:
+            # shielded: a cancelled agent run must not cancel a search another tool call may be waiting on
+            nodes = await asyncio.shield(pending.future)
+        except Exception as e:
+            log.warning(f"Prefetched retrieval failed, retrieving again: {e}")
+            registry.inc("retrieval_prefetch", result="error")
+            return None
+        return self._taken(pending, nodes)
+
+
+class PrefetchingRetriever(BaseRetriever):
+    """Retriever for the query engine that prefers the `RetrievalPrefetcher` result over a new search."""
+
+    def __init__(self, prefetcher: RetrievalPrefetcher):
+        self._prefetcher = prefetcher
+        super().__init__(callback_manager=prefetcher.inner.callback_manager)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = self._prefetcher.take(query_bundle.query_str)
+        if nodes is not None:
+            return nodes
+        return self._prefetcher.inner.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await self._prefetcher.atake(query_bundle.query_str)
+        if nodes is not None:
+            return nodes
+        return await self._prefetcher.inner.aretrieve(query_bundle)
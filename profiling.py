@@ -0,0 +1,216 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def rss_bytes():
+    import psutil
+
+    return psutil.Process().memory_info().rss
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class Profiler:
+    """Runtime-switchable profiling of the requests being answered, without code changes or a redeploy.
+
+    - `memory_sample_rate`: share of requests that get a tracemalloc diff (top allocation sites that grew). tracemalloc
+      is process-wide, so allocations of requests answered at the same time show up in the diff too.
+    - `slow_seconds`: requests are run under cProfile and the profile is kept when they take at least this long.
+      cProfile profiles a thread, so requests answered as tasks on an event loop (the async server) are skipped:
+      one request's profiler would replace another's on the loop thread.
+    - `rss_interval`: how often the process RSS is logged, exported as `process_rss_bytes` and appended to `rss.log`.
+
+    Reports are written to `output_dir`, keeping the newest `max_files`.
+    """
+
+    def __init__(self, output_dir="profiles", memory_sample_rate=0.0, slow_seconds=0.0, rss_interval=0,
+                 memory_frames=10, max_files=200):
+        self.output_dir = output_dir
+        self.memory_sample_rate = memory_sample_rate
+        self.slow_seconds = slow_seconds
+        self.rss_interval = rss_interval
+        self.memory_frames = memory_frames
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        # sampled requests in flight, tracemalloc runs only while there are any (unless it was on before)
+        self._memory_lock = threading.Lock()
+        self._memory_requests = 0
+        self._started_tracing = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            output_dir=os.getenv("PROFILE_DIR", "profiles"),
+            memory_sample_rate=float(os.getenv("PROFILE_MEMORY_SAMPLE_RATE", 0)),
+            slow_seconds=float(os.getenv("PROFILE_SLOW_SECONDS", 0)),
+            rss_interval=float(os.getenv("PROFILE_RSS_INTERVAL_SECONDS", 0)),
+            memory_frames=int(os.getenv("PROFILE_MEMORY_FRAMES", 10)),
+        )
+
+    @property
+    def enabled(self):
+        return self.memory_sample_rate > 0 or self.slow_seconds > 0 or self.rss_interval > 0
+
+    @contextmanager
+    def profile_request(self, trace):
+        """Request hook for `tracing.request`."""
+        sample_memory = self.memory_sample_rate > 0 and random.random() < self.memory_sample_rate
+        before = None
+        if sample_memory:
+            self._start_tracing()
+            before = tracemalloc.take_snapshot()
+
+        profile = None
+        if self.slow_seconds > 0 and not _on_event_loop():
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                if duration >= self.slow_seconds:
+                    self._write_cpu_profile(trace, profile, duration)
+            if before is not None:
+                self._write_memory_diff(trace, before, duration)
+                self._stop_tracing()
+
+    def _start_tracing(self):
+        with self._memory_lock:
+            if self._memory_requests == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(self.memory_frames)
+                self._started_tracing = True
+            self._memory_requests += 1
+
+    def _stop_tracing(self):
+        # the other requests would pay for tracing allocations until the next sampled one
+        with self._memory_lock:
+            self._memory_requests -= 1
+            if self._memory_requests == 0 and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def _path(self, trace, kind):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.request_id}-{trace.name}-{kind}"
+        return os.path.join(self.output_dir, _SAFE_NAME.sub("_", name))
+
+    def _write_cpu_profile(self, trace, profile, duration):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = self._path(trace, "cpu")
+            profile.dump_stats(path + ".prof")
+
+            summary = io.StringIO()
+            summary.write(f"Request {trace.request_id} ({trace.name}) took {duration:.2f}s: {trace.summary()}\n\n")
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(40)
+            with open(path + ".txt", "w") as f:
+                f.write(summary.getvalue())
+            registry.inc("profiles_written", kind="cpu")
+            log.info(f"Request {trace.request_id} took {duration:.2f}s, CPU profile written to {path}.prof")
+            self._prune()
+        except Exception as e:
+            log.error(f"Failed to write CPU profile: {e}")
+
+    def _write_memory_diff(self, trace, before, duration):
+        try:
+            stats = tracemalloc.take_snapshot().compare_to(before, "lineno")
+            growth = sum(stat.size_diff for stat in stats)
+            lines = [f"Request {trace.request_id} ({trace.name}) took {duration:.2f}s, "
+                     f"traced memory grew by {growth / 1024:.1f} KiB", ""]
+            lines += [str(stat) for stat in stats[:25]]
+
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = self._path(trace, "memory") + ".txt"
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            registry.inc("profiles_written", kind="memory")
+            self._prune()
+        except Exception as e:
+            log.error(f"Failed to write memory diff: {e}")
+
+    def _prune(self):
+        with self._lock:
+            files = [os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir) if name != "rss.log"]
+            files.sort(key=os.path.getmtime)
+            for path in files[:max(0, len(files) - self.max_files)]:
+                os.remove(path)
+
+    def files(self):
+        """Reports in the output directory, newest first."""
+        if not os.path.isdir(self.output_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.output_dir):
+            path = os.path.join(self.output_dir, name)
+            entries.append({"name": name, "size": os.path.getsize(path), "modified": os.path.getmtime(path)})
+        return sorted(entries, key=lambda entry: -entry["modified"])
+
+    def file_path(self, name):
+        """Path of the report `name`, or None if it is not one of ours."""
+        if _SAFE_NAME.search(name) or name.startswith("."):
+            return None
+        path = os.path.join(self.output_dir, name)
+        return path if os.path.isfile(path) else None
+
+    def _report_rss(self):
+        rss = rss_bytes()
+        registry.set_gauge("process_rss_bytes", rss)
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        line = f"{time.strftime('%Y-%m-%dT%H:%M:%S')} pid={os.getpid()} rss={rss / 1024 / 1024:.1f}MiB"
+        if traced:
+            line += f" traced={traced / 1024 / 1024:.1f}MiB"
+        log.info(line)
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, "rss.log"), "a") as f:
+            f.write(line + "\n")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._report_rss()
+            except Exception as e:
+                log.error(f"RSS report failed: {e}")
+            self._stop.wait(self.rss_interval)
+
+    def start(self):
+        """Starts the RSS reporter (again, if this process was forked after it started)."""
+        if self.rss_interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="rss-reporter", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -1,16 +1,37 @@
 import os
+from typing import List, Optional
+
 from slack_sdk import WebClient
-from llama_index.postprocessor.colbert_rerank.base import ColbertRerank
 
 from llama_index.core import PromptTemplate
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 
 from tool_specs import SlackToolSpec, FeedSpec, YoutubeSpec, BingSearchToolSpec
+from tracing import span
 from memory_profiler import profile
 
 
+class TimedPostprocessor(BaseNodePostprocessor):
+    """Records the wrapped postprocessor (e.g. the ColBERT reranker) as a `stage` span."""
+
+    postprocessor: BaseNodePostprocessor
+    stage: str = "rerank"
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TimedPostprocessor"
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        with span(self.stage, postprocessor=self.postprocessor.class_name()):
+            return self.postprocessor.postprocess_nodes(nodes, query_bundle)
+
+
 class QueryEngineManager:
-    # __slots__ = ['index', 'templates', '_agent_context']
+    __slots__ = ['index', 'templates', '_agent_context', '_agent_context_commands']
 
     # @profile
     def __init__(self, index):
@@ -143,16 +164,35 @@ class QueryEngineManager:
     def get_agent_commands_context(self):
         return self._agent_context_commands
 
-    def create_query_engine(self, similarity_top_k=5, streaming=True, chat=False, rerank=False):
+    def create_query_engine(self, similarity_top_k=5, streaming=True, chat=False, rerank=False, retriever=None,
+                            depth=None):
+        node_postprocessors = []
+        if depth is not None:
+            # an AdaptiveDepthPostprocessor, it picks how many of up to max_top_k candidates are used
+            similarity_top_k = depth.max_top_k
+            node_postprocessors.append(depth)
         if rerank:
-            colbert_reranker = ColbertRerank(
+            # imported on use, ColBERT brings torch and transformers into the process
+            from llama_index.postprocessor.colbert_rerank.base import ColbertRerank
+
+            node_postprocessors.append(TimedPostprocessor(postprocessor=ColbertRerank(
                 top_n=5,
                 model="colbert-ir/colbertv2.0",
                 tokenizer="colbert-ir/colbertv2.0",
                 keep_retrieval_score=True,
-            )
-
-            query_engine = self.index.as_chat_engine(streaming=streaming, similarity_top_k=similarity_top_k, node_postprocessors=[colbert_reranker]) if chat else self.index.as_query_engine(similarity_top_k=similarity_top_k, streaming=streaming, node_postprocessors=[colbert_reranker])
+            )))
+
+        if retriever is not None and not chat:
+            # e.g. the two-stage retriever, which applies its own top-k
+            from llama_index.core import Settings
+            from llama_index.core.query_engine import RetrieverQueryEngine
+            from llama_index.core.settings import llm_from_settings_or_context
+
+            query_engine = RetrieverQueryEngine.from_args(
+                retriever, llm=llm_from_settings_or_context(Settings, self.index.service_context),
+                streaming=streaming, node_postprocessors=node_postprocessors)
+        elif node_postprocessors:
+            query_engine = self.index.as_chat_engine(streaming=streaming, similarity_top_k=similarity_top_k, node_postprocessors=node_postprocessors) if chat else self.index.as_query_engine(similarity_top_k=similarity_top_k, streaming=streaming, node_postprocessors=node_postprocessors)
         else:
             query_engine = self.index.as_chat_engine(streaming=streaming, similarity_top_k=similarity_top_k) if chat else self.index.as_query_engine(similarity_top_k=similarity_top_k, streaming=streaming)
         
@@ -161,14 +201,17 @@ class QueryEngineManager:
 
 
 class QueryEngineToolsManager:
-    # add __slots__ to reduce memory usage
-    # __slots__ = ['_slack_tool_spec', '_feed_tool_spec', '_query_engine']
+    __slots__ = ['_slack_tool_spec', '_feed_tool_spec', '_query_engine', '_youtube_tool_spec',
+                 '_bing_search_tool_spec', 'youtube_transcripts_tool']
     # @profile
-    def __init__(self, query_engine):
-        self._slack_tool_spec = SlackToolSpec(client=WebClient(token=os.environ["SLACK_BOT_TOKEN"]))
-        self._feed_tool_spec = FeedSpec()
+    def __init__(self, query_engine, message_store=None, channel_ids=None, video_catalog=None):
+        slack_client = WebClient(token=os.environ["SLACK_BOT_TOKEN"],
+                                 base_url=os.getenv("SLACK_API_URL", WebClient.BASE_URL))
+        self._slack_tool_spec = SlackToolSpec(client=slack_client,
+                                              message_store=message_store, channel_ids=channel_ids)
+        self._feed_tool_spec = FeedSpec(refresh_interval=int(os.getenv("FEED_REFRESH_SECONDS", 900)))
         self._query_engine = query_engine
-        self._youtube_tool_spec = YoutubeSpec()
+        self._youtube_tool_spec = YoutubeSpec(catalog=video_catalog)
         self._bing_search_tool_spec = BingSearchToolSpec(api_key=os.environ["BING_SEARCH_API_KEY"])
         self.youtube_transcripts_tool = QueryEngineTool(
             query_engine=self._query_engine,
@@ -178,6 +221,14 @@ class QueryEngineToolsManager:
             ),
         )
     @property
+    def feed_cache(self):
+        return self._feed_tool_spec.feed_cache
+
+    @property
+    def video_catalog(self):
+        return self._youtube_tool_spec.catalog
+
+    @property
     def slack_tool(self):
         return self._slack_tool_spec.to_tool_list()
 
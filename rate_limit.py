@@ -0,0 +1,84 @@
+import threading
+import time
+
+from ttl_cache import TTLCache
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst` tokens.
+
+    `reserve` never blocks: it takes a token (possibly going into debt) and returns how long the caller should wait
+    before acting, so it works the same from threads (`time.sleep`) and coroutines (`asyncio.sleep`).
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, calls, burst=None):
+        return cls(calls / 60.0, burst or max(1, calls // 10))
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, tokens=1):
+        """Takes `tokens` and returns the number of seconds to wait before using them."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Takes `tokens` only if they are available right now."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        time.sleep(self.reserve(tokens))
+
+    def refund(self, tokens=1):
+        """Gives back `tokens` taken for something that did not happen."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+
+class KeyedRateLimiter:
+    """One `TokenBucket` per key (user, channel, ...); buckets idle for `idle_ttl` seconds are dropped."""
+
+    def __init__(self, calls_per_minute, burst, idle_ttl=3600, maxsize=10000, name=None):
+        self.calls_per_minute = calls_per_minute
+        self.burst = burst
+        self.name = name
+        self._buckets = TTLCache(maxsize=maxsize, ttl=idle_ttl, name=name)
+        self._lock = threading.Lock()
+
+    def _bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.calls_per_minute / 60.0, self.burst)
+            # refresh the idle timer on every use
+            self._buckets.set(key, bucket)
+            return bucket
+
+    def allow(self, key):
+        """Takes a token for `key`; returns False if its bucket is empty."""
+        if key is None or not self.calls_per_minute:
+            return True
+        return self._bucket(key).try_acquire()
+
+    def refund(self, key):
+        """Gives back the token `allow` took for `key`."""
+        if key is None or not self.calls_per_minute:
+            return
+        self._bucket(key).refund()
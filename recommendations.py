@@ -0,0 +1,180 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import registry
+from shared_state import Lease
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS recommendations (
+        role TEXT PRIMARY KEY,
+        text TEXT NOT NULL,
+        version TEXT,
+        computed_at REAL NOT NULL
+    );
+    """
+
+
+class RoleRecommendations:
+    """Onboarding recommendations per role, computed ahead of time and refreshed in the background.
+
+    The answer to a role button only depends on the role, so `compute(role)` runs once per role and the result is
+    stored in SQLite (shared by all workers and kept across restarts). An entry is recomputed when it is older than
+    `refresh_interval` seconds or when `index_version()` reports a different index than it was computed from.
+
+    With a shared `state` only the process holding the refresher lease computes; it publishes each answer through
+    `state`, and the other workers and replicas copy them into their own store.
+    """
+
+    def __init__(self, roles, compute, index_version=None, path="recommendations.sqlite3", refresh_interval=21600,
+                 check_interval=300, state=None):
+        self.roles = list(roles)
+        self.compute = compute
+        self.index_version = index_version
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.state = state
+        self._lease = Lease(state, "recommendations:refresher", ttl=check_interval * 3) if state is not None else None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._thread = None
+        self._thread_pid = None
+        self._stop = threading.Event()
+        self._db()
+
+    def _db(self):
+        # sqlite connections must not be shared with forked (gunicorn) workers, reopen once per process
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _load(self, role):
+        conn = self._db()
+        with self._lock:
+            return conn.execute("SELECT text, version, computed_at FROM recommendations WHERE role = ?",
+                                (role,)).fetchone()
+
+    def get(self, role):
+        """Returns the stored recommendations for `role`, or None if they were not computed yet."""
+        row = self._load(role)
+        registry.inc("role_recommendations", result="hit" if row else "miss")
+        return row[0] if row else None
+
+    def set(self, role, text, version=None, computed_at=None):
+        conn = self._db()
+        with self._lock:
+            conn.execute(
+                "INSERT INTO recommendations (role, text, version, computed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (role) DO UPDATE SET text = excluded.text, version = excluded.version, "
+                "computed_at = excluded.computed_at",
+                (role, text, version, computed_at or time.time()),
+            )
+            conn.commit()
+
+    def _publish(self, role, text, version):
+        if self.state is None:
+            return
+        try:
+            self.state.set(f"recommendations:{role}", {"text": text, "version": version, "computed_at": time.time()})
+        except Exception as e:
+            log.warning(f"Could not share the recommendations for {role}: {e}")
+
+    def load_shared(self):
+        """Copies the answers the refresher published that are newer than the stored ones; returns how many."""
+        if self.state is None:
+            return 0
+        loaded = 0
+        for role in self.roles:
+            try:
+                shared = self.state.get(f"recommendations:{role}")
+            except Exception as e:
+                log.warning(f"Could not load the shared recommendations for {role}: {e}")
+                return loaded
+            row = self._load(role)
+            if shared and (row is None or row[2] < shared["computed_at"]):
+                self.set(role, shared["text"], shared["version"], shared["computed_at"])
+                loaded += 1
+        return loaded
+
+    def _current_version(self):
+        if self.index_version is None:
+            return None
+        try:
+            return str(self.index_version())
+        except Exception as e:
+            log.warning(f"Could not read the index version: {e}")
+            return None
+
+    def is_stale(self, role, version=None):
+        row = self._load(role)
+        if row is None:
+            return True
+        _, stored_version, computed_at = row
+        if version is not None and stored_version != version:
+            return True
+        return time.time() - computed_at > self.refresh_interval
+
+    def refresh(self, force=False):
+        """Recomputes the missing or stale roles one after another; returns the number of roles computed."""
+        # a previous refresher may have computed them already
+        self.load_shared()
+        version = self._current_version()
+        computed = 0
+        for role in self.roles:
+            if self._stop.is_set():
+                break
+            if self._lease is not None and not force and not self._lease.acquire():
+                # renewed between roles, another process took over
+                break
+            if not force and not self.is_stale(role, version):
+                continue
+
+            start = time.monotonic()
+            try:
+                text = self.compute(role)
+            except Exception as e:
+                registry.inc("role_recommendations_refresh", result="error")
+                log.error(f"Computing recommendations for {role} failed: {e}")
+                continue
+            if text:
+                self.set(role, text, version)
+                self._publish(role, text, version)
+                computed += 1
+                registry.inc("role_recommendations_refresh", result="computed")
+                log.info(f"Computed recommendations for {role} in {time.monotonic() - start:.2f}s")
+        return computed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._lease is None or self._lease.acquire():
+                    self.refresh()
+                else:
+                    self.load_shared()
+            except Exception as e:
+                log.error(f"Recommendations refresh failed: {e}")
+            self._stop.wait(self.check_interval)
+
+    def start(self):
+        """Starts the background refresher (again, if this process was forked after it started)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="role-recommendations", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+VIDEO_ID_FIELD = "video_id"
+PUBLISHED_FIELD = "published_ts"
+
+DEPTH_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+
+def parse_published(value):
+    """Unix timestamp of a publish date from the video catalog ("2023-05-01 00:00:00", "May 1, 2023", ...)."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    value = str(value).strip()
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        pass
+    for fmt in ("%b %d, %Y", "%d %b %Y", "%Y/%m/%d", "%m/%d/%Y"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
+    return None
+
+
+def _published_condition(published_after):
+    from qdrant_client.http.models import FieldCondition, Range
+
+    return FieldCondition(key=PUBLISHED_FIELD, range=Range(gte=published_after))
+
+
+class VideoSummaryIndex:
+    """Coarse index with one vector per video, next to the chunk collection.
+
+    A video's vector is the normalized mean of its chunk vectors, so building it needs no extra embedding or LLM
+    calls. Building also tags every chunk with its video ID and publish date, and creates payload indexes on both
+    fields in both collections so filtered searches stay fast as the corpus grows.
+    """
+
+    def __init__(self, client, collection_name, catalog=None, batch_size=256, aclient=None):
+        self.client = client
+        # AsyncQdrantClient for `asearch`, None for the in-memory Qdrant
+        self.aclient = aclient
+        self.chunk_collection = collection_name
+        self.collection_name = f"{collection_name}-videos"
+        self.catalog = catalog
+        self.batch_size = batch_size
+
+    def exists(self):
+        try:
+            return self.client.count(self.collection_name).count > 0
+        except Exception:
+            return False
+
+    def ensure_payload_indexes(self):
+        from qdrant_client.http.models import PayloadSchemaType
+
+        for collection in (self.chunk_collection, self.collection_name):
+            self.client.create_payload_index(collection, VIDEO_ID_FIELD, field_schema=PayloadSchemaType.KEYWORD)
+            self.client.create_payload_index(collection, PUBLISHED_FIELD, field_schema=PayloadSchemaType.INTEGER)
+
+    def _chunk_vectors(self):
+        """Yields (point id, video id, vector) for every chunk."""
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                self.chunk_collection, limit=self.batch_size, offset=offset,
+                with_payload=[VIDEO_ID_FIELD, "doc_id"], with_vectors=True,
+            )
+            for point in points:
+                payload = point.payload or {}
+                # the youtube reader uses the video ID as document ID, older chunks may lack the video_id field
+                video_id = payload.get(VIDEO_ID_FIELD) or payload.get("doc_id")
+                if video_id and point.vector is not None:
+                    yield point.id, video_id, point.vector
+            if offset is None:
+                return
+
+    def build(self, force=False):
+        """Creates the video collection unless it is already filled (or `force`)."""
+        import numpy as np
+        from qdrant_client.http.models import Distance, PointStruct, VectorParams
+
+        if not force and self.exists():
+            return 0
+
+        start = time.monotonic()
+        sums, chunk_ids = {}, {}
+        for point_id, video_id, vector in self._chunk_vectors():
+            vector = np.asarray(vector, dtype=np.float32)
+            if video_id in sums:
+                sums[video_id] += vector
+            else:
+                sums[video_id] = vector.copy()
+            chunk_ids.setdefault(video_id, []).append(point_id)
+        if not sums:
+            log.warning(f"No chunks with a video ID in {self.chunk_collection}, skipping the video index")
+            return 0
+
+        dimensions = len(next(iter(sums.values())))
+        self.client.recreate_collection(
+            collection_name=self.collection_name,
+            vectors_config=VectorParams(size=dimensions, distance=Distance.COSINE),
+        )
+        self.ensure_payload_indexes()
+
+        points = []
+        for number, (video_id, total) in enumerate(sums.items()):
+            video = (self.catalog.get(video_id) if self.catalog is not None else None) or {}
+            fields = {VIDEO_ID_FIELD: video_id}
+            published = parse_published(video.get("published"))
+            if published is not None:
+                fields[PUBLISHED_FIELD] = published
+            # tag the chunks so the second stage can filter on the same fields
+            self.client.set_payload(self.chunk_collection, payload=fields, points=chunk_ids[video_id])
+
+            norm = float(np.linalg.norm(total)) or 1.0
+            payload = {**fields, "title": video.get("title"), "chunks": len(chunk_ids[video_id])}
+            points.append(PointStruct(id=number, vector=(total / norm).tolist(), payload=payload))
+
+        for i in range(0, len(points), self.batch_size):
+            self.client.upsert(self.collection_name, points=points[i:i + self.batch_size])
+
+        registry.set_gauge("video_index_videos", len(points))
+        log.info(f"Built {self.collection_name} with {len(points)} videos in {time.monotonic() - start:.1f}s")
+        return len(points)
+
+    def _search_args(self, embedding, limit, published_after):
+        from qdrant_client.http.models import Filter
+
+        query_filter = Filter(must=[_published_condition(published_after)]) if published_after else None
+        return dict(query_vector=embedding, limit=limit, query_filter=query_filter, with_payload=[VIDEO_ID_FIELD])
+
+    def search(self, embedding, limit, published_after=None):
+        """Returns the IDs of the `limit` videos closest to `embedding`."""
+        hits = self.client.search(self.collection_name, **self._search_args(embedding, limit, published_after))
+        return [hit.payload[VIDEO_ID_FIELD] for hit in hits]
+
+    async def asearch(self, embedding, limit, published_after=None):
+        hits = await self.aclient.search(self.collection_name, **self._search_args(embedding, limit, published_after))
+        return [hit.payload[VIDEO_ID_FIELD] for hit in hits]
+
+
+class TwoStageRetriever(BaseRetriever):
+    """Picks the `top_videos` best matching videos from the `VideoSummaryIndex`, then searches chunks only within them.
+
+    Answers draw from a few coherent videos instead of fragments of unrelated ones. Falls back to a flat chunk search
+    when no video matches (e.g. a `published_after` filter excludes all of them).
+    """
+
+    def __init__(self, index, video_index: VideoSummaryIndex, similarity_top_k=5, top_videos=3,
+                 published_after: Optional[int] = None):
+        self._vector_store = index.vector_store
+        self._embed_model = index._embed_model
+        self._video_index = video_index
+        self._similarity_top_k = similarity_top_k
+        self._top_videos = top_videos
+        self._published_after = published_after
+        super().__init__(callback_manager=index._callback_manager)
+
+    def _query(self, query_bundle, video_ids):
+        from qdrant_client.http.models import FieldCondition, Filter, MatchAny
+
+        conditions = []
+        if video_ids:
+            conditions.append(FieldCondition(key=VIDEO_ID_FIELD, match=MatchAny(any=video_ids)))
+            registry.inc("two_stage_retrievals", result="videos")
+        else:
+            registry.inc("two_stage_retrievals", result="flat")
+        if self._published_after:
+            conditions.append(_published_condition(self._published_after))
+
+        query = VectorStoreQuery(query_embedding=query_bundle.embedding, similarity_top_k=self._similarity_top_k)
+        return query, Filter(must=conditions)
+
+    @staticmethod
+    def _nodes(result):
+        scores = result.similarities or [None] * len(result.nodes)
+        return [NodeWithScore(node=node, score=score) for node, score in zip(result.nodes, scores)]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+
+        video_ids = self._video_index.search(query_bundle.embedding, self._top_videos, self._published_after)
+        query, qdrant_filters = self._query(query_bundle, video_ids)
+        return self._nodes(self._vector_store.query(query, qdrant_filters=qdrant_filters))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # needs the async Qdrant client on both the video index and the vector store, see ThreadedRetriever otherwise
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await self._embed_model.aget_agg_embedding_from_queries(
+                query_bundle.embedding_strs)
+
+        video_ids = await self._video_index.asearch(query_bundle.embedding, self._top_videos, self._published_after)
+        query, qdrant_filters = self._query(query_bundle, video_ids)
+        return self._nodes(await self._vector_store.aquery(query, qdrant_filters=qdrant_filters))
+
+
+class ThreadedRetriever(BaseRetriever):
+    """Awaited retrievals of `retriever` run in a worker thread.
+
+    For a Qdrant without an async client (the in-memory one), where the vector store's `aquery` is not available.
+    """
+
+    def __init__(self, retriever: BaseRetriever):
+        self._inner = retriever
+        super().__init__(callback_manager=retriever.callback_manager)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._inner.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # to_thread copies the context, the search's spans stay tied to the request
+        return await asyncio.to_thread(self._inner.retrieve, query_bundle)
+
+
+class AdaptiveDepthPostprocessor(BaseNodePostprocessor):
+    """Sends as many retrieved chunks to synthesis as the scores justify, instead of a fixed top-k.
+
+    The query engine retrieves `max_top_k` candidates. Chunks scoring below `min_score` are not relevant, so a
+    question without any relevant chunk gets none. Of the rest, only chunks within `relative_cutoff` of the best
+    score are kept: one decisive hit (0.62, 0.41, ...) is sent alone, while flat scores (0.48, 0.47, 0.46, ...) keep
+    up to `max_top_k` chunks.
+    """
+
+    min_score: float = 0.25
+    relative_cutoff: float = 0.2
+    min_top_k: int = 1
+    max_top_k: int = 10
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AdaptiveDepthPostprocessor"
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        ranked = sorted((n for n in nodes if n.score is not None and n.score >= self.min_score),
+                        key=lambda n: -n.score)
+        kept = []
+        if ranked:
+            floor = ranked[0].score * (1 - self.relative_cutoff)
+            kept = [n for i, n in enumerate(ranked[:self.max_top_k]) if i < self.min_top_k or n.score >= floor]
+
+        registry.observe("retrieval_depth", len(kept), buckets=DEPTH_BUCKETS)
+        if not kept:
+            registry.inc("retrieval_no_relevant_chunks")
+        return kept
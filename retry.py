@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import random
+import socket
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, List
+
+from llama_index.core.tools import AsyncBaseTool, BaseTool, ToolMetadata, ToolOutput, adapt_to_async_tool
+from slack_sdk.errors import SlackApiError
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+UNAVAILABLE = "unavailable"
+BAD_OUTPUT = "bad_output"
+SLACK = "slack"
+OTHER = "other"
+
+RETRYABLE = {RATE_LIMIT, TIMEOUT, UNAVAILABLE, BAD_OUTPUT}
+
+# reason the current attempt is a retry ("" on the first attempt), read by the LLM cache to skip bad cached steps
+_retry_reason: ContextVar[str] = ContextVar("retry_reason", default="")
+
+
+def current_retry_reason():
+    return _retry_reason.get()
+
+
+def _status_code(error):
+    """HTTP status of an API error (openai, httpx and the like), None if it carries none."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def classify_error(error: BaseException) -> str:
+    """Maps an exception raised while answering a question to a retry class."""
+    name = type(error).__name__
+    message = str(error).lower()
+
+    if isinstance(error, SlackApiError):
+        if error.response.get("error") == "ratelimited" or error.response.status_code == 429:
+            return RATE_LIMIT
+        return SLACK
+    if name == "RateLimitError" or _status_code(error) == 429 or "rate limit" in message:
+        return RATE_LIMIT
+    if isinstance(error, (TimeoutError, socket.timeout)) or "timeout" in name.lower() or "timed out" in message:
+        return TIMEOUT
+    if name in ("APIConnectionError", "InternalServerError", "ServiceUnavailableError", "ConnectionError"):
+        return UNAVAILABLE
+    if isinstance(error, ValueError) and ("could not parse" in message or "got empty message" in message):
+        return BAD_OUTPUT
+    return OTHER
+
+
+class RetryPolicy:
+    """Retries retryable errors with jittered exponential backoff ("full jitter")."""
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=20.0, retryable=RETRYABLE):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+
+    def backoff(self, attempt, reason):
+        # rate limits need a longer cool-down than a flaky parse
+        base = self.base_delay * (4 if reason == RATE_LIMIT else 1)
+        return random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+
+    def _failed(self, error, attempt, start, label):
+        """Classifies a failed attempt; returns (reason, backoff delay), the delay is None when giving up."""
+        reason = classify_error(error)
+        registry.inc("retry_errors", label=label, reason=reason)
+
+        if reason not in self.retryable or attempt == self.max_attempts - 1:
+            log.error(f"{label}: giving up after {attempt + 1} attempt(s) ({reason}): {error}")
+            registry.inc("retry_giveups", label=label, reason=reason)
+            registry.inc("retry_wasted_seconds", time.monotonic() - start, label=label)
+            return reason, None
+
+        delay = self.backoff(attempt, reason)
+        log.warning(f"{label}: attempt {attempt + 1} failed ({reason}): {error}, retrying in {delay:.1f}s")
+        registry.inc("retry_attempts", label=label, reason=reason)
+        return reason, delay
+
+    def run(self, func: Callable[[], Any], label="default"):
+        """Calls `func` until it succeeds, the error is not retryable or attempts run out."""
+        reason = ""
+        for attempt in range(self.max_attempts):
+            token = _retry_reason.set(reason)
+            start = time.monotonic()
+            try:
+                return func()
+            except Exception as e:
+                reason, delay = self._failed(e, attempt, start, label)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                registry.inc("retry_wasted_seconds", time.monotonic() - start, label=label)
+            finally:
+                _retry_reason.reset(token)
+
+    async def arun(self, func: Callable[[], Awaitable[Any]], label="default"):
+        """`run` for coroutines: awaits `func()` and backs off without blocking the event loop."""
+        reason = ""
+        for attempt in range(self.max_attempts):
+            token = _retry_reason.set(reason)
+            start = time.monotonic()
+            try:
+                return await func()
+            except Exception as e:
+                reason, delay = self._failed(e, attempt, start, label)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                registry.inc("retry_wasted_seconds", time.monotonic() - start, label=label)
+            finally:
+                _retry_reason.reset(token)
+
+
+class CheckpointedTool(AsyncBaseTool):
+    """Tool wrapper that replays successful results recorded in a `ToolCheckpoint`."""
+
+    def __init__(self, tool: BaseTool, checkpoint: "ToolCheckpoint"):
+        self._tool = adapt_to_async_tool(tool)
+        self._checkpoint = checkpoint
+
+    @property
+    def metadata(self) -> ToolMetadata:
+        return self._tool.metadata
+
+    def _key(self, args, kwargs):
+        return self.metadata.name, json.dumps([args, kwargs], sort_keys=True, default=str)
+
+    def call(self, *args: Any, **kwargs: Any) -> ToolOutput:
+        key = self._key(args, kwargs)
+        output = self._checkpoint.get(key)
+        if output is None:
+            output = self._tool.call(*args, **kwargs)
+            self._checkpoint.put(key, output)
+        return output
+
+    async def acall(self, *args: Any, **kwargs: Any) -> ToolOutput:
+        key = self._key(args, kwargs)
+        output = self._checkpoint.get(key)
+        if output is None:
+            output = await self._tool.acall(*args, **kwargs)
+            self._checkpoint.put(key, output)
+        return output
+
+
+class ToolCheckpoint:
+    """Remembers completed tool calls of one question so a retried agent run doesn't redo them."""
+
+    def __init__(self):
+        self._outputs = {}
+
+    def get(self, key):
+        output = self._outputs.get(key)
+        if output is not None:
+            registry.inc("tool_checkpoint_hits", tool=key[0])
+        return output
+
+    def put(self, key, output: ToolOutput):
+        if not output.is_error:
+            self._outputs[key] = output
+
+    def wrap(self, tools: List[BaseTool]) -> List[AsyncBaseTool]:
+        return [CheckpointedTool(tool, self) for tool in tools]
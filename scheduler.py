@@ -0,0 +1,57 @@
+import logging
+
+from metrics import registry
+from rate_limit import KeyedRateLimiter
+
+log = logging.getLogger(__name__)
+
+# lower runs first: slash commands are interactive and ephemeral, mentions are answered in a thread
+PRIORITY_COMMAND = 0
+PRIORITY_ONBOARDING = 1
+PRIORITY_MENTION = 2
+
+ACCEPTED = "accepted"
+BUSY = "busy"
+LIMITED = "limited"
+
+
+class RequestScheduler:
+    """Admission in front of the `JobQueue`: per-user and per-channel token buckets, then priority classes.
+
+    A user or channel that runs out of tokens is told to slow down instead of filling the queue, and queued jobs are
+    served by priority and round-robin across users (see `JobQueue`).
+    """
+
+    def __init__(self, job_queue, user_limiter: KeyedRateLimiter = None, channel_limiter: KeyedRateLimiter = None):
+        self.job_queue = job_queue
+        self.user_limiter = user_limiter
+        self.channel_limiter = channel_limiter
+
+    def start(self):
+        self.job_queue.start()
+
+    def submit(self, name, func, *args, priority=PRIORITY_MENTION, user=None, channel=None):
+        """Queues `func(*args)`; returns ACCEPTED, BUSY (queue full) or LIMITED (user or channel over its rate).
+
+        Tokens are only spent on admitted requests: a request turned away by a later check gives its tokens back.
+        """
+        if self.user_limiter is not None and not self.user_limiter.allow(user):
+            registry.inc("scheduler_limited", job=name, scope="user")
+            log.info(f"Rate limiting {name} from user {user}")
+            return LIMITED
+        if self.channel_limiter is not None and not self.channel_limiter.allow(channel):
+            self._refund(user=user)
+            registry.inc("scheduler_limited", job=name, scope="channel")
+            log.info(f"Rate limiting {name} in channel {channel}")
+            return LIMITED
+
+        if not self.job_queue.submit(name, func, *args, priority=priority, fair_key=user):
+            self._refund(user=user, channel=channel)
+            return BUSY
+        return ACCEPTED
+
+    def _refund(self, user=None, channel=None):
+        if self.user_limiter is not None:
+            self.user_limiter.refund(user)
+        if self.channel_limiter is not None:
+            self.channel_limiter.refund(channel)
@@ -0,0 +1,385 @@
+"""State shared between processes and replicas: cached answers, seen Slack events and in-flight locks.
+
+`MemoryState` keeps everything in the current process, `SQLiteState` shares it between the worker processes of one
+host. `RedisState` talks the Redis protocol (RESP) to a server shared by all replicas; `StateServer` is a small
+stand-in for that server for local runs and benchmarks:
+
+    python shared_state.py --port 6380
+    SHARED_STATE_URL=redis://localhost:6380 python commons-bot.py
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from metrics import registry
+from ttl_cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class SharedState:
+    """Key/value store with expiring entries; values are anything JSON serializable."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def set_if_absent(self, key, value, ttl=None):
+        """Stores `value` only if `key` is not set; returns True if it was stored (an atomic claim)."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryState(SharedState):
+    """In-process state, used when no shared server is configured."""
+
+    def __init__(self, maxsize=100000, default_ttl=86400, max_bytes=None):
+        self._data = TTLCache(maxsize=maxsize, ttl=default_ttl, name="shared_state", max_bytes=max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._data.set(key, value, ttl=ttl)
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self._lock:
+            if self._data.get(key) is not None:
+                return False
+            self._data.set(key, value, ttl=ttl)
+            return True
+
+    def delete(self, key):
+        self._data.pop(key)
+
+
+class SQLiteState(SharedState):
+    """State in a SQLite file, shared by the worker processes of one host.
+
+    Entries are only dropped once they expire, never to make room, so claims and leases kept here hold.
+    """
+
+    def __init__(self, path="shared_state.sqlite3", timeout=5.0, purge_every=1000):
+        self.path = path
+        self.timeout = timeout
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        # sqlite connections must not be shared with forked (gunicorn) workers, reopen once per process
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "expires_at REAL)")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _expires_at(ttl):
+        return time.time() + ttl if ttl else None
+
+    def _purge(self, conn):
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            conn.execute("DELETE FROM state WHERE expires_at < ?", (time.time(),))
+
+    def get(self, key):
+        conn = self._db()
+        with self._lock:
+            row = conn.execute("SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                               (key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        conn = self._db()
+        with self._lock:
+            conn.execute("INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), self._expires_at(ttl)))
+            self._purge(conn)
+            conn.commit()
+
+    def set_if_absent(self, key, value, ttl=None):
+        conn = self._db()
+        with self._lock:
+            # the DELETE takes the write lock, so the check and the insert are atomic across processes
+            conn.execute("DELETE FROM state WHERE key = ? AND expires_at < ?", (key, time.time()))
+            inserted = conn.execute("INSERT OR IGNORE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                                    (key, json.dumps(value), self._expires_at(ttl))).rowcount == 1
+            self._purge(conn)
+            conn.commit()
+        return inserted
+
+    def delete(self, key):
+        conn = self._db()
+        with self._lock:
+            conn.execute("DELETE FROM state WHERE key = ?", (key,))
+            conn.commit()
+
+
+class RedisError(Exception):
+    pass
+
+
+def _encode_command(args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _read_reply(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed by the state server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        raise RedisError(rest.decode("utf-8"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return stream.read(length + 2)[:-2]
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [_read_reply(stream) for _ in range(length)]
+    raise RedisError(f"Unexpected reply {line!r}")
+
+
+class RedisState(SharedState):
+    """Shared state on a Redis (or `StateServer`) instance, e.g. `redis://:password@redis:6379/0`.
+
+    Speaks just enough of the Redis protocol for GET, SET (EX/PX/NX) and DEL over a small pool of connections, so
+    there is no client library to install.
+    """
+
+    def __init__(self, url, pool_size=8, timeout=5.0, prefix="commons-bot:"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.prefix = prefix
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+        if self.password:
+            self._send(connection, "AUTH", self.password)
+        if self.db:
+            self._send(connection, "SELECT", self.db)
+        return connection
+
+    @staticmethod
+    def _send(connection, *args):
+        sock, stream = connection
+        sock.sendall(_encode_command(args))
+        return _read_reply(stream)
+
+    def command(self, *args):
+        if self._pid != os.getpid():
+            # connections must not be shared with forked (gunicorn) workers
+            self._pool = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+
+        try:
+            reply = self._send(connection, *args)
+        except RedisError:
+            self._release(connection)
+            raise
+        except OSError:
+            registry.inc("shared_state_errors", command=args[0])
+            connection[0].close()
+            raise
+        self._release(connection)
+        return reply
+
+    def _release(self, connection):
+        if self._pool.qsize() < self.pool_size:
+            self._pool.put(connection)
+        else:
+            connection[0].close()
+
+    def get(self, key):
+        value = self.command("GET", self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        args = ["SET", self.prefix + key, json.dumps(value)]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        self.command(*args)
+
+    def set_if_absent(self, key, value, ttl=None):
+        args = ["SET", self.prefix + key, json.dumps(value), "NX"]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        return self.command(*args) == "OK"
+
+    def delete(self, key):
+        self.command("DEL", self.prefix + key)
+
+
+def create_shared_state(url=None, max_bytes=None):
+    """Returns a `RedisState` for `url`, or in-process `MemoryState` (capped at `max_bytes`) without one."""
+    if not url:
+        return MemoryState(max_bytes=max_bytes)
+    log.info(f"Sharing caches and locks through {urlparse(url).hostname}")
+    return RedisState(url)
+
+
+def create_coordination_state(url=None, path="shared_state.sqlite3"):
+    """Store for claims, locks and leases: `RedisState` for `url`, else a `SQLiteState` shared by this host's workers.
+
+    Unlike the cache store it must never evict entries to make room, or a claim could silently disappear: point `url`
+    at a Redis instance that holds no caches and runs with `maxmemory-policy noeviction`.
+    """
+    if not url:
+        return SQLiteState(path)
+    return RedisState(url)
+
+
+class Lease:
+    """Elects one process among those sharing `state` (workers and replicas) to do a job, e.g. a periodic refresh.
+
+    `acquire` claims the lease or renews it for its holder; the others take over once it was not renewed for `ttl`
+    seconds.
+    """
+
+    def __init__(self, state, key, ttl=600):
+        self.state = state
+        self.key = key
+        self.ttl = ttl
+
+    @staticmethod
+    def _owner():
+        # per process, the lease is created before gunicorn forks its workers
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def acquire(self):
+        """Returns True if this process holds the lease."""
+        owner = self._owner()
+        try:
+            if self.state.set_if_absent(self.key, owner, ttl=self.ttl):
+                return True
+            if self.state.get(self.key) == owner:
+                self.state.set(self.key, owner, ttl=self.ttl)
+                return True
+        except Exception as e:
+            log.warning(f"Could not claim {self.key}: {e}")
+        return False
+
+    def release(self):
+        try:
+            if self.state.get(self.key) == self._owner():
+                self.state.delete(self.key)
+        except Exception as e:
+            log.warning(f"Could not release {self.key}: {e}")
+
+
+class _StateRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except (ConnectionError, OSError):
+                return
+            try:
+                reply = self.server.execute([arg.decode("utf-8") for arg in args])
+            except Exception as e:
+                self.wfile.write(f"-ERR {e}\r\n".encode("utf-8"))
+                continue
+
+            if reply is None:
+                self.wfile.write(b"$-1\r\n")
+            elif isinstance(reply, int):
+                self.wfile.write(b":%d\r\n" % reply)
+            elif reply == "OK" or reply == "PONG":
+                self.wfile.write(f"+{reply}\r\n".encode("utf-8"))
+            else:
+                data = reply.encode("utf-8")
+                self.wfile.write(b"$%d\r\n%s\r\n" % (len(data), data))
+
+
+class StateServer(socketserver.ThreadingTCPServer):
+    """Stand-in for a Redis server backed by `MemoryState`, supporting the commands `RedisState` uses."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=6380):
+        super().__init__((host, port), _StateRequestHandler)
+        self.state = MemoryState()
+
+    def execute(self, args):
+        command = args[0].upper()
+        if command == "PING":
+            return "PONG"
+        if command in ("AUTH", "SELECT"):
+            return "OK"
+        if command == "GET":
+            return self.state.get(args[1])
+        if command == "DEL":
+            existed = self.state.get(args[1]) is not None
+            self.state.delete(args[1])
+            return int(existed)
+        if command == "SET":
+            key, value, options = args[1], args[2], [option.upper() for option in args[3:]]
+            ttl = None
+            if "EX" in options:
+                ttl = float(args[3 + options.index("EX") + 1])
+            if "PX" in options:
+                ttl = float(args[3 + options.index("PX") + 1]) / 1000
+            if "NX" in options:
+                return "OK" if self.state.set_if_absent(key, value, ttl=ttl) else None
+            self.state.set(key, value, ttl=ttl)
+            return "OK"
+        raise ValueError(f"unknown command '{command}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    args = parser.parse_args()
+
+    with StateServer(args.host, args.port) as server:
+        print(f"Serving shared state on {args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from metrics import registry
+from shared_state import MemoryState
+
+log = logging.getLogger(__name__)
+
+_NON_WORD_PATTERN = re.compile(r"[^\w\s]")
+_SPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """Lowercases a question and drops punctuation and extra whitespace so equivalent questions share a key."""
+    query = _NON_WORD_PATTERN.sub(" ", (query or "").lower())
+    return _SPACE_PATTERN.sub(" ", query).strip()
+
+
+class EventDeduplicator:
+    """Remembers recently seen Slack event IDs so redeliveries (X-Slack-Retry-Num) are processed only once.
+
+    With a shared `state` a redelivery is recognized even if it lands on another replica.
+    """
+
+    def __init__(self, ttl=600, maxsize=10000, state=None):
+        self.ttl = ttl
+        self.state = state or MemoryState(maxsize=maxsize, default_ttl=ttl)
+
+    def seen(self, event_id):
+        """Returns True if `event_id` was seen before, otherwise records it and returns False."""
+        if not event_id:
+            return False
+        try:
+            first = self.state.set_if_absent(f"event:{event_id}", True, ttl=self.ttl)
+        except Exception as e:
+            # better to answer twice than not at all
+            log.warning(f"Could not record event {event_id}: {e}")
+            return False
+        if not first:
+            registry.inc("slack_events_deduplicated")
+        return not first
+
+
+class _Call:
+    __slots__ = ['done', 'result', 'error', 'waiters']
+
+    def __init__(self, done=None):
+        self.done = done or threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+def _state_key(key):
+    return hashlib.sha256(json.dumps(key, default=str).encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution whose result every caller receives.
+
+    Within a process callers wait on the leader directly. With a shared `state` the leader also claims the key
+    across replicas: other replicas wait for its result instead of computing the same answer, and take over if the
+    claim expires after `lock_ttl` seconds or is released without a result. The result is only kept for the waiters
+    to pick it up (`result_ttl`, a few poll intervals by default), it is not an answer cache.
+    """
+
+    def __init__(self, state=None, lock_ttl=300, result_ttl=None, poll_interval=0.5):
+        self.state = state
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl if result_ttl is not None else poll_interval * 4
+        self.poll_interval = poll_interval
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._calls = {}
+        self._async_calls = {}  # only touched from the event loop, no lock
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            registry.inc("singleflight_calls", role="shared")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        registry.inc("singleflight_calls", role="leader")
+        try:
+            call.result = self._do_shared(key, func) if self.state is not None else func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, func):
+        """`do` for the async server: `func()` returns an awaitable, followers wait without holding a thread."""
+        call = self._async_calls.get(key)
+        if call is not None:
+            registry.inc("singleflight_calls", role="shared")
+            call.waiters += 1
+            await call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        registry.inc("singleflight_calls", role="leader")
+        call = self._async_calls[key] = _Call(asyncio.Event())
+        try:
+            call.result = await (self._ado_shared(key, func) if self.state is not None else func())
+            return call.result
+        except BaseException as e:
+            # a cancelled leader fails its followers too, instead of handing them None
+            call.error = e
+            raise
+        finally:
+            del self._async_calls[key]
+            call.done.set()
+
+    def _try_state(self, operation, *args, **kwargs):
+        try:
+            return getattr(self.state, operation)(*args, **kwargs), True
+        except Exception as e:
+            log.warning(f"Shared state {operation} failed, computing locally: {e}")
+            return None, False
+
+    def _do_shared(self, key, func):
+        name = _state_key(key)
+        lock_key, result_key = f"flight:{name}:lock", f"flight:{name}:result"
+
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            result, ok = self._try_state("get", result_key)
+            if not ok:
+                return func()
+            if result is not None:
+                registry.inc("singleflight_calls", role="replica")
+                return result["value"]
+
+            claimed, ok = self._try_state("set_if_absent", lock_key, self._owner, ttl=self.lock_ttl)
+            if not ok:
+                return func()
+            if claimed or time.monotonic() > deadline:
+                break
+            # another replica is computing this answer, wait for its result
+            time.sleep(self.poll_interval)
+
+        try:
+            value = func()
+            self._try_state("set", result_key, {"value": value}, ttl=self.result_ttl)
+            return value
+        finally:
+            if claimed:
+                self._try_state("delete", lock_key)
+
+    async def _atry_state(self, operation, *args, **kwargs):
+        # a Redis round trip (or a slow, unreachable server) must not stall the event loop
+        return await asyncio.to_thread(self._try_state, operation, *args, **kwargs)
+
+    async def _ado_shared(self, key, func):
+        # same protocol as _do_shared, with the state calls in a worker thread
+        name = _state_key(key)
+        lock_key, result_key = f"flight:{name}:lock", f"flight:{name}:result"
+
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            result, ok = await self._atry_state("get", result_key)
+            if not ok:
+                return await func()
+            if result is not None:
+                registry.inc("singleflight_calls", role="replica")
+                return result["value"]
+
+            claimed, ok = await self._atry_state("set_if_absent", lock_key, self._owner, ttl=self.lock_ttl)
+            if not ok:
+                return await func()
+            if claimed or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            value = await func()
+            await self._atry_state("set", result_key, {"value": value}, ttl=self.result_ttl)
+            return value
+        finally:
+            if claimed:
+                await self._atry_state("delete", lock_key)
@@ -1,6 +1,17 @@
+import asyncio
+import functools
+import inspect
+
 from llama_index.core.agent.react import ReActAgent
 from llama_index.core import Settings
 
+from retry import RetryPolicy, ToolCheckpoint
+from metrics import registry
+from singleflight import SingleFlight, normalize_query
+from scheduler import ACCEPTED, LIMITED, PRIORITY_COMMAND, PRIORITY_MENTION
+from slack_client import ChannelDirectory, SlackApiClient
+import tracing
+
 roles_and_interests = [
     "Software Engineer",
     "Product Manager",
@@ -37,11 +48,20 @@ blocks = [
 
 
 class SlackOperations:
-    def __init__(self, app):
+    """Slack Web API calls made by the bot, sent through a pooled, rate-limited `SlackApiClient`.
+
+    Messages wait for Slack to accept them so errors still reach the caller; reactions are fire-and-forget so they
+    never hold up an answer.
+    """
+
+    def __init__(self, app, api: SlackApiClient = None):
         self.app = app
+        self.api = api or SlackApiClient(app.client.token, base_url=app.client.base_url)
+        self.channels = ChannelDirectory(self.api)
 
     def post_ephemeral_message(self, channel, user, text, message_blocks=None, thread_ts=None):
-        self.app.client.chat_postEphemeral(
+        self.api.call_and_wait(
+            "chat.postEphemeral",
             channel=channel,
             user=user,
             text=text,
@@ -50,94 +70,292 @@ class SlackOperations:
         )
 
     def post_message(self, channel, text, thread_ts=None, blocks=None):
-        self.app.client.chat_postMessage(
+        self.api.call_and_wait(
+            "chat.postMessage",
+            channel=channel,
+            text=text,
+            thread_ts=thread_ts,
+            blocks=blocks
+        )
+
+    async def apost_ephemeral_message(self, channel, user, text, message_blocks=None, thread_ts=None):
+        await self.api.acall(
+            "chat.postEphemeral",
+            channel=channel,
+            user=user,
+            text=text,
+            blocks=message_blocks,
+            thread_ts=thread_ts
+        )
+
+    async def apost_message(self, channel, text, thread_ts=None, blocks=None):
+        await self.api.acall(
+            "chat.postMessage",
             channel=channel,
             text=text,
             thread_ts=thread_ts,
             blocks=blocks
         )
 
+    # notices sent from the event loop (e.g. "busy"), which must not wait for Slack
+
+    def post_ephemeral_later(self, channel, user, text, thread_ts=None):
+        self.api.fire_and_forget("chat.postEphemeral", channel=channel, user=user, text=text, thread_ts=thread_ts)
+
+    def post_message_later(self, channel, text, thread_ts=None):
+        self.api.fire_and_forget("chat.postMessage", channel=channel, text=text, thread_ts=thread_ts)
+
     def add_reaction(self, channel, timestamp, emoji):
-        self.app.client.reactions_add(
+        self.api.fire_and_forget(
+            "reactions.add",
+            order_key=(channel, timestamp),
             name=emoji,
             channel=channel,
             timestamp=timestamp
         )
 
     def remove_reaction(self, channel, timestamp, emoji):
-        self.app.client.reactions_remove(
+        self.api.fire_and_forget(
+            "reactions.remove",
+            order_key=(channel, timestamp),
             name=emoji,
             channel=channel,
             timestamp=timestamp
         )
 
     def join_channel(self, channel_name):
-        channel_list = self.app.client.conversations_list().data
-        channel = next((ch for ch in channel_list.get('channels', []) if ch.get("name") == channel_name), None)
-        if channel:
-            channel_id = channel.get('id')
-            self.app.client.conversations_join(channel=channel_id)
+        channel_id = self.channels.get_id(channel_name)
+        if channel_id:
+            self.api.call_and_wait("conversations.join", channel=channel_id)
             return channel_id
         return None
 
-    # Additional methods for other operations like posting messages, adding reactions, etc.
+
+def _collect_rich_text(elements, bot_user_id, fragments):
+    """Walks nested rich text elements, returns True if one of them mentions the bot."""
+    mentioned = False
+    for element in elements:
+        element_type = element.get('type')
+        if element_type == 'user' and element.get('user_id') == bot_user_id:
+            mentioned = True
+        elif element_type == 'text':
+            fragments.append(element.get('text', ''))
+        elif element_type == 'link':
+            fragments.append(element.get('text') or element.get('url', ''))
+        elif 'elements' in element:
+            # sections, lists, quotes and preformatted blocks nest their elements
+            mentioned = _collect_rich_text(element['elements'], bot_user_id, fragments) or mentioned
+            fragments.append('\n')
+    return mentioned
+
+
+def extract_mention_query(message, bot_user_id):
+    """Returns the text of a message that mentions the bot as a single query, or None."""
+    reply_blocks = message.get('blocks')
+    if not reply_blocks:
+        mention = f"<@{bot_user_id}>"
+        text = message.get('text', '')
+        if mention not in text:
+            return None
+        return text.replace(mention, ' ').strip() or None
+
+    fragments = []
+    rich_text_blocks = [block for block in reply_blocks if block.get('type') == 'rich_text']
+    if not _collect_rich_text(rich_text_blocks, bot_user_id, fragments):
+        return None
+
+    lines = (" ".join(line.split()) for line in "".join(fragments).splitlines())
+    return "\n".join(line for line in lines if line) or None
+
+
+# LLM the ReAct agents reason with, e.g. a `cascade.CascadeLLM`; Settings.llm when unset
+_agent_llm = None
+# `prefetch.RetrievalPrefetcher` that starts retrieving the question while the agent's first step runs
+_prefetcher = None
+
+
+def use_agent_llm(llm):
+    global _agent_llm
+    _agent_llm = llm
+
+
+def use_prefetcher(prefetcher):
+    global _prefetcher
+    _prefetcher = prefetcher
+
+
+def _create_agent(tools, context, handler):
+    registry.inc("agent_runs", handler=handler)
+    return ReActAgent.from_tools(
+        tools,
+        llm=_agent_llm or Settings.llm,
+        verbose=True,
+        context=context)
+
+
+def run_agent(tools, context, query, handler):
+    """Runs one ReAct agent chat over `tools`, counted per handler so runs per question can be tracked."""
+    agent = _create_agent(tools, context, handler)
+    if _prefetcher is None:
+        return agent.chat(query)
+    with _prefetcher.prefetch(query):
+        return agent.chat(query)
+
+
+async def arun_agent(tools, context, query, handler):
+    """`run_agent` for the async server: the agent awaits its LLM steps and tools (`achat`)."""
+    agent = _create_agent(tools, context, handler)
+    if _prefetcher is None:
+        return await agent.achat(query)
+    async with _prefetcher.aprefetch(query):
+        return await agent.achat(query)
+
+
+def _run_traced(name, func, *args):
+    # every span recorded while answering (embedding, search, LLM, tools, Slack calls) gets this request's ID
+    with tracing.request(name):
+        return func(*args)
+
+
+async def _arun_traced(name, func, *args):
+    # each job is its own task, with its own copy of the context, so concurrent requests keep separate traces
+    with tracing.request(name):
+        return await func(*args)
+
+
+_inline_tasks = set()
+
+busy_message = "I'm answering a lot of questions right now, please try again in a minute :pray:"
+limited_message = "You're asking faster than I can answer, please give me a minute before the next question :pray:"
+
+
+def submit_job(scheduler, name, func, *args, priority=PRIORITY_MENTION, user=None, channel=None, on_busy=None):
+    """Runs `func` through the scheduler (or inline without one).
+
+    A coroutine function `func` is run on the event loop, with an `AsyncJobQueue` behind the scheduler.
+    If the job is refused, `on_busy` is called with the message to show: the queue is full, or the user or channel
+    is over its rate limit.
+    """
+    is_async = inspect.iscoroutinefunction(func)
+    traced_func = functools.partial(_arun_traced if is_async else _run_traced, name, func)
+    if scheduler is None:
+        if is_async:
+            task = asyncio.get_running_loop().create_task(traced_func(*args))
+            # the loop only keeps weak references to its tasks
+            _inline_tasks.add(task)
+            task.add_done_callback(_inline_tasks.discard)
+        else:
+            traced_func(*args)
+        return True
+    result = scheduler.submit(name, traced_func, *args, priority=priority, user=user, channel=channel)
+    if result == ACCEPTED:
+        return True
+    if on_busy is not None:
+        on_busy(limited_message if result == LIMITED else busy_message)
+    return False
 
 
 # Other imports as needed
 
 class CommandHandler:
     def __init__(self, slack_ops: SlackOperations, query_engine_transcripts, query_engine_agent_commands_tools,
-                 agent_commands_context):
+                 agent_commands_context, scheduler=None, single_flight=None):
         self.slack_ops = slack_ops
         self.query_engine_transcripts = query_engine_transcripts
         self.query_engine_agent_commands_tools = query_engine_agent_commands_tools
         self.agent_commands_context = agent_commands_context
-
-    def process_command_query_with_retry(self, process_func, channel_id, user_id, thread_ts=None):
-        max_attempts = 5
-        try_count = 0
-        for attempt in range(max_attempts):
-            try:
-                response = process_func()
-                formatted_transcripts_response = utils.convert_to_slack_formatting(str(response))
-
-                self.slack_ops.post_ephemeral_message(channel_id, user_id, formatted_transcripts_response, thread_ts)
-
-                return True
-            except Exception as e:
-                print(f"Error: {str(e)}")
-                try_count += 1
-
-        if try_count == max_attempts:
+        self.retry_policy = RetryPolicy(max_attempts=5)
+        self.scheduler = scheduler
+        # identical questions in flight share one computation, shared between the handlers
+        self.single_flight = single_flight or SingleFlight()
+
+    def process_command_query_with_retry(self, process_func, channel_id, user_id, thread_ts=None, flight_key=None):
+        def compute():
+            return self.retry_policy.run(
+                lambda: utils.convert_to_slack_formatting(str(process_func())), label="command")
+
+        try:
+            formatted_transcripts_response = self.single_flight.do(flight_key, compute) if flight_key else compute()
+        except Exception as e:
+            print(f"Error: {str(e)}")
             self.slack_ops.post_ephemeral_message(channel_id, user_id,
                                                   "No further information to provide.",
-                                                  thread_ts)
-        return False
-
+                                                  thread_ts=thread_ts)
+            return False
+
+        self.slack_ops.post_ephemeral_message(channel_id, user_id, formatted_transcripts_response,
+                                              thread_ts=thread_ts)
+        return True
+
+    async def aprocess_command_query_with_retry(self, process_func, channel_id, user_id, thread_ts=None,
+                                                flight_key=None):
+        """`process_command_query_with_retry` for the async server, `process_func()` returns an awaitable."""
+        async def attempt():
+            return utils.convert_to_slack_formatting(str(await process_func()))
+
+        def compute():
+            return self.retry_policy.arun(attempt, label="command")
+
+        try:
+            formatted_transcripts_response = await (self.single_flight.ado(flight_key, compute) if flight_key
+                                                    else compute())
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            await self.slack_ops.apost_ephemeral_message(channel_id, user_id,
+                                                         "No further information to provide.",
+                                                         thread_ts=thread_ts)
+            return False
+
+        await self.slack_ops.apost_ephemeral_message(channel_id, user_id, formatted_transcripts_response,
+                                                     thread_ts=thread_ts)
+        return True
+
+    def _submit_command(self, name, func, command):
+        user_id = command['user_id']
+        channel_id = command['channel_id']
+        # the async server's handlers run on the event loop, which must not wait for Slack
+        notify = (self.slack_ops.post_ephemeral_later if inspect.iscoroutinefunction(func)
+                  else self.slack_ops.post_ephemeral_message)
+        submit_job(self.scheduler, name, func, command['text'], channel_id, user_id,
+                   priority=PRIORITY_COMMAND, user=user_id, channel=channel_id,
+                   on_busy=lambda message: notify(channel_id, user_id, message))
 
     def handle_commons_command_agent_only(self, ack, command):
         ack()
-        user_id = command['user_id']
-        channel_id = command['channel_id']
-        query = command['text']
+        self._submit_command("commons_command", self.process_commons_command_agent_only, command)
 
+    def process_commons_command_agent_only(self, query, channel_id, user_id):
         self.slack_ops.post_ephemeral_message(channel_id, user_id,
                                               "Got your command, working on it! :hourglass_flowing_sand:")
 
+        # tool results are reused if the agent run has to be retried
+        tools = ToolCheckpoint().wrap(self.query_engine_agent_commands_tools)
         self.process_command_query_with_retry(
-            lambda: ReActAgent.from_tools(
-                self.query_engine_agent_commands_tools,
-                llm=Settings.llm,
-                verbose=True,
-                context=self.agent_commands_context).chat(query),
-            channel_id, user_id
+            lambda: run_agent(tools, self.agent_commands_context, query, "command"),
+            channel_id, user_id,
+            flight_key=("agent", normalize_query(query))
         )
+
+    async def ahandle_commons_command_agent_only(self, ack, command):
+        await ack()
+        self._submit_command("commons_command", self.aprocess_commons_command_agent_only, command)
+
+    async def aprocess_commons_command_agent_only(self, query, channel_id, user_id):
+        await self.slack_ops.apost_ephemeral_message(channel_id, user_id,
+                                                     "Got your command, working on it! :hourglass_flowing_sand:")
+
+        tools = ToolCheckpoint().wrap(self.query_engine_agent_commands_tools)
+        await self.aprocess_command_query_with_retry(
+            lambda: arun_agent(tools, self.agent_commands_context, query, "command"),
+            channel_id, user_id,
+            flight_key=("agent", normalize_query(query))
+        )
+
     def handle_commons_command(self, ack, command):
         ack()
-        user_id = command['user_id']
-        channel_id = command['channel_id']
-        query = command['text']
+        self._submit_command("commons_command", self.process_commons_command, command)
 
+    def process_commons_command(self, query, channel_id, user_id):
         self.slack_ops.post_ephemeral_message(channel_id, user_id,
                                               "Got your command, working on it! :hourglass_flowing_sand:")
 
@@ -145,19 +363,18 @@ class CommandHandler:
             lambda: self.query_engine_transcripts.query(query),
             channel_id,
             user_id,
+            flight_key=("transcripts", normalize_query(query))
         )
 
         if transcripts_processed:
             self.slack_ops.post_ephemeral_message(channel_id, user_id,
                                                   "Getting you more information :information_source:")
 
+            tools = ToolCheckpoint().wrap(self.query_engine_agent_commands_tools)
             self.process_command_query_with_retry(
-                lambda: ReActAgent.from_tools(
-                    self.query_engine_agent_commands_tools,
-                    llm=Settings.llm,
-                    verbose=True,
-                    context=self.agent_commands_context).chat(query),
-                channel_id, user_id
+                lambda: run_agent(tools, self.agent_commands_context, query, "command"),
+                channel_id, user_id,
+                flight_key=("agent", normalize_query(query))
             )
 
     def handle_onboard_command(self, ack, body, client):
@@ -175,14 +392,35 @@ class CommandHandler:
             thread_ts=thread_ts
         )
 
+    async def ahandle_onboard_command(self, ack, body, client):
+        await ack()
+
+        user_id = body["user_id"]
+        await self.slack_ops.apost_ephemeral_message(
+            channel=body["channel_id"],
+            user=user_id,
+            text=f"Welcome <@{user_id}>",
+            message_blocks=blocks,
+            thread_ts=body.get('thread_ts', None)
+        )
+
     def handle_help_command(self, ack, body, client):
         ack()
 
         user_id = body["user_id"]
         channel_id = body["channel_id"]
 
-        # Define the help message with an additional section for asking questions
-        help_message = """
+        self.slack_ops.post_ephemeral_message(channel_id, user_id, help_message)
+
+    async def ahandle_help_command(self, ack, body, client):
+        await ack()
+        await self.slack_ops.apost_ephemeral_message(body["channel_id"], body["user_id"], help_message)
+
+    # Other command handlers as methods of this class
+
+
+# Define the help message with an additional section for asking questions
+help_message = """
     *Here are the commands you can use with this Slack bot:*
 
     * `/onboard`: Get started with the bot and set up your profile.
@@ -196,44 +434,63 @@ class CommandHandler:
     If you have any questions or need further assistance, feel free to ask here!
         """
 
-        self.slack_ops.post_ephemeral_message(channel_id, user_id, help_message)
-
-    # Other command handlers as methods of this class
-
 
 import utils
 
 
 class MessageHandler:
     def __init__(self, slack_ops: SlackOperations, query_engine_transcripts, query_engine_agent_commands_tools,
-                 agent_commands_context):
+                 agent_commands_context, scheduler=None, single_flight=None):
         self.slack_ops = slack_ops
         self.query_engine_transcripts = query_engine_transcripts
         self.query_engine_agent_commands_tools = query_engine_agent_commands_tools
         self.agent_commands_context = agent_commands_context
-
-    def process_message_query_with_retry(self, process_func, channel_id, user_id, thread_ts=None):
-        max_attempts = 7
-
-        try_count = 0
-        for attempt in range(max_attempts):
-            try:
-                response = process_func()
-                formatted_response = utils.convert_to_slack_formatting(str(response))
-                self.slack_ops.post_message(channel_id, formatted_response, thread_ts=thread_ts)
-                return True
-            except Exception as e:
-                print(f"Error: {str(e)}")
-                try_count += 1
-
-        if try_count == max_attempts:
+        self.retry_policy = RetryPolicy(max_attempts=7)
+        self.scheduler = scheduler
+        # identical questions in flight share one computation, shared between the handlers
+        self.single_flight = single_flight or SingleFlight()
+
+    def process_message_query_with_retry(self, process_func, channel_id, user_id, thread_ts=None, flight_key=None):
+        def compute():
+            return self.retry_policy.run(
+                lambda: utils.convert_to_slack_formatting(str(process_func())), label="message")
+
+        try:
+            formatted_response = self.single_flight.do(flight_key, compute) if flight_key else compute()
+        except Exception as e:
+            print(f"Error: {str(e)}")
             self.slack_ops.post_message(
                 channel_id,
                 "No further information to provide.",
                 thread_ts=thread_ts
             )
+            return False
+
+        self.slack_ops.post_message(channel_id, formatted_response, thread_ts=thread_ts)
+        return True
+
+    async def aprocess_message_query_with_retry(self, process_func, channel_id, user_id, thread_ts=None,
+                                                flight_key=None):
+        """`process_message_query_with_retry` for the async server, `process_func()` returns an awaitable."""
+        async def attempt():
+            return utils.convert_to_slack_formatting(str(await process_func()))
+
+        def compute():
+            return self.retry_policy.arun(attempt, label="message")
+
+        try:
+            formatted_response = await (self.single_flight.ado(flight_key, compute) if flight_key else compute())
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            await self.slack_ops.apost_message(
+                channel_id,
+                "No further information to provide.",
+                thread_ts=thread_ts
+            )
+            return False
 
-        return False
+        await self.slack_ops.apost_message(channel_id, formatted_response, thread_ts=thread_ts)
+        return True
 
     def process_message_query_agent_only(self, query, reply_channel_id, reply_user_id, thread_ts):
         self.slack_ops.add_reaction(reply_channel_id, thread_ts, "hourglass_flowing_sand")
@@ -244,21 +501,42 @@ class MessageHandler:
             text="Got your command, working on it! :hourglass_flowing_sand:"
         )
 
+        # tool results are reused if the agent run has to be retried
+        tools = ToolCheckpoint().wrap(self.query_engine_agent_commands_tools)
         self.process_message_query_with_retry(
-            lambda: ReActAgent.from_tools(
-                self.query_engine_agent_commands_tools,
-                llm=Settings.llm,
-                verbose=True,
-                context=self.agent_commands_context).chat(query),
+            lambda: run_agent(tools, self.agent_commands_context, query, "mention"),
             channel_id=reply_channel_id,
             user_id=reply_user_id,
-            thread_ts=thread_ts
+            thread_ts=thread_ts,
+            flight_key=("agent", normalize_query(query))
         )
 
         # remove the hourglass emoji and add a checkmark
         self.slack_ops.remove_reaction(reply_channel_id, thread_ts, "hourglass_flowing_sand")
         self.slack_ops.add_reaction(reply_channel_id, thread_ts, "white_check_mark")
 
+    async def aprocess_message_query_agent_only(self, query, reply_channel_id, reply_user_id, thread_ts):
+        # reactions are fire-and-forget, they never wait on the loop
+        self.slack_ops.add_reaction(reply_channel_id, thread_ts, "hourglass_flowing_sand")
+
+        await self.slack_ops.apost_ephemeral_message(
+            reply_channel_id,
+            reply_user_id,
+            text="Got your command, working on it! :hourglass_flowing_sand:"
+        )
+
+        tools = ToolCheckpoint().wrap(self.query_engine_agent_commands_tools)
+        await self.aprocess_message_query_with_retry(
+            lambda: arun_agent(tools, self.agent_commands_context, query, "mention"),
+            channel_id=reply_channel_id,
+            user_id=reply_user_id,
+            thread_ts=thread_ts,
+            flight_key=("agent", normalize_query(query))
+        )
+
+        self.slack_ops.remove_reaction(reply_channel_id, thread_ts, "hourglass_flowing_sand")
+        self.slack_ops.add_reaction(reply_channel_id, thread_ts, "white_check_mark")
+
 
     def process_message_query(self, query, reply_channel_id, reply_user_id, thread_ts):
         self.slack_ops.add_reaction(reply_channel_id, thread_ts, "hourglass_flowing_sand")
@@ -273,22 +551,21 @@ class MessageHandler:
             lambda: self.query_engine_transcripts.query(query),
             reply_channel_id,
             reply_user_id,
-            thread_ts
+            thread_ts,
+            flight_key=("transcripts", normalize_query(query))
         )
 
         if transcripts_processed:
             self.slack_ops.post_ephemeral_message(reply_channel_id, reply_user_id,
                                                   "Getting you more information :information_source:")
 
+            tools = ToolCheckpoint().wrap(self.query_engine_agent_commands_tools)
             self.process_message_query_with_retry(
-                lambda: ReActAgent.from_tools(
-                    self.query_engine_agent_commands_tools,
-                    llm=Settings.llm,
-                    verbose=True,
-                    context=self.agent_commands_context).chat(query),
+                lambda: run_agent(tools, self.agent_commands_context, query, "mention"),
                 channel_id=reply_channel_id,
                 user_id=reply_user_id,
-                thread_ts=thread_ts
+                thread_ts=thread_ts,
+                flight_key=("agent", normalize_query(query))
             )
 
         # remove the hourglass emoji and add a checkmark
@@ -296,24 +573,28 @@ class MessageHandler:
         self.slack_ops.add_reaction(reply_channel_id, thread_ts, "white_check_mark")
 
     def reply(self, message, bot_user_id):
+        self._submit_reply(message, bot_user_id, self.process_message_query_agent_only, self.slack_ops.post_message)
+
+    def areply(self, message, bot_user_id):
+        """`reply` for the async server: the answer is computed on the event loop, a busy notice is not waited for."""
+        self._submit_reply(message, bot_user_id, self.aprocess_message_query_agent_only,
+                           self.slack_ops.post_message_later)
+
+    def _submit_reply(self, message, bot_user_id, process, notify):
         user_id = message['user']
         channel_id = message['channel']
         thread_ts = message.get('thread_ts', message['ts'])
-        reply_blocks = message.get('blocks')
-
-        if reply_blocks:
-            for block in reply_blocks:
-                if block.get('type') != 'rich_text':
-                    print("TYPE IS:" + block.get('type'))
-                    continue
-                for rich_text_section in block.get('elements', []):
-                    elements = rich_text_section.get('elements', [])
-                    if any(element.get('type') == 'user' and element.get('user_id') == bot_user_id for element in
-                           elements):
-                        for element in elements:
-                            if element.get('type') == 'text':
-                                query = element.get('text')
-                                self.process_message_query_agent_only(query, channel_id, user_id, thread_ts)
+
+        # one consolidated question per message, however many sections or line breaks it has
+        query = extract_mention_query(message, bot_user_id)
+        if not query:
+            return
+
+        registry.inc("mention_messages")
+        submit_job(self.scheduler, "mention", process,
+                   query, channel_id, user_id, thread_ts,
+                   priority=PRIORITY_MENTION, user=user_id, channel=channel_id,
+                   on_busy=lambda message: notify(channel_id, message, thread_ts=thread_ts))
 
     def handle_message(self, message, say, client, bot_user_id):
         self.reply(message, bot_user_id)
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from metrics import registry
+from rate_limit import TokenBucket
+import tracing
+
+log = logging.getLogger(__name__)
+
+# Web API rate limit tiers (calls per minute per workspace), https://api.slack.com/docs/rate-limits
+METHOD_TIERS = {
+    "chat.postEphemeral": 100,
+    "reactions.add": 50,
+    "reactions.remove": 50,
+    "conversations.join": 50,
+    "conversations.history": 50,
+    "conversations.list": 20,
+}
+DEFAULT_TIER = 20
+# chat.postMessage is limited to about one message per second per channel
+POST_MESSAGE_PER_CHANNEL = 60
+
+
+class SlackApiClient:
+    """Pooled `AsyncWebClient` running on its own event loop thread.
+
+    Calls are rate limited per method tier (and per channel for `chat.postMessage`) before they are sent, share one
+    aiohttp connection pool, and are retried on 429 using the `Retry-After` header. `call` returns a future, so callers
+    can wait for the result (`call_and_wait`, `acall`) or not (`fire_and_forget`). Calls made on another event loop
+    (the async server's) run on that loop, with a client of its own, instead of hopping to the client's thread.
+    """
+
+    def __init__(self, token, base_url=None, max_connections=16, timeout=30):
+        self.token = token
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._buckets = {}
+        self._pending = {}
+        self._local_pending = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._client = None
+        self._pid = None
+        self._local_client = None
+        self._local_client_loop = None
+
+    def _ensure_started(self):
+        # the loop thread does not survive a fork (gunicorn preload), start one per process
+        with self._lock:
+            if self._pid == os.getpid():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="slack-api-loop", daemon=True).start()
+            self._client = asyncio.run_coroutine_threadsafe(self._create_client(), loop).result()
+            self._loop = loop
+            self._buckets = {}
+            self._pending = {}
+            self._pid = os.getpid()
+            return loop
+
+    async def _create_client(self):
+        import aiohttp
+        from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+        from slack_sdk.web.async_client import AsyncWebClient
+
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        kwargs = {"base_url": self.base_url} if self.base_url else {}
+        return AsyncWebClient(token=self.token, session=session, timeout=self.timeout,
+                              retry_handlers=[AsyncRateLimitErrorRetryHandler(max_retry_count=3)], **kwargs)
+
+    async def _get_local_client(self):
+        # aiohttp sessions are bound to the loop they were created on
+        loop = asyncio.get_running_loop()
+        if self._local_client_loop is not loop:
+            self._local_client = await self._create_client()
+            self._local_client_loop = loop
+        return self._local_client
+
+    def _caller_loop(self):
+        """The event loop of the caller (the async server's), None in threads and on the client's own loop."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+        return None if loop is self._loop else loop
+
+    def _bucket(self, method, channel=None):
+        if method == "chat.postMessage":
+            key = (method, channel)
+            calls = POST_MESSAGE_PER_CHANNEL
+        else:
+            key = (method, None)
+            calls = METHOD_TIERS.get(method, DEFAULT_TIER)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket.per_minute(calls)
+            return bucket
+
+    async def _call(self, method, kwargs, after=None, trace=None):
+        with tracing.use_trace(trace):
+            return await self._traced_call(self._client, method, kwargs, after)
+
+    async def _call_local(self, method, kwargs, after=None):
+        # a task on the caller's loop, it already runs in the caller's context (and trace)
+        return await self._traced_call(await self._get_local_client(), method, kwargs, after)
+
+    async def _traced_call(self, client, method, kwargs, after):
+        if after is not None:
+            # keep calls on the same message in order, e.g. adding a reaction before removing it
+            await asyncio.wait([asyncio.wrap_future(after)])
+
+        delay = self._bucket(method, kwargs.get("channel")).reserve()
+        if delay:
+            registry.inc("slack_api_throttled_seconds", delay, method=method)
+            await asyncio.sleep(delay)
+
+        start = time.monotonic()
+        try:
+            return await getattr(client, method.replace(".", "_"))(**kwargs)
+        except Exception:
+            registry.inc("slack_api_errors", method=method)
+            raise
+        finally:
+            registry.inc("slack_api_calls", method=method)
+            tracing.record("slack_api", time.monotonic() - start, method=method)
+
+    def _ordered(self, pending, order_key, start):
+        """Starts a call with `start(after)`, where `after` is the previous call with the same `order_key`."""
+        if order_key is None:
+            return start(None)
+
+        with self._lock:
+            after = pending.get(order_key)
+            future = start(after)
+            pending[order_key] = future
+
+        def forget(done):
+            with self._lock:
+                if pending.get(order_key) is done:
+                    del pending[order_key]
+
+        future.add_done_callback(forget)
+        return future
+
+    def _call_threadsafe(self, method, order_key, kwargs):
+        loop = self._ensure_started()
+        # the loop thread has its own context, hand it the caller's trace so the call is tied to its request
+        trace = tracing.current_trace()
+        return self._ordered(
+            self._pending, order_key,
+            lambda after: asyncio.run_coroutine_threadsafe(self._call(method, kwargs, after, trace), loop))
+
+    def call(self, method, order_key=None, **kwargs):
+        """Schedules a Web API call such as `call("reactions.add", ...)` and returns its future.
+
+        From a thread the call runs on the client's loop and a `concurrent.futures.Future` is returned; from another
+        event loop it runs on that loop as a task. Calls sharing an `order_key` run one after another, in the order
+        they were made from the same side.
+        """
+        loop = self._caller_loop()
+        if loop is None:
+            return self._call_threadsafe(method, order_key, kwargs)
+        return self._ordered(self._local_pending, order_key,
+                             lambda after: loop.create_task(self._call_local(method, kwargs, after)))
+
+    def call_and_wait(self, method, **kwargs):
+        # blocks, so always on the client's loop even when called from another loop's thread
+        return self._call_threadsafe(method, None, kwargs).result(timeout=self.timeout * 2)
+
+    async def acall(self, method, order_key=None, **kwargs):
+        """`call_and_wait` for coroutines: awaits the call, made on the caller's loop."""
+        future = asyncio.wrap_future(self.call(method, order_key=order_key, **kwargs))
+        return await asyncio.wait_for(future, timeout=self.timeout * 2)
+
+    def fire_and_forget(self, method, order_key=None, **kwargs):
+        """Sends a call nobody waits for (reactions and other cosmetics); failures are only logged."""
+
+        def done(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is not None:
+                log.warning(f"Slack {method} failed: {error}")
+
+        self.call(method, order_key=order_key, **kwargs).add_done_callback(done)
+
+
+class ChannelDirectory:
+    """Channel name to ID lookup from a paginated `conversations.list`, refreshed every `ttl` seconds."""
+
+    def __init__(self, api: SlackApiClient, ttl=3600, page_size=1000):
+        self.api = api
+        self.ttl = ttl
+        self.page_size = page_size
+        self._ids = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        ids = {}
+        cursor = None
+        while True:
+            response = self.api.call_and_wait("conversations.list", limit=self.page_size, cursor=cursor,
+                                              exclude_archived=True, types="public_channel")
+            for channel in response.get("channels", []):
+                ids[channel["name"]] = channel["id"]
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+        self._ids = ids
+        self._loaded_at = time.monotonic()
+        registry.set_gauge("slack_channel_directory_size", len(ids))
+        return ids
+
+    def get_id(self, channel_name):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self.refresh()
+            channel_id = self._ids.get(channel_name)
+            if channel_id is None and time.monotonic() - self._loaded_at > 60:
+                # the channel may have been created since the last refresh
+                channel_id = self.refresh().get(channel_name)
+            return channel_id
@@ -0,0 +1,220 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from slack_sdk.errors import SlackApiError
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        channel TEXT NOT NULL,
+        ts TEXT NOT NULL,
+        user TEXT,
+        thread_ts TEXT,
+        text TEXT NOT NULL,
+        PRIMARY KEY (channel, ts)
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages', content_rowid='rowid'
+    );
+    CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+        INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+    END;
+    -- synced_ts: everything up to it is mirrored; target_ts / resume_ts: newest and oldest ts of an unfinished run
+    CREATE TABLE IF NOT EXISTS backfill_state (
+        channel TEXT PRIMARY KEY,
+        synced_ts TEXT,
+        target_ts TEXT,
+        resume_ts TEXT
+    );
+    """
+
+
+class SlackMessageStore:
+    """Local mirror of Slack channel messages with a full-text (FTS5) index.
+
+    The mirror is kept current from the event stream (`add_message`, `update_message`, `delete_message`) and filled
+    with a paginated, resumable `backfill` of the configured channels.
+    """
+
+    def __init__(self, path="slack_messages.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._db()
+
+    def _db(self):
+        # sqlite connections must not be shared with forked (gunicorn) workers, reopen once per process
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def add_message(self, message):
+        """Stores a message from the Slack event stream or history API."""
+        text = message.get("text")
+        channel = message.get("channel")
+        if not text or not channel or not message.get("ts"):
+            return
+
+        conn = self._db()
+        with self._lock:
+            conn.execute(
+                "INSERT INTO messages (channel, ts, user, thread_ts, text) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (channel, ts) DO UPDATE SET text = excluded.text",
+                (channel, message["ts"], message.get("user"), message.get("thread_ts"), text),
+            )
+            conn.commit()
+
+    def update_message(self, event):
+        """Applies a `message_changed` event."""
+        message = dict(event.get("message", {}), channel=event.get("channel"))
+        self.add_message(message)
+
+    def delete_message(self, event):
+        """Applies a `message_deleted` event."""
+        conn = self._db()
+        with self._lock:
+            conn.execute("DELETE FROM messages WHERE channel = ? AND ts = ?",
+                         (event.get("channel"), event.get("deleted_ts")))
+            conn.commit()
+
+    def backfill_state(self, channel):
+        """(synced_ts, target_ts, resume_ts) of a channel's backfill, all None before the first one."""
+        conn = self._db()
+        with self._lock:
+            row = conn.execute("SELECT synced_ts, target_ts, resume_ts FROM backfill_state WHERE channel = ?",
+                               (channel,)).fetchone()
+        return row or (None, None, None)
+
+    def _set_backfill_state(self, channel, synced_ts, target_ts, resume_ts):
+        conn = self._db()
+        with self._lock:
+            conn.execute(
+                "INSERT INTO backfill_state (channel, synced_ts, target_ts, resume_ts) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (channel) DO UPDATE SET synced_ts = excluded.synced_ts, "
+                "target_ts = excluded.target_ts, resume_ts = excluded.resume_ts",
+                (channel, synced_ts, target_ts, resume_ts),
+            )
+            conn.commit()
+
+    def count(self, channel=None) -> int:
+        conn = self._db()
+        with self._lock:
+            if channel:
+                return conn.execute("SELECT COUNT(*) FROM messages WHERE channel = ?", (channel,)).fetchone()[0]
+            return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def backfill(self, client, channel, page_size=200, max_pages=None):
+        """Pages through `conversations_history` (newest first) for the messages the mirror is missing.
+
+        Only a run that reaches the end moves the channel's `synced_ts` watermark up to the newest message it saw.
+        An interrupted run (an error, `max_pages`) records the oldest message it reached, and the next run continues
+        below it, so older history is never skipped. Messages stored from events don't move the watermark.
+        """
+        synced_ts, target_ts, resume_ts = self.backfill_state(channel)
+        oldest = synced_ts or "0"
+        latest = resume_ts if target_ts else None
+        cursor = None
+        pages = 0
+        fetched = 0
+        complete = False
+        while max_pages is None or pages < max_pages:
+            try:
+                response = client.conversations_history(channel=channel, limit=page_size, oldest=oldest,
+                                                        latest=latest, cursor=cursor)
+            except SlackApiError as e:
+                if e.response.status_code == 429:
+                    time.sleep(int(e.response.headers.get("Retry-After", 1)))
+                    continue
+                log.error(f"Slack API Error while mirroring {channel}: {e.response['error']}")
+                break
+
+            messages = response["messages"]
+            for message in messages:
+                self.add_message(dict(message, channel=channel))
+            fetched += len(messages)
+            pages += 1
+
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            complete = not response.get("has_more") or not cursor
+            if messages:
+                page_ts = [message["ts"] for message in messages]
+                if target_ts is None:
+                    target_ts = max(page_ts, key=float)
+                resume_ts = min(page_ts, key=float)
+                if not complete:
+                    self._set_backfill_state(channel, synced_ts, target_ts, resume_ts)
+            if complete:
+                break
+
+        if complete:
+            if target_ts is not None and (synced_ts is None or float(target_ts) > float(synced_ts)):
+                synced_ts = target_ts
+            self._set_backfill_state(channel, synced_ts or "0", None, None)
+
+        registry.inc("slack_mirror_backfilled_messages", fetched, channel=channel)
+        log.info(f"Mirrored {fetched} new messages from {channel}" + ("" if complete else " (to be continued)"))
+        return fetched
+
+    def search(self, query, channels: Optional[List[str]] = None, limit=20) -> List[dict]:
+        """Returns the best BM25-ranked messages containing any of the query terms."""
+        terms = _TOKEN_PATTERN.findall(query.lower())
+        if not terms:
+            return []
+
+        match = " OR ".join(f'"{term}"' for term in terms)
+        sql = ("SELECT m.channel, m.ts, m.user, m.thread_ts, m.text FROM messages_fts "
+               "JOIN messages m ON m.rowid = messages_fts.rowid WHERE messages_fts MATCH ?")
+        params = [match]
+        if channels:
+            sql += f" AND m.channel IN ({','.join('?' * len(channels))})"
+            params.extend(channels)
+        sql += " ORDER BY bm25(messages_fts) LIMIT ?"
+        params.append(limit)
+
+        start = time.monotonic()
+        conn = self._db()
+        with self._lock:
+            rows = conn.execute(sql, params).fetchall()
+        registry.inc("slack_mirror_search_seconds", time.monotonic() - start)
+
+        return [
+            {"channel": channel, "ts": ts, "user": user, "thread_ts": thread_ts, "text": text}
+            for channel, ts, user, thread_ts, text in rows
+        ]
+
+    def start_backfill(self, client, channels):
+        """Backfills the given channels in a background thread."""
+
+        def run():
+            for channel in channels:
+                try:
+                    self.backfill(client, channel)
+                except Exception as e:
+                    log.error(f"Backfill of {channel} failed: {e}")
+
+        thread = threading.Thread(target=run, name="slack-mirror-backfill", daemon=True)
+        thread.start()
+        return thread
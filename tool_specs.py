@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from typing import List, Optional
 from llama_index.core.tools.tool_spec.base import BaseToolSpec
@@ -5,6 +6,9 @@ from slack_sdk.errors import SlackApiError
 
 from memory_profiler import profile
 
+from metrics import registry
+from tracing import traced
+
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,14 +20,19 @@ class SlackToolSpec(BaseToolSpec):
     from slack_sdk import WebClient
 
     """Slack tool spec."""
-    spec_functions = ["get_channel_history_by_query"]
+    # (sync, async) pairs: the async server's agents await the second one
+    spec_functions = [("get_channel_history_by_query", "aget_channel_history_by_query")]
 
-    __slots__ = ['client']
+    __slots__ = ['client', 'message_store', 'channel_ids']
 
     # @profile
-    def __init__(self, client: WebClient):
+    def __init__(self, client: WebClient, message_store=None, channel_ids: Optional[List[str]] = None):
         self.client = client
+        # local mirror of channel messages (see slack_mirror.SlackMessageStore), searched instead of the history API
+        self.message_store = message_store
+        self.channel_ids = channel_ids or ["C0FNVPMNF"]
 
+    @traced("tool", tool="search_messages")
     def search_messages(self, query: str) -> List[dict]:
         """Search for messages matching a query."""
         try:
@@ -37,6 +46,7 @@ class SlackToolSpec(BaseToolSpec):
             print(f"Error searching messages: {e.response['error']}")
             return []
 
+    @traced("tool", tool="get_channel_history")
     def get_channel_history(self, channel_id: str, limit: int = 100) -> List[dict]:
         """Fetches the message history of a channel."""
         try:
@@ -50,11 +60,13 @@ class SlackToolSpec(BaseToolSpec):
             print(f"Slack API Error: {e.response['error']}")
             return []
 
+    @traced("tool", tool="get_channel_history_by_query")
     def get_channel_history_by_query(self, query: str, limit: int = 100) -> List[dict]:
-        """Fetches channel history and filters messages by a search query."""
+        """Searches the history of the community channels for messages related to a query."""
+        if self.message_store is not None and self.message_store.count():
+            return self.message_store.search(query, channels=self.channel_ids, limit=min(limit, 20))
 
-        # fixed to general channel for now
-        # TODO - make this more dynamic
+        # no mirror yet, fall back to the last messages of the general channel
         _general_channel = "C0FNVPMNF"
         messages = self.get_channel_history(_general_channel, limit)
         query_related_messages = []
@@ -66,119 +78,190 @@ class SlackToolSpec(BaseToolSpec):
 
         return query_related_messages
 
+    async def aget_channel_history_by_query(self, query: str, limit: int = 100) -> List[dict]:
+        """Async `get_channel_history_by_query`."""
+        # the sqlite mirror (or the history API) is blocking, search in a worker thread
+        return await asyncio.to_thread(self.get_channel_history_by_query, query, limit)
+
 
 # build a spec to check if youtube url is functional
 class YoutubeSpec(BaseToolSpec):
     """Youtube tool spec."""
-    spec_functions = ["check_youtube_url"]
+    spec_functions = [("check_youtube_url", "acheck_youtube_url")]
 
-    def check_youtube_url(self, url) -> str:
-        """Check if the youtube url is functional."""
-        from pytube import YouTube
-        valid_yt_links = []
-        try:
-            yt = YouTube(url)
-            yt.check_availability()
-            return "Valid youtube link"
-        except Exception as e:
-            print(f"Error checking youtube link {url}: {e}")
-            # return exception message
-            return str(e)
+    __slots__ = ['catalog']
+
+    def __init__(self, catalog=None):
+        from youtube_catalog import VideoCatalog
+
+        self.catalog = catalog if catalog is not None else VideoCatalog()
+
+    @traced("tool", tool="check_youtube_url")
+    def check_youtube_url(self, url: str, title: Optional[str] = None) -> str:
+        """Check if the youtube url is functional and, if a title is given, that it matches the video."""
+        from youtube_catalog import title_similarity
+
+        video_id, video = self.catalog.lookup(url)
+        if video_id is None:
+            return f"Not a youtube video link: {url}"
+        if video["valid"] is False:
+            return video["error"] or "Video unavailable"
+
+        if title and video["title"]:
+            if title_similarity(title, video["title"]) < 0.5:
+                return f"Valid youtube link, but its title is \"{video['title']}\", not \"{title}\""
+            return f"Valid youtube link, title matches: {video['title']}"
+
+        if video["title"]:
+            return f"Valid youtube link: {video['title']}"
+        return "Valid youtube link"
+
+    async def acheck_youtube_url(self, url: str, title: Optional[str] = None) -> str:
+        """Async `check_youtube_url`."""
+        from youtube_catalog import extract_video_id
+
+        video_id = extract_video_id(url)
+        if video_id is None or self.catalog.get(video_id) is not None:
+            # answered from the catalog in memory
+            return self.check_youtube_url(url, title)
+        # unknown video, youtube is asked in a worker thread
+        return await asyncio.to_thread(self.check_youtube_url, url, title)
 
 
 class FeedSpec(BaseToolSpec):
     """News fetcher specification."""
-    spec_functions = ["fetch_news"]
+    spec_functions = [("fetch_news", "afetch_news")]
 
-    __slots__ = ['feed_urls']
+    __slots__ = ['feed_urls', 'feed_cache']
 
     # @profile
-    def __init__(self):
+    def __init__(self, refresh_interval: int = 900):
+        from feed_cache import FeedCache
+
         self.feed_urls = [
             "https://www.cncf.io/rss",
             "https://kubernetes.io/feed.xml",
             "https://www.redhat.com/en/rss/blog",
             "https://research.redhat.com/feed/"
         ]
+        # feeds are fetched and ranked in the background, fetch_news only reads the cached list
+        self.feed_cache = FeedCache(self.feed_urls, refresh_interval=refresh_interval)
 
+    @traced("tool", tool="fetch_news")
     def fetch_news(self) -> str:
-        import feedparser
-
         """Fetch news items from specified feeds."""
-        print("Fetching news...")
-        formatted_news_list = []
-        for url in self.feed_urls:
-            try:
-                # Parse the feed
-                feed = feedparser.parse(url)
-                for entry in feed.entries:
-                    formatted_item = f"Title: {entry.title}\n" \
-                                     f"Link: {entry.link}\n" \
-                                     f"Published: {entry.published}\n" \
-                        # f"Summary: {entry.summary}\n" \
-                    formatted_news_list.append(formatted_item)
-
-            except Exception as e:
-                # log error
-                logging.error(f"Error parsing RSS URL '{url}': {e}")
-                # print(f"Error fetching news from {url}: {e}")
-
-        # limit items in formatted_news_list that contain openshift or red hat to 4 and include the rest up to 10
-        red_hat_openshift_news = [news for news in formatted_news_list if
-                                  "red hat" in news.lower() or "openshift" in news.lower()]
+        formatted_news_list, age = self.feed_cache.get_news()
+        if not formatted_news_list:
+            return "No news available right now."
 
-        formatted_news_list = [news for news in formatted_news_list if news not in red_hat_openshift_news]
-        formatted_news_list = red_hat_openshift_news[:4] + formatted_news_list
-        formatted_news_list = formatted_news_list[:10]
+        return f"News last updated {int(age // 60)} minutes ago.\n\n" + "\n\n".join(formatted_news_list)
 
-        print("\n\n".join(formatted_news_list))
-        return "\n\n".join(formatted_news_list)
+    async def afetch_news(self) -> str:
+        """Async `fetch_news`."""
+        # the feeds are refreshed in the background, reading the cached list doesn't block
+        return self.fetch_news()
 
 
 class BingSearchToolSpec(BaseToolSpec):
     """Bing Search tool spec."""
 
-    spec_functions = ["bing_search", "bing_news_search", "bing_video_search"]
+    spec_functions = [("bing_search", "abing_search"), ("bing_news_search", "abing_news_search"),
+                      ("bing_video_search", "abing_video_search"), ("bing_multi_search", "abing_multi_search")]
     # spec_functions = ["bing_news_search", "bing_image_search", "bing_video_search"]
 
     def __init__(
-            self, api_key: str, lang: Optional[str] = "en-US", results: Optional[int] = 5
+            self, api_key: str, lang: Optional[str] = "en-US", results: Optional[int] = 5,
+            timeout: float = 10.0, cache_ttl: int = 600, cache_size: int = 256,
+            cache_max_bytes: Optional[int] = 4 * 1024 * 1024
     ) -> None:
         """Initialize with parameters."""
+        import requests
+        from requests.adapters import HTTPAdapter
+        from ttl_cache import TTLCache
+
         self.api_key = api_key
         self.lang = lang
         self.results = results
+        self.timeout = timeout
+
+        # one keep-alive session for all endpoints, sized for the concurrent multi search
+        self._session = requests.Session()
+        self._session.headers.update({"Ocp-Apim-Subscription-Key": self.api_key})
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl, name="bing", max_bytes=cache_max_bytes)
+        # aiohttp session of the async server's loop, created on its first search
+        self._async_session = None
+        self._async_session_loop = None
+
+    # Endpoint base URL
+    endpoint_base_url = "https://api.bing.microsoft.com/v7.0/"
+
+    def _cached(self, endpoint: str, query: str, freshness: str):
+        cache_key = (endpoint, query.strip().lower(), freshness, self.lang, self.results)
+        cached = self._cache.get(cache_key)
+        registry.inc("bing_cache_requests", result="miss" if cached is None else "hit")
+        if cached is None:
+            # Log
+            logging.info(f"Making a request to Bing {endpoint} with query: {query}")
+        return cache_key, cached
+
+    def _params(self, query: str, freshness: str):
+        return {
+            "q": query,
+            "mkt": self.lang,
+            "count": self.results,
+            "freshness": freshness,  # Use the freshness parameter here
+        }
+
+    def _results(self, cache_key, response_json, keys: List[str]):
+        # Processing the response, web search nests its results under webPages
+        values = response_json.get("webPages", response_json).get("value", [])
 
-    def _bing_request(self, endpoint: str, query: str, keys: List[str], freshness: str = "Year"):
-        import requests
-        import logging
-
-        # Log
-        logging.info(f"Making a request to Bing {endpoint} with query: {query}")
+        # Extracting and returning the desired information from the results
+        results = [[result.get(key) for key in keys] for result in values]
+        self._cache.set(cache_key, results)
+        return results
 
-        # Endpoint base URL
-        endpoint_base_url = "https://api.bing.microsoft.com/v7.0/"
+    def _bing_request(self, endpoint: str, query: str, keys: List[str], freshness: str = "Year"):
+        cache_key, cached = self._cached(endpoint, query, freshness)
+        if cached is not None:
+            return cached
 
         # Making the request
-        response = requests.get(
-            endpoint_base_url + endpoint,
-            headers={"Ocp-Apim-Subscription-Key": self.api_key},
-            params={
-                "q": query,
-                "mkt": self.lang,
-                "count": self.results,
-                "freshness": freshness,  # Use the freshness parameter here
-            },
+        response = self._session.get(
+            self.endpoint_base_url + endpoint,
+            params=self._params(query, freshness),
+            timeout=self.timeout,
         )
-
-        # Processing the response
-        response_json = response.json()
-        print(response)
-
-        # Extracting and returning the desired information from the results
-        return [[result[key] for key in keys] for result in response_json.get("value", [])]
+        response.raise_for_status()
+        return self._results(cache_key, response.json(), keys)
+
+    def _get_async_session(self):
+        import aiohttp
+
+        # a session belongs to the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._async_session_loop is not loop:
+            self._async_session_loop = loop
+            self._async_session = aiohttp.ClientSession(
+                headers={"Ocp-Apim-Subscription-Key": self.api_key},
+                connector=aiohttp.TCPConnector(limit=8),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._async_session
+
+    async def _abing_request(self, endpoint: str, query: str, keys: List[str], freshness: str = "Year"):
+        cache_key, cached = self._cached(endpoint, query, freshness)
+        if cached is not None:
+            return cached
+
+        params = {name: str(value) for name, value in self._params(query, freshness).items() if value is not None}
+        async with self._get_async_session().get(self.endpoint_base_url + endpoint, params=params) as response:
+            response.raise_for_status()
+            return self._results(cache_key, await response.json(), keys)
 
     # write a function to do bing search
+    @traced("tool", tool="bing_search")
     def bing_search(self, query: str):
         """
         Make a query to bing news search. Useful for finding news on a query.
@@ -189,6 +272,12 @@ class BingSearchToolSpec(BaseToolSpec):
         """
         return self._bing_request("search", query, ["name", "description", "url"])
 
+    @traced("tool", tool="bing_search")
+    async def abing_search(self, query: str):
+        """Async `bing_search`."""
+        return await self._abing_request("search", query, ["name", "description", "url"])
+
+    @traced("tool", tool="bing_news_search")
     def bing_news_search(self, query: str):
         """
         Make a query to bing news search. Useful for finding news on a query.
@@ -199,7 +288,13 @@ class BingSearchToolSpec(BaseToolSpec):
         """
         return self._bing_request("news/search", query, ["name", "description", "url"])
 
+    @traced("tool", tool="bing_news_search")
+    async def abing_news_search(self, query: str):
+        """Async `bing_news_search`."""
+        return await self._abing_request("news/search", query, ["name", "description", "url"])
 
+
+    @traced("tool", tool="bing_image_search")
     def bing_image_search(self, query: str):
         """
         Make a query to bing images search. Useful for finding an image of a query.
@@ -211,6 +306,7 @@ class BingSearchToolSpec(BaseToolSpec):
         """
         return self._bing_request("images/search", query, ["name", "contentUrl"])
 
+    @traced("tool", tool="bing_video_search")
     def bing_video_search(self, query: str):
         """
         Make a query to bing video search. Useful for finding a video related to a query.
@@ -220,3 +316,59 @@ class BingSearchToolSpec(BaseToolSpec):
 
         """
         return self._bing_request("videos/search", query, ["name", "contentUrl"])
+
+    @traced("tool", tool="bing_video_search")
+    async def abing_video_search(self, query: str):
+        """Async `bing_video_search`."""
+        return await self._abing_request("videos/search", query, ["name", "contentUrl"])
+
+    @traced("tool", tool="bing_multi_search")
+    def bing_multi_search(self, query: str):
+        """
+        Make a query to bing web, news and video search at once. Useful for getting
+        web pages, news and videos on a query in a single step.
+
+        Args:
+            query (str): The query to be passed to bing.
+
+        """
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+
+        searches = {
+            "web": self.bing_search,
+            "news": self.bing_news_search,
+            "videos": self.bing_video_search,
+        }
+        with ThreadPoolExecutor(max_workers=len(searches)) as executor:
+            # run each search in a copy of this context so its spans stay tied to the request
+            futures = {name: executor.submit(contextvars.copy_context().run, search, query)
+                       for name, search in searches.items()}
+
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(f"Bing {name} search failed for query '{query}': {e}")
+                results[name] = []
+        return results
+
+    @traced("tool", tool="bing_multi_search")
+    async def abing_multi_search(self, query: str):
+        """Async `bing_multi_search`."""
+        searches = {
+            "web": self.abing_search,
+            "news": self.abing_news_search,
+            "videos": self.abing_video_search,
+        }
+        # concurrent on the loop, no threads needed
+        outcomes = await asyncio.gather(*(search(query) for search in searches.values()), return_exceptions=True)
+
+        results = {}
+        for name, outcome in zip(searches, outcomes):
+            if isinstance(outcome, Exception):
+                logging.error(f"Bing {name} search failed for query '{query}': {outcome}")
+                outcome = []
+            results[name] = outcome
+        return results
@@ -0,0 +1,201 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+# the `Trace` of the Slack question being answered in this context
+_trace = ContextVar("trace", default=None)
+
+# context manager factories entered around every request, e.g. `profiling.Profiler.profile_request`
+_request_hooks = []
+
+
+COST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Trace:
+    __slots__ = ['request_id', 'name', 'spans', 'costs']
+
+    def __init__(self, name, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.name = name
+        self.spans = []
+        self.costs = defaultdict(float)  # LLM role -> USD
+
+    def summary(self):
+        totals = defaultdict(float)
+        for stage, seconds in self.spans:
+            totals[stage] += seconds
+        summary = " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in sorted(totals.items(), key=lambda t: -t[1]))
+        if self.costs:
+            summary += " cost: " + " ".join(f"{role}=${usd:.4f}" for role, usd in sorted(self.costs.items()))
+        return summary
+
+
+def current_trace():
+    return _trace.get()
+
+
+def current_request_id():
+    trace = _trace.get()
+    return trace.request_id if trace else None
+
+
+@contextmanager
+def use_trace(trace):
+    """Attaches spans recorded in this context (e.g. another thread or event loop) to `trace`."""
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def add_request_hook(hook):
+    """Registers `hook(trace)`, a context manager wrapped around every request."""
+    _request_hooks.append(hook)
+
+
+@contextmanager
+def request(name, request_id=None):
+    """Root span of one Slack question; every span recorded inside is tied to its request ID."""
+    trace = Trace(name, request_id)
+    start = time.perf_counter()
+    with use_trace(trace):
+        try:
+            with ExitStack() as hooks:
+                for hook in _request_hooks:
+                    hooks.enter_context(hook(trace))
+                yield trace
+        finally:
+            duration = time.perf_counter() - start
+            registry.observe("request_seconds", duration, job=name)
+            if trace.costs:
+                registry.observe("request_llm_cost_usd", sum(trace.costs.values()), buckets=COST_BUCKETS, job=name)
+            log.info(f"Request {trace.request_id} ({name}) took {duration:.2f}s: {trace.summary()}")
+
+
+def record(stage, seconds, **labels):
+    registry.observe("stage_seconds", seconds, stage=stage, **labels)
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.append((stage, seconds))
+        log.debug(f"Request {trace.request_id}: {stage} {labels} took {seconds:.3f}s")
+
+
+def record_llm_usage(role, model, prompt_tokens, completion_tokens, usd):
+    """Counts the tokens and cost of one LLM call and charges it to the current request."""
+    registry.inc("llm_tokens", prompt_tokens, model=model, role=role, kind="prompt")
+    registry.inc("llm_tokens", completion_tokens, model=model, role=role, kind="completion")
+    registry.inc("llm_cost_usd", usd, model=model, role=role)
+    trace = _trace.get()
+    if trace is not None:
+        trace.costs[role] += usd
+
+
+@contextmanager
+def span(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        registry.inc("stage_errors", stage=stage)
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, **labels)
+
+
+def traced(stage, **labels):
+    """Decorator recording each call (or await, for coroutine functions) as a `stage` span; tool functions keep their
+    signature and docstring."""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage, **labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_methods(obj, names, stage):
+    """Wraps the named methods of `obj` (e.g. the Qdrant client's searches) in spans."""
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is not None:
+            setattr(obj, name, traced(stage, method=name)(method))
+
+
+# llama-index instrumentation events, start and end of the same call share a span_id
+_LLAMA_INDEX_STAGES = {
+    "EmbeddingStartEvent": ("embedding", True),
+    "EmbeddingEndEvent": ("embedding", False),
+    "RetrievalStartEvent": ("retrieval", True),
+    "RetrievalEndEvent": ("retrieval", False),
+    "QueryStartEvent": ("query", True),
+    "QueryEndEvent": ("query", False),
+    "ReRankStartEvent": ("rerank", True),
+    "ReRankEndEvent": ("rerank", False),
+    "LLMChatStartEvent": ("llm", True),
+    "LLMChatEndEvent": ("llm", False),
+    "LLMCompletionStartEvent": ("llm", True),
+    "LLMCompletionEndEvent": ("llm", False),
+}
+
+
+def install_llama_index_spans():
+    """Records query engine, embedding, retrieval, rerank and LLM calls made through llama-index as spans."""
+    from llama_index.core.bridge.pydantic import PrivateAttr
+    from llama_index.core.instrumentation import get_dispatcher
+    from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+
+    class StageEventHandler(BaseEventHandler):
+        # start time per (stage, span_id); an end event may come from another thread or task than its start
+        _started: dict = PrivateAttr(default_factory=dict)
+        _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+        max_started: int = 10000
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "StageEventHandler"
+
+        def handle(self, event, **kwargs):
+            stage = _LLAMA_INDEX_STAGES.get(event.class_name())
+            if stage is None or event.span_id is None:
+                # without a span the start and end of concurrent calls can't be told apart
+                return
+            name, is_start = stage
+            key = (name, event.span_id)
+            with self._lock:
+                if is_start:
+                    self._started[key] = time.perf_counter()
+                    # calls that never ended (errors) must not pile up
+                    while len(self._started) > self.max_started:
+                        del self._started[next(iter(self._started))]
+                    return
+                started = self._started.pop(key, None)
+            if started is not None:
+                record(name, time.perf_counter() - started)
+
+    handler = StageEventHandler()
+    get_dispatcher().add_event_handler(handler)
+    return handler
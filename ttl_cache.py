@@ -0,0 +1,81 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def approximate_size(value):
+    """Rough number of bytes held by `value` (strings, bytes, numbers and nested containers of them)."""
+    if isinstance(value, (str, bytes, bytearray, int, float, bool)) or value is None:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(approximate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire `ttl` seconds after they were set.
+
+    With `max_bytes`, least recently used entries are also evicted once the values add up to more than that.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=256, ttl=600, name=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self.bytes -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is self._MISSING:
+                return default
+
+            expires_at, value, _ = item
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        size = approximate_size(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            self.pop(key)
+            return
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (self.max_bytes and self.bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key][1]
+            self._remove(key)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
@@ -0,0 +1,15 @@
+"""WSGI entry point for gunicorn (`gunicorn -c gunicorn.conf.py wsgi:app`).
+
+`commons-bot.py` is not importable by name, so it is loaded from its path here.
+"""
+import importlib.util
+import os
+
+_spec = importlib.util.spec_from_file_location(
+    "commons_bot", os.path.join(os.path.dirname(os.path.abspath(__file__)), "commons-bot.py")
+)
+commons_bot = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(commons_bot)
+
+app = commons_bot.flask_app
+start_background_services = commons_bot.start_background_services
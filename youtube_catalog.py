@@ -0,0 +1,246 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from metrics import registry
+from shared_state import Lease
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "commons_urls.xlsx")
+
+_VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def extract_video_id(url):
+    """Returns the 11 character video ID of a youtube URL (watch, youtu.be, shorts, embed) or None."""
+    if not url:
+        return None
+    url = url.strip().strip("<>").split("|")[0]
+    if _VIDEO_ID_PATTERN.match(url):
+        return url
+
+    parsed = urlparse(url if "://" in url else f"https://{url}")
+    host = parsed.netloc.lower()
+    video_id = None
+    if host.endswith("youtu.be"):
+        video_id = parsed.path.lstrip("/").split("/")[0]
+    elif "youtube" in host:
+        if parsed.path == "/watch":
+            video_id = parse_qs(parsed.query).get("v", [None])[0]
+        elif parsed.path.startswith(("/shorts/", "/embed/", "/live/", "/v/")):
+            video_id = parsed.path.split("/")[2]
+
+    return video_id if video_id and _VIDEO_ID_PATTERN.match(video_id) else None
+
+
+def title_similarity(a, b):
+    """Share of the words of `a` that appear in `b`."""
+    words_a = set(_WORD_PATTERN.findall(a.lower()))
+    words_b = set(_WORD_PATTERN.findall(b.lower()))
+    if not words_a:
+        return 0.0
+    return len(words_a & words_b) / len(words_a)
+
+
+class VideoCatalog:
+    """Local catalog of known videos with their titles and link validity.
+
+    Lookups are answered from memory; `refresh` re-validates the catalog in bulk (in the background after `start`),
+    and only unknown video IDs are checked against youtube on demand. With a shared `state` one process per
+    deployment holds the refresher lease and re-validates the videos not checked within `refresh_interval`; it shares
+    the results through `state`, and the other processes load them every `check_interval` seconds.
+    """
+
+    CHECKS_KEY = "youtube_catalog:checks"
+
+    def __init__(self, refresh_interval=24 * 3600, max_workers=8, state=None, check_interval=600, max_unknown=1000):
+        self.refresh_interval = refresh_interval
+        self.max_workers = max_workers
+        self.state = state
+        self.check_interval = check_interval
+        self.max_unknown = max_unknown
+        self._lease = Lease(state, "youtube_catalog:refresher", ttl=check_interval * 3) if state is not None else None
+        self._videos = {}  # video id -> {"title", "published", "valid", "error", "checked_at"}
+        self._unknown = OrderedDict()  # videos outside the catalog checked by `lookup`, least recently used first
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._videos)
+
+    def get(self, video_id):
+        video = self._videos.get(video_id)
+        if video is None:
+            with self._lock:
+                video = self._unknown.get(video_id)
+        return video
+
+    def _upsert(self, video_id, **fields):
+        with self._lock:
+            video = self._videos.setdefault(
+                video_id, {"title": None, "published": None, "valid": None, "error": None, "checked_at": None}
+            )
+            video.update({k: v for k, v in fields.items() if v is not None or k in ("error",)})
+
+    def add_links(self, links):
+        for link in links:
+            video_id = extract_video_id(link)
+            if video_id:
+                self._upsert(video_id)
+
+    def load_spreadsheet(self, path=DEFAULT_CATALOG_PATH):
+        """Loads video IDs, titles and publish dates from the commons URL spreadsheet."""
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        sheet = workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(cell).strip() if cell else "" for cell in next(rows)]
+        url_col = header.index("URL")
+        id_col = header.index("Content")
+        title_col = header.index("Video title")
+        published_col = header.index("Video publish time") if "Video publish time" in header else None
+
+        loaded = 0
+        for row in rows:
+            video_id = extract_video_id(str(row[id_col] or "")) or extract_video_id(
+                f"{row[url_col] or ''}{row[id_col] or ''}")
+            if not video_id:
+                continue
+            published = row[published_col] if published_col is not None else None
+            self._upsert(video_id, title=row[title_col], published=str(published) if published else None)
+            loaded += 1
+
+        workbook.close()
+        log.info(f"Loaded {loaded} videos from {path}")
+        return loaded
+
+    def _validate(self, video_id, fetch_title=False):
+        """Checks a video against youtube; returns its `valid`, `error`, `title` and `checked_at` fields."""
+        from pytube import YouTube
+
+        registry.inc("youtube_remote_checks")
+        try:
+            yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
+            yt.check_availability()
+            title = yt.title if fetch_title else None
+            return {"valid": True, "error": None, "title": title, "checked_at": time.time()}
+        except Exception as e:
+            print(f"Error checking youtube link {video_id}: {e}")
+            return {"valid": False, "error": str(e), "title": None, "checked_at": time.time()}
+
+    def _check(self, video_id, fetch_title):
+        self._upsert(video_id, **self._validate(video_id, fetch_title))
+
+    def _check_unknown(self, video_id):
+        video = dict(self._validate(video_id, fetch_title=True), published=None)
+        with self._lock:
+            self._unknown[video_id] = video
+            while len(self._unknown) > self.max_unknown:
+                self._unknown.popitem(last=False)
+        return video
+
+    def _snapshot(self):
+        # lookups and loaded checks update the catalog while a refresh runs
+        with self._lock:
+            return {video_id: dict(video) for video_id, video in self._videos.items()}
+
+    def load_checks(self):
+        """Takes the validation results another process shared through `state`, where they are newer than ours."""
+        if self.state is None:
+            return
+        try:
+            checks = self.state.get(self.CHECKS_KEY) or {}
+        except Exception as e:
+            log.warning(f"Could not load the video catalog checks: {e}")
+            return
+        with self._lock:
+            for video_id, fields in checks.items():
+                video = self._videos.get(video_id)
+                if video is not None and (video["checked_at"] or 0) < fields["checked_at"]:
+                    video.update({k: v for k, v in fields.items() if v is not None or k in ("error",)})
+
+    def save_checks(self):
+        if self.state is None:
+            return
+        checks = {
+            video_id: {k: video[k] for k in ("valid", "error", "title", "checked_at")}
+            for video_id, video in self._snapshot().items() if video["checked_at"] is not None
+        }
+        try:
+            self.state.set(self.CHECKS_KEY, checks)
+        except Exception as e:
+            log.warning(f"Could not share the video catalog checks: {e}")
+
+    def _report(self):
+        videos = self._snapshot()
+        invalid = sum(1 for video in videos.values() if video["valid"] is False)
+        registry.set_gauge("youtube_catalog_videos", len(videos))
+        registry.set_gauge("youtube_catalog_invalid_videos", invalid)
+        return invalid
+
+    def refresh(self):
+        """Re-validates, in parallel, the videos of the catalog not checked within `refresh_interval` seconds."""
+        start = time.monotonic()
+        self.load_checks()
+        videos = self._snapshot()
+        now = time.time()
+        stale = [video_id for video_id, video in videos.items()
+                 if video["checked_at"] is None or now - video["checked_at"] > self.refresh_interval]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for video_id in stale:
+                executor.submit(self._check, video_id, not videos[video_id]["title"])
+        if stale:
+            self.save_checks()
+
+        invalid = self._report()
+        log.info(f"Validated {len(stale)} videos ({invalid} unavailable) in {time.monotonic() - start:.1f}s")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._lease is None or self._lease.acquire():
+                    self.refresh()
+                else:
+                    # another process validates the catalog, use its results
+                    self.load_checks()
+                    self._report()
+            except Exception as e:
+                log.error(f"Video catalog refresh failed: {e}")
+            self._stop.wait(self.refresh_interval if self.state is None else self.check_interval)
+
+    def start(self):
+        """Starts the background re-validation (again, if this process was forked after it started)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="youtube-catalog", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def lookup(self, url):
+        """Returns (video_id, video) for a URL, going to youtube only for IDs not in the catalog."""
+        video_id = extract_video_id(url)
+        if video_id is None:
+            return None, None
+
+        video = self.get(video_id)
+        if video is None:
+            registry.inc("youtube_catalog_lookups", result="unknown")
+            return video_id, self._check_unknown(video_id)
+
+        registry.inc("youtube_catalog_lookups", result="known")
+        return video_id, video